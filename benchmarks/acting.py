@@ -0,0 +1,69 @@
+import argparse
+import time
+import numpy as np
+import torch
+
+from src.model import Dueling_DQN
+from utils.replay_buffer import ReplayBuffer
+from utils.frame_stack import FrameStack
+
+device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+
+
+def check(frames, dones, frame_history_len):
+    """Assert that a FrameStack holds the observation the replay buffer
+    encodes at every step, across episode ends."""
+    replay_buffer = ReplayBuffer(len(frames), frame_history_len)
+    frame_stack = FrameStack(frame_history_len)
+    for frame, done in zip(frames, dones):
+        idx = replay_buffer.store_frame(frame)
+        frame_stack.push(frame)
+        assert torch.equal(frame_stack.observation(), replay_buffer.encode_recent_observation())
+        replay_buffer.store_effect(idx, 0, 0.0, done)
+        if done:
+            frame_stack.reset()
+
+
+def run(Q, frames, dones, frame_history_len, fast):
+    """Per step time of storing a frame and choosing the greedy action, by
+    re-encoding the observation from the replay buffer and returning a 0-d
+    tensor (fast=False), or from a FrameStack returning an int (fast=True)."""
+    replay_buffer = ReplayBuffer(len(frames), frame_history_len)
+    frame_stack = FrameStack(frame_history_len)
+    start = time.perf_counter()
+    for frame, done in zip(frames, dones):
+        idx = replay_buffer.store_frame(frame)
+        if fast:
+            frame_stack.push(frame)
+            with torch.no_grad():
+                action = int(Q(frame_stack.observation().unsqueeze(0)).max(1)[1])
+        else:
+            observations = replay_buffer.encode_recent_observation()
+            with torch.no_grad():
+                action = (Q(observations.unsqueeze(0)).data.max(1)[1])[0]
+        replay_buffer.store_effect(idx, action, 0.0, done)
+        if fast and done:
+            frame_stack.reset()
+    if device.type == 'cuda':
+        torch.cuda.synchronize()
+    return (time.perf_counter() - start) / len(frames)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Per step acting latency, replay encoding vs FrameStack')
+    parser.add_argument("--steps", type=int, default=2000)
+    parser.add_argument("--frame_history_len", type=int, default=4)
+    parser.add_argument("--num_actions", type=int, default=4)
+    parser.add_argument("--episode_len", type=int, default=100, help="mean episode length")
+    args = parser.parse_args()
+
+    np.random.seed(0)
+    frames = np.random.randint(0, 256, (args.steps, 84, 84, 1), dtype=np.uint8)
+    dones = np.random.rand(args.steps) < 1.0 / args.episode_len
+    Q = Dueling_DQN(args.frame_history_len, args.num_actions).to(device)
+
+    check(frames, dones, args.frame_history_len)
+    print("%-14s %10s" % ("", "us/step"))
+    for name, fast in (("encode", False), ("frame stack", True)):
+        run(Q, frames[:100], dones[:100], args.frame_history_len, fast)   # warm up
+        print("%-14s %10.1f" % (name, 1e6 * run(Q, frames, dones, args.frame_history_len, fast)))
@@ -0,0 +1,83 @@
+import argparse
+import time
+import torch
+import torch.optim as optim
+
+from src.model import Dueling_DQN, TargetHistory
+from src.learner_step import CompiledStep, make_aa_target
+
+device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+
+
+def make_update(Q, optimizer, aa_target, rows, batch, batch_size, compiled):
+    """One AA update of raa_dqn: online forward, AA target, clipped TD error
+    backward and optimizer step."""
+    obs_t, act_t, rew_t, obs_tp1, done_mask = batch
+    Q_update = CompiledStep(Q) if compiled else Q
+    aa_target = CompiledStep(aa_target) if compiled else aa_target
+    optimizer_step = CompiledStep(optimizer.step) if compiled else optimizer.step
+
+    def update():
+        q_s_a = Q_update(obs_t[:batch_size]).gather(1, act_t[:batch_size].unsqueeze(1)).squeeze(1)
+        q_rhs, delta_Qs = aa_target(obs_t, act_t, rew_t, obs_tp1, done_mask, rows)
+        clipped_error = -1.0 * (q_rhs - q_s_a).clamp(-1, 1)
+        optimizer.zero_grad()
+        q_s_a.backward(clipped_error.data)
+        optimizer_step()
+        return q_rhs
+    return update, (Q_update, aa_target, optimizer_step)
+
+
+def updates_per_sec(update, iters):
+    for _ in range(3):
+        update()
+    if device.type == 'cuda':
+        torch.cuda.synchronize()
+    start = time.perf_counter()
+    for _ in range(iters):
+        update()
+    if device.type == 'cuda':
+        torch.cuda.synchronize()
+    return iters / (time.perf_counter() - start)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='RAA updates/sec, eager vs torch.compile')
+    parser.add_argument("--batch_size", type=int, default=32)
+    parser.add_argument("--sample_size", type=int, default=128)
+    parser.add_argument("--num_actions", type=int, default=4)
+    parser.add_argument("--AA", type=int, default=0)
+    parser.add_argument("--soft", type=int, default=0)
+    parser.add_argument("--iters", type=int, default=50)
+    args = parser.parse_args()
+
+    torch.manual_seed(0)
+    n = args.sample_size
+    batch = (torch.randint(0, 256, (n, 4, 84, 84), dtype=torch.uint8, device=device),
+             torch.randint(0, args.num_actions, (n,), device=device),
+             torch.randn(n, device=device).clamp(-1, 1),
+             torch.randint(0, 256, (n, 4, 84, 84), dtype=torch.uint8, device=device),
+             (torch.rand(n, device=device) < 0.01).float())
+
+    print("%3s %12s %12s %8s %12s" % ("num", "eager u/s", "compiled u/s", "speedup", "q_rhs err"))
+    for num in range(2, 6):
+        results = []
+        for compiled in (False, True):
+            # the same initial weights for both modes
+            torch.manual_seed(num)
+            Q = Dueling_DQN(4, args.num_actions).to(device)
+            Q_targets = TargetHistory(Q, 5)
+            for _ in range(5):
+                Q_targets.push(Dueling_DQN(4, args.num_actions).to(device))
+            optimizer = optim.RMSprop(Q.parameters(), lr=0.00025, alpha=0.95, eps=0.01)
+            rows = torch.LongTensor(Q_targets.order(num)).to(device)
+            aa_target = make_aa_target(Q_targets, args.batch_size, 0.99, 0.05, 0.1, args.AA, args.soft, 5.0)
+            update, steps = make_update(Q, optimizer, aa_target, rows, batch, args.batch_size, compiled)
+            first_q_rhs = update()
+            results.append((first_q_rhs, updates_per_sec(update, args.iters), steps))
+
+        err = (results[0][0] - results[1][0]).abs().max().item()
+        print("%3d %12.1f %12.1f %8.2f %12.2e" % (num, results[0][1], results[1][1], results[1][1] / results[0][1], err))
+        fallbacks = [s.fallback for s in results[1][2] if s.fallback]
+        if fallbacks:
+            print("    compiled ran eagerly: %s" % fallbacks[0])
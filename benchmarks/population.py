@@ -0,0 +1,118 @@
+import argparse
+import time
+import torch
+import torch.optim as optim
+
+from src.model import Dueling_DQN, StackedQ, TargetHistory
+from src.anderson_solver import raa_alpha, raa_alpha_batched
+from src.backup import bellman_targets
+
+device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+
+
+def make_optimizer(params):
+    return optim.RMSprop(params, lr=0.00025, alpha=0.95, eps=0.01)
+
+
+def separate_update(Q, Q_targets, optimizer, batch, batch_size, gamma, beta, reg):
+    """One AA update of raa_dqn with all targets live, for one run."""
+    obs_t, act_t, rew_t, obs_tp1, done_mask = batch
+    n = obs_t.size(0)
+    q_s_a = Q(obs_t[:batch_size]).gather(1, act_t[:batch_size].unsqueeze(1)).squeeze(1)
+    q = Q_targets(torch.cat((obs_t, obs_tp1), 0))
+    qs = q[:, :n].gather(2, act_t.view(1, -1, 1).expand(q.size(0), -1, 1)).squeeze(2)
+    F_qs = bellman_targets(q[:, n:], rew_t, done_mask, gamma)
+    alpha = raa_alpha((F_qs - qs).t(), reg)
+    q_rhs = beta * qs[:, :batch_size].t().mm(alpha) + (1 - beta) * F_qs[:, :batch_size].t().mm(alpha)
+    optimizer.zero_grad()
+    q_s_a.backward(-1.0 * (q_rhs.squeeze(1) - q_s_a).clamp(-1, 1))
+    optimizer.step()
+
+
+def population_update(Q, Q_targets, optimizer, batch, batch_size, gamma, beta, regs):
+    """The same update for all members of a population at once, as in
+    src.population_dqn."""
+    obs_t, act_t, rew_t, obs_tp1, done_mask = batch
+    K, n = act_t.shape
+    q_s_a = Q(obs_t[:batch_size]).gather(2, act_t[:, :batch_size].unsqueeze(2)).squeeze(2)
+    q = Q_targets(torch.cat((obs_t, obs_tp1), 0))
+    qs = q[:, :, :n].gather(3, act_t.view(K, 1, -1, 1).expand(-1, q.size(1), -1, 1)).squeeze(3)
+    F_qs = bellman_targets(q[:, :, n:], rew_t.unsqueeze(1), done_mask.unsqueeze(1), gamma)
+    alpha = raa_alpha_batched((F_qs - qs).transpose(1, 2), regs)
+    q_rhs = (beta * qs[:, :, :batch_size].transpose(1, 2).bmm(alpha)
+             + (1 - beta) * F_qs[:, :, :batch_size].transpose(1, 2).bmm(alpha)).squeeze(2)
+    optimizer.zero_grad()
+    q_s_a.backward(-1.0 * (q_rhs - q_s_a).clamp(-1, 1))
+    optimizer.step()
+
+
+def timeit(f, iters):
+    f()
+    if device.type == 'cuda':
+        torch.cuda.synchronize()
+    start = time.perf_counter()
+    for _ in range(iters):
+        f()
+    if device.type == 'cuda':
+        torch.cuda.synchronize()
+    return (time.perf_counter() - start) / iters
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Updates/sec of K separate RAA learners vs one population')
+    parser.add_argument("--members", type=int, default=4)
+    parser.add_argument("--batch_size", type=int, default=32)
+    parser.add_argument("--sample_size", type=int, default=128)
+    parser.add_argument("--num_actions", type=int, default=4)
+    parser.add_argument("--iters", type=int, default=20)
+    args = parser.parse_args()
+    K, n, gamma, beta, reg = args.members, args.sample_size, 0.99, 0.05, 0.1
+
+    torch.manual_seed(0)
+    nets = [[Dueling_DQN(4, args.num_actions).to(device) for i in range(6)] for k in range(K)]
+    batches = [(torch.randint(0, 256, (n, 4, 84, 84), dtype=torch.uint8, device=device),
+                torch.randint(0, args.num_actions, (n,), device=device),
+                torch.randn(n, device=device).clamp(-1, 1),
+                torch.randint(0, 256, (n, 4, 84, 84), dtype=torch.uint8, device=device),
+                (torch.rand(n, device=device) < 0.01).float()) for k in range(K)]
+
+    # K runs of their own, each with its online network and 5 targets
+    runs = []
+    for k in range(K):
+        # a copy, the population starts from the same weights
+        Q = Dueling_DQN(4, args.num_actions).to(device)
+        Q.load_state_dict(nets[k][0].state_dict())
+        Q_targets = TargetHistory(Q, 5)
+        for i in range(5):
+            Q_targets.push(nets[k][1 + i])
+        runs.append((Q, Q_targets, make_optimizer(Q.parameters())))
+
+    # the population of the same K runs
+    Q = StackedQ([net[0] for net in nets])
+    Q_targets = TargetHistory(Q, 5)
+    for i in range(5):
+        Q_targets.push(StackedQ([net[1 + i] for net in nets]))
+    optimizer = make_optimizer(Q.parameters())
+    batch = (torch.cat([b[0] for b in batches], 1), torch.stack([b[1] for b in batches]),
+             torch.stack([b[2] for b in batches]), torch.cat([b[3] for b in batches], 1),
+             torch.stack([b[4] for b in batches]))
+    regs = torch.full((K,), reg, dtype=torch.float64, device=device)
+
+    def separate():
+        for run, b in zip(runs, batches):
+            separate_update(*run, b, args.batch_size, gamma, beta, reg)
+
+    def population():
+        population_update(Q, Q_targets, optimizer, batch, args.batch_size, gamma, beta, regs)
+
+    separate_time = timeit(separate, args.iters)
+    population_time = timeit(population, args.iters)
+    print("%-12s %14s" % ("", "updates/sec"))
+    print("%-12s %14.1f" % ("separate", K / separate_time))
+    print("%-12s %14.1f" % ("population", K / population_time))
+    print("speedup %.2f" % (separate_time / population_time))
+
+    # both took iters + 1 updates on the same batches from the same weights
+    error = max((Q.params[k] - torch.cat(Q._flatten(run[0]))).abs().max().item()
+                for k, run in enumerate(runs))
+    print("max abs difference of the parameters after %d updates %.2e" % (args.iters + 1, error))
@@ -0,0 +1,66 @@
+import argparse
+import time
+import torch
+
+from src.model import Dueling_DQN, TargetHistory
+from utils.precision import autocast, bf16_stages, bellman_target_error
+
+device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+
+
+def timeit(f, iters):
+    f()
+    if device.type == 'cuda':
+        torch.cuda.synchronize()
+    start = time.perf_counter()
+    for _ in range(iters):
+        f()
+    if device.type == 'cuda':
+        torch.cuda.synchronize()
+    return (time.perf_counter() - start) / iters
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Learner stages in float32 vs bfloat16 autocast')
+    parser.add_argument("--batch_size", type=int, default=32)
+    parser.add_argument("--sample_size", type=int, default=128)
+    parser.add_argument("--num_actions", type=int, default=4)
+    parser.add_argument("--gamma", type=float, default=0.99)
+    parser.add_argument("--iters", type=int, default=20)
+    args = parser.parse_args()
+    bf16_stages('bf16')
+
+    torch.manual_seed(0)
+    Q = Dueling_DQN(4, args.num_actions).to(device)
+    Q_targets = TargetHistory(Q, 5)
+    for _ in range(5):
+        Q_targets.push(Dueling_DQN(4, args.num_actions).to(device))
+    obs = torch.randint(0, 256, (1, 4, 84, 84), dtype=torch.uint8, device=device)
+    obs_t = torch.randint(0, 256, (args.batch_size, 4, 84, 84), dtype=torch.uint8, device=device)
+    cat_obs = torch.randint(0, 256, (2 * args.sample_size, 4, 84, 84), dtype=torch.uint8, device=device)
+    done_mask = (torch.rand(2 * args.sample_size, device=device) < 0.01).float()
+
+    def acting():
+        with torch.no_grad():
+            return Q(obs).max(1)[1]
+
+    def online():
+        Q.zero_grad()
+        Q(obs_t).float().max(1)[0].sum().backward()
+
+    def targets():
+        return Q_targets(cat_obs).float()
+
+    print("%-8s %10s %10s %8s" % ("stage", "fp32 ms", "bf16 ms", "speedup"))
+    for name, f in (('acting', acting), ('online', online), ('targets', targets)):
+        fp32_time = timeit(f, args.iters)
+        with autocast(True):
+            bf16_time = timeit(f, args.iters)
+        print("%-8s %10.2f %10.2f %8.2f" % (name, 1e3 * fp32_time, 1e3 * bf16_time, fp32_time / bf16_time))
+
+    # accuracy of each target's max backup on s' (the reward cancels)
+    with torch.no_grad():
+        scale = Q_targets(cat_obs).abs().max().item()
+    for i in range(5):
+        error = bellman_target_error(lambda x: Q_targets(x)[i], cat_obs, done_mask, args.gamma)
+        print("bellman targets of target %d: max abs error %.2e (max |Q| %.2e)" % (i, error, scale))
@@ -0,0 +1,64 @@
+import argparse
+import time
+import cv2
+import numpy as np
+
+from utils.atari_wrappers import FRAME84_TOLERANCE, _process_frame84, process_frames84
+
+
+def reference_frame84(frame):
+    """The float32 preprocessing _process_frame84 replaced."""
+    img = np.reshape(frame, [210, 160, 3]).astype(np.float32)
+    img = img[:, :, 0] * 0.299 + img[:, :, 1] * 0.587 + img[:, :, 2] * 0.114
+    resized_screen = cv2.resize(img, (84, 110),  interpolation=cv2.INTER_LINEAR)
+    x_t = resized_screen[18:102, :]
+    x_t = np.reshape(x_t, [84, 84, 1])
+    return x_t.astype(np.uint8)
+
+
+def frames_per_sec(f, frames, repeats):
+    start = time.perf_counter()
+    for _ in range(repeats):
+        f(frames)
+    return repeats * len(frames) / (time.perf_counter() - start)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Frames/sec of the Atari preprocessing, float32 vs uint8')
+    parser.add_argument("--frames", type=int, default=256)
+    parser.add_argument("--repeats", type=int, default=10)
+    args = parser.parse_args()
+
+    # noise, the worst case for the rounding differences, and smooth frames
+    # closer to a game screen
+    rng = np.random.default_rng(0)
+    noise = rng.integers(0, 256, (args.frames, 210, 160, 3), dtype=np.uint8)
+    smooth = np.stack([cv2.GaussianBlur(frame, (15, 15), 0) for frame in noise])
+    frames = np.concatenate((noise, smooth))
+
+    diff = np.stack([_process_frame84(frame).astype(np.int16) - reference_frame84(frame) for frame in frames])
+    print("max abs difference %d (tolerance %d), mean difference %.3f"
+          % (np.abs(diff).max(), FRAME84_TOLERANCE, diff.mean()))
+    assert np.abs(diff).max() <= FRAME84_TOLERANCE
+    assert (process_frames84(frames) == np.stack([_process_frame84(frame) for frame in frames])).all()
+
+    gray, resized = np.empty((210, 160), dtype=np.uint8), np.empty((110, 84), dtype=np.uint8)
+    out = np.empty((len(frames), 84, 84, 1), dtype=np.uint8)
+    obs_buffer, max_frame = np.empty((2, 210, 160, 3), dtype=np.uint8), np.empty((210, 160, 3), dtype=np.uint8)
+
+    def max_stack(frames):
+        for i in range(1, len(frames)):
+            np.max(np.stack([frames[i - 1], frames[i]]), axis=0)
+
+    def max_inplace(frames):
+        for i in range(1, len(frames)):
+            obs_buffer[i % 2] = frames[i]
+            np.maximum(obs_buffer[0], obs_buffer[1], out=max_frame)
+
+    print("%-24s %12s" % ("", "frames/sec"))
+    for name, f in (("float32 frame84", lambda x: [reference_frame84(frame) for frame in x]),
+                    ("uint8 frame84", lambda x: [_process_frame84(frame, gray, resized) for frame in x]),
+                    ("uint8 frame84 batched", lambda x: process_frames84(x, out)),
+                    ("max pool np.stack", max_stack),
+                    ("max pool in place", max_inplace)):
+        print("%-24s %12.0f" % (name, frames_per_sec(f, frames, args.repeats)))
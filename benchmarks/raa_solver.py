@@ -0,0 +1,69 @@
+import argparse
+import time
+import torch
+
+from src.anderson_solver import raa_alpha, raa_newreg_alpha
+
+
+def legacy_alpha(delta_Qs, reg):
+    """The explicit inverse `RAA.calculate` used before src.anderson_solver."""
+    del_mat = delta_Qs.t().mm(delta_Qs)
+    alpha = del_mat / torch.abs(torch.mean(del_mat))
+    alpha += reg * torch.eye(delta_Qs.size(1), dtype=delta_Qs.dtype)
+    alpha = torch.sum(alpha.inverse(), 1)
+    return torch.unsqueeze(alpha / torch.sum(alpha), 1)
+
+
+def legacy_newreg_alpha(delta_Qs, F_Qs, reg):
+    """The explicit inverse `RAA.calculate_newReg` used before src.anderson_solver."""
+    cur_size = delta_Qs.size(1)
+    Y = delta_Qs[:, 1:] - delta_Qs[:, :cur_size - 1]
+    S = F_Qs[:, 1:] - F_Qs[:, :cur_size - 1]
+    temp = Y.t().mm(Y)
+    temp = temp / torch.abs(torch.mean(temp))
+    temp += reg * (torch.norm(S, p='fro') ** 2 + torch.norm(Y, p='fro') ** 2) * torch.eye(cur_size - 1, dtype=Y.dtype)
+    gamma = temp.inverse().mm(Y.t().mm(delta_Qs[:, -1:]))
+    return torch.cat((gamma[:1], gamma[1:] - gamma[:-1], 1 - gamma[-1:]), 0)
+
+
+def make_inputs(n, m, spread, seed):
+    """F(Q) and Q of m targets whose residuals differ by `spread`, small
+    spreads giving the ill-conditioned systems of nearly converged targets."""
+    g = torch.Generator().manual_seed(seed)
+    Qs = torch.randn(n, m, generator=g, dtype=torch.float64)
+    delta_Qs = torch.randn(n, 1, generator=g, dtype=torch.float64) + spread * torch.randn(n, m, generator=g, dtype=torch.float64)
+    return (Qs + delta_Qs).float(), Qs.float()
+
+
+def timeit(f, iters):
+    f()
+    start = time.perf_counter()
+    for _ in range(iters):
+        f()
+    return (time.perf_counter() - start) / iters
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='RAA weights: explicit inverse vs Cholesky solver')
+    parser.add_argument("--sample_size", type=int, default=128)
+    parser.add_argument("--reg", type=float, default=0.1)
+    parser.add_argument("--iters", type=int, default=1000)
+    args = parser.parse_args()
+
+    print("%-7s %2s %8s %12s %12s %10s %10s" % ("method", "m", "spread", "legacy err", "new err", "legacy us", "new us"))
+    for m in range(2, 6):
+        for spread in (1.0, 1e-2, 1e-4):
+            F_Qs, Qs = make_inputs(args.sample_size, m, spread, seed=m)
+            delta_Qs = F_Qs - Qs
+            cases = [('calc', lambda x, f: legacy_alpha(x, args.reg), lambda x, f: raa_alpha(x, args.reg)),
+                     ('newReg', lambda x, f: legacy_newreg_alpha(x, f, args.reg),
+                      lambda x, f: raa_newreg_alpha(x, f, args.reg))]
+            for name, legacy, new in cases:
+                # float64 inputs through the legacy formula as the reference
+                reference = legacy(delta_Qs.double(), F_Qs.double())
+                legacy_err = (legacy(delta_Qs, F_Qs).double() - reference).abs().max().item()
+                new_err = (new(delta_Qs, F_Qs).double() - reference).abs().max().item()
+                legacy_time = timeit(lambda: legacy(delta_Qs, F_Qs), args.iters)
+                new_time = timeit(lambda: new(delta_Qs, F_Qs), args.iters)
+                print("%-7s %2d %8.0e %12.2e %12.2e %10.1f %10.1f" % (name, m, spread, legacy_err, new_err,
+                                                                     1e6 * legacy_time, 1e6 * new_time))
@@ -0,0 +1,57 @@
+import argparse
+import torch
+
+from src.anderson_alpha import RAA
+
+
+def busy(size, repeats):
+    """Queue enough device work that a call syncing with the device has to
+    wait for it, and return an event recorded after it."""
+    x = torch.randn(size, size, device='cuda')
+    for _ in range(repeats):
+        x = x.mm(x).tanh_()
+    done = torch.cuda.Event()
+    done.record()
+    return done
+
+
+def count_syncs(anderson, method, Qs, F_Qs, updates, size, repeats):
+    """Number of calls that returned only after the device work queued
+    before them had finished, i.e. that synchronized at least once."""
+    num_synced = 0
+    for _ in range(updates):
+        done = busy(size, repeats)
+        getattr(anderson, method)(Qs, F_Qs)
+        num_synced += done.query()
+    torch.cuda.synchronize()
+    return num_synced
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Host syncs per RAA update, default vs sync free')
+    parser.add_argument("--updates", type=int, default=200)
+    parser.add_argument("--num", type=int, default=5, help="number of targets")
+    parser.add_argument("--sample_size", type=int, default=128)
+    parser.add_argument("--interval", type=int, default=50, help="restart interval, shortened so checks happen")
+    parser.add_argument("--busy_size", type=int, default=2048)
+    parser.add_argument("--busy_repeats", type=int, default=20)
+    args = parser.parse_args()
+    assert torch.cuda.is_available(), "syncs only exist with a CUDA device"
+
+    # the probe is only meaningful if queued work outlasts a call that does not sync
+    done = busy(args.busy_size, args.busy_repeats)
+    assert not done.query(), "busy work finished too early, increase --busy_repeats"
+    torch.cuda.synchronize()
+
+    Qs = torch.randn(args.num, 2 * args.sample_size, device='cuda')
+    F_Qs = Qs + 0.1 * torch.randn(args.num, 2 * args.sample_size, device='cuda')
+    print("fraction of updates that synchronized with the device")
+    print("%-17s %10s %10s" % ("method", "default", "sync free"))
+    for method in ('calculate', 'calculate_newReg'):
+        counts = []
+        for sync_free in (False, True):
+            anderson = RAA(args.num, True, sync_free=sync_free)
+            anderson.interval = args.interval
+            anderson.errors = torch.zeros(args.interval, device='cuda')
+            counts.append(count_syncs(anderson, method, Qs, F_Qs, args.updates, args.busy_size, args.busy_repeats))
+        print("%-17s %10.3f %10.3f" % (method, counts[0] / args.updates, counts[1] / args.updates))
@@ -0,0 +1,73 @@
+import argparse
+import time
+import numpy as np
+
+from utils.replay_buffer import ReplayBuffer
+from utils.storage import CompressedStorage, MemoryStorage
+
+
+def atari_like_frames(num_frames, seed=0):
+    """Yield 84x84x1 uint8 frames with a static playfield, a moving paddle and
+    ball, and some per-frame noise in the score line, which compress roughly
+    like preprocessed Atari screens."""
+    rng = np.random.RandomState(seed)
+    background = np.zeros((84, 84), dtype=np.uint8)
+    background[10:30:4, 4:80] = rng.randint(60, 200, size=(5, 1))
+    background[:, :3] = background[:, -3:] = 142
+    x, y, dx, dy = 40., 50., 1.3, -1.7
+    for t in range(num_frames):
+        frame = background.copy()
+        x, y = x + dx, y + dy
+        if not 4 < x < 78:
+            dx = -dx
+        if not 32 < y < 76:
+            dy = -dy
+        frame[int(y):int(y) + 2, int(x):int(x) + 2] = 200
+        paddle = int(40 + 30 * np.sin(t / 20.))
+        frame[78:80, max(paddle - 8, 3):paddle + 8] = 180
+        frame[2:8, 30:54] = rng.randint(0, 2, size=(6, 24)) * 120
+        yield frame[:, :, None]
+
+
+def run(storage, args):
+    replay_buffer = ReplayBuffer(args.size, 4, storage=storage)
+    rng = np.random.RandomState(0)
+    start = time.perf_counter()
+    for frame in atari_like_frames(args.fill):
+        idx = replay_buffer.store_frame(frame)
+        replay_buffer.store_effect(idx, rng.randint(4), 0., rng.rand() < 0.005)
+    store_rate = args.fill / (time.perf_counter() - start)
+
+    start = time.perf_counter()
+    for _ in range(args.iters):
+        replay_buffer.sample(args.batch_size)
+    sample_rate = args.iters * args.batch_size / (time.perf_counter() - start)
+    return replay_buffer.obs.nbytes / float(min(args.fill, args.size)), store_rate, sample_rate
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Replay frame storage: memory vs throughput')
+    parser.add_argument("--size", type=int, default=50000)
+    parser.add_argument("--fill", type=int, default=60000)
+    parser.add_argument("--batch_size", type=int, default=128)
+    parser.add_argument("--iters", type=int, default=50)
+    parser.add_argument("--codecs", default="zlib,lz4", help="comma separated codecs to try")
+    parser.add_argument("--chunk_sizes", default="4,8,16")
+    args = parser.parse_args()
+
+    settings = [('raw', MemoryStorage)]
+    for codec in args.codecs.split(','):
+        for chunk_size in [int(c) for c in args.chunk_sizes.split(',')]:
+            for delta in (False, True):
+                name = '%s%s/%d' % (codec, '_delta' if delta else '', chunk_size)
+                settings.append((name, lambda c=codec, k=chunk_size, d=delta: CompressedStorage(c, k, d)))
+
+    print("%-16s %12s %14s %16s" % ("storage", "bytes/frame", "frames/sec", "samples/sec"))
+    for name, make in settings:
+        try:
+            storage = make()
+            bytes_per_frame, store_rate, sample_rate = run(storage, args)
+        except ImportError as e:
+            print("%-16s skipped (%s)" % (name, e))
+            continue
+        print("%-16s %12.0f %14.0f %16.0f" % (name, bytes_per_frame, store_rate, sample_rate))
@@ -0,0 +1,94 @@
+import argparse
+import tempfile
+import time
+import numpy as np
+import random
+import torch
+
+from utils.replay_buffer import ReplayBuffer
+from utils.samplers import PrioritizedSampler
+
+
+def sample_n_unique(sampling_f, n):
+    """Helper function. Given a function `sampling_f` that returns
+    comparable objects, sample n such unique objects. The index sampling
+    `ReplayBuffer.sample` used before UniformSampler.
+    """
+    res = []
+    while len(res) < n:
+        candidate = sampling_f()
+        if candidate not in res:
+            res.append(candidate)
+    return res
+
+
+def fill_buffer(replay_buffer, num_frames, done_prob=0.01, seed=0):
+    rng = np.random.RandomState(seed)
+    for _ in range(num_frames):
+        frame = rng.randint(0, 256, size=(84, 84, 1), dtype=np.uint8)
+        idx = replay_buffer.store_frame(frame)
+        replay_buffer.store_effect(idx, rng.randint(4), rng.randn(), rng.rand() < done_prob)
+    return replay_buffer
+
+
+def legacy_encode_sample(replay_buffer, idxes):
+    """The per-index path `ReplayBuffer._encode_sample` used before batching."""
+    obs_batch      = torch.cat([replay_buffer._encode_observation(idx)[None] for idx in idxes], 0)
+    act_batch      = replay_buffer.action[idxes]
+    rew_batch      = replay_buffer.reward[idxes]
+    next_obs_batch = torch.cat([replay_buffer._encode_observation(idx + 1)[None] for idx in idxes], 0)
+    done_mask      = torch.FloatTensor([1.0 if replay_buffer.done[idx] else 0.0 for idx in idxes])
+    return obs_batch, act_batch, rew_batch, next_obs_batch, done_mask
+
+
+def check_equal(replay_buffer, batch_size, trials=20):
+    for _ in range(trials):
+        idxes = sample_n_unique(lambda: random.randint(0, replay_buffer.num_in_buffer - 2), batch_size)
+        for old, new in zip(legacy_encode_sample(replay_buffer, idxes), replay_buffer._encode_sample(idxes)):
+            old = old.cpu().float() if torch.is_tensor(old) else torch.as_tensor(old)
+            new = new.cpu().float() if torch.is_tensor(new) else torch.as_tensor(new)
+            assert torch.equal(old, new)
+
+
+def check_prioritized_load(size, num_frames, frame_history_len=4):
+    """Assert that a PrioritizedSampler restored by `load` can draw every
+    valid transition: with the priorities all equal, sampling as many
+    transitions as are valid draws each of them exactly once."""
+    replay_buffer = fill_buffer(ReplayBuffer(size, frame_history_len), num_frames)
+    with tempfile.TemporaryDirectory() as path:
+        replay_buffer.save(path)
+        restored = ReplayBuffer(size, frame_history_len, sampler=PrioritizedSampler())
+        restored.load(path)
+    uniform = replay_buffer.sampler
+    valid = (uniform.valid_start + np.arange(uniform.num_valid)) % size
+    assert restored.sampler.num_valid == uniform.num_valid
+    assert (np.sort(restored.sampler.sample(uniform.num_valid)) == np.sort(valid)).all()
+
+
+def samples_per_sec(encode, replay_buffer, batch_size, iters):
+    idx_batches = [sample_n_unique(lambda: random.randint(0, replay_buffer.num_in_buffer - 2), batch_size)
+                   for _ in range(iters)]
+    start = time.perf_counter()
+    for idxes in idx_batches:
+        encode(idxes)
+    return iters * batch_size / (time.perf_counter() - start)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='ReplayBuffer sample throughput')
+    parser.add_argument("--size", type=int, default=100000, help="buffer size")
+    parser.add_argument("--fill", type=int, default=120000, help="frames stored before sampling (> size wraps)")
+    parser.add_argument("--batch_size", type=int, default=128)
+    parser.add_argument("--iters", type=int, default=200)
+    args = parser.parse_args()
+
+    random.seed(0)
+    replay_buffer = fill_buffer(ReplayBuffer(args.size, 4), args.fill)
+    check_equal(replay_buffer, args.batch_size)
+    for num_frames in (args.size // 2, args.fill):
+        check_prioritized_load(args.size, num_frames)
+
+    legacy = samples_per_sec(lambda i: legacy_encode_sample(replay_buffer, i), replay_buffer, args.batch_size, args.iters)
+    batched = samples_per_sec(replay_buffer._encode_sample, replay_buffer, args.batch_size, args.iters)
+    print("legacy  %10.0f samples/sec" % legacy)
+    print("batched %10.0f samples/sec (x%.1f)" % (batched, batched / legacy))
@@ -0,0 +1,243 @@
+import argparse
+import contextlib
+import json
+import os
+import platform
+import sys
+import tempfile
+import time
+from collections import namedtuple
+
+import numpy as np
+import torch
+import torch.optim as optim
+
+from src import dqn, raa_dqn
+from src.anderson_alpha import RAA
+from src.model import Dueling_DQN
+from utils.gym_setup import get_env, get_monitor_stats, set_global_seeds
+from utils.replay_buffer import ReplayBuffer
+from utils.schedules import LinearSchedule
+from benchmarks.replay_sample import fill_buffer
+
+device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+
+# every result is a rate, so a drop below (1 - threshold) times the baseline
+# is a regression
+GROUPS = ('replay', 'model', 'raa', 'wrappers', 'end_to_end')
+
+
+def rate(f, min_time, repeats, work=1):
+    """Best of `repeats` measurements of `work` units per second of calling
+    f, each calling it for at least `min_time` seconds after a warm up."""
+    f()
+    best = 0.
+    for _ in range(repeats):
+        if device.type == 'cuda':
+            torch.cuda.synchronize()
+        calls, start = 0, time.perf_counter()
+        while True:
+            f()
+            calls += 1
+            if device.type == 'cuda' and calls % 10 == 0:
+                torch.cuda.synchronize()
+            elapsed = time.perf_counter() - start
+            if elapsed >= min_time:
+                break
+        if device.type == 'cuda':
+            torch.cuda.synchronize()
+            elapsed = time.perf_counter() - start
+        best = max(best, calls * work / elapsed)
+    return best
+
+
+def bench_replay(args):
+    """store_frame/store_effect, sample and encode_recent_observation of a
+    buffer filled to `replay_fill` frames (more than its size wraps)."""
+    replay_buffer = fill_buffer(ReplayBuffer(args.replay_size, 4), args.replay_fill)
+    frame = np.random.RandomState(1).randint(0, 256, size=(84, 84, 1), dtype=np.uint8)
+
+    def store():
+        idx = replay_buffer.store_frame(frame)
+        replay_buffer.store_effect(idx, 0, 0.0, False)
+
+    results = {'replay/store_frame': (rate(store, args.min_time, args.repeats), 'frames/s'),
+               'replay/encode_recent_observation': (rate(replay_buffer.encode_recent_observation,
+                                                         args.min_time, args.repeats), 'calls/s')}
+    for batch_size in (32, 128):
+        results['replay/sample_%d' % batch_size] = (
+            rate(lambda: replay_buffer.sample(batch_size), args.min_time, args.repeats, batch_size), 'samples/s')
+    replay_buffer.close()
+    return results
+
+
+def bench_model(args):
+    """Dueling_DQN forward and forward + backward at batch 1, 32 and 256."""
+    Q = Dueling_DQN(4, args.num_actions).to(device)
+    results = {}
+    for batch_size in (1, 32, 256):
+        x = torch.randint(0, 256, (batch_size, 4, 84, 84), dtype=torch.uint8, device=device)
+
+        def forward():
+            with torch.no_grad():
+                Q(x)
+
+        def backward():
+            Q.zero_grad()
+            Q(x).max(1)[0].sum().backward()
+
+        results['model/forward_%d' % batch_size] = (
+            rate(forward, args.min_time, args.repeats, batch_size), 'samples/s')
+        results['model/forward_backward_%d' % batch_size] = (
+            rate(backward, args.min_time, args.repeats, batch_size), 'samples/s')
+    return results
+
+
+def bench_raa(args):
+    """RAA.calculate and calculate_newReg for 2 to 5 targets, restarts off
+    so every call does the same work."""
+    results = {}
+    for num in range(2, 6):
+        Qs = torch.randn(num, args.sample_size, device=device)
+        F_Qs = Qs + 0.1 * torch.randn(num, args.sample_size, device=device)
+        anderson = RAA(5, False, 0.1)
+        for method in ('calculate', 'calculate_newReg'):
+            f = getattr(anderson, method)
+            results['raa/%s_%d' % (method, num)] = (rate(lambda: f(Qs, F_Qs), args.min_time, args.repeats), 'calls/s')
+    return results
+
+
+def bench_wrappers(args):
+    """Steps of the synthetic env through Monitor and the wrap_deepmind
+    stack, with random actions."""
+    with tempfile.TemporaryDirectory() as save_path:
+        env = get_env(args.env_name, 0, save_path)
+        env.reset()
+        actions = np.random.RandomState(0).randint(env.action_space.n, size=1000)
+        steps = [0]
+
+        def step():
+            _, _, done, _ = env.step(actions[steps[0] % len(actions)])
+            steps[0] += 1
+            if done:
+                env.reset()
+
+        result = rate(step, args.min_time, args.repeats)
+        env.close()
+    return {'wrappers/wrap_deepmind_step': (result, 'steps/s')}
+
+
+def run_learner(learner, args, **kwargs):
+    """Env frames and parameter updates per second of a short run of a
+    learner on the synthetic env, its log silenced. Updates are counted by
+    the optimizer's step; the learners check max_steps every 10000 wrapped
+    steps, so a run is at least 40000 frames."""
+    num_updates = [0]
+
+    def counting_rmsprop(params, **kwargs):
+        optimizer = optim.RMSprop(params, **kwargs)
+        step = optimizer.step
+
+        def counted_step(*a, **k):
+            num_updates[0] += 1
+            return step(*a, **k)
+        optimizer.step = counted_step
+        return optimizer
+
+    OptimizerSpec = namedtuple("OptimizerSpec", ["constructor", "kwargs"])
+    optimizer = OptimizerSpec(constructor=counting_rmsprop, kwargs=dict(lr=0.00025, alpha=0.95, eps=0.01))
+    with tempfile.TemporaryDirectory() as save_path:
+        env = get_env(args.env_name, 0, save_path)
+        set_global_seeds(0)
+        start = time.perf_counter()
+        with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+            learner.dqn_learning(env=env, q_func=Dueling_DQN, optimizer_spec=optimizer,
+                                 exploration=LinearSchedule(args.e2e_frames // 4, 0.1),
+                                 max_steps=args.e2e_frames, replay_buffer_size=args.replay_size,
+                                 learning_starts=args.e2e_learning_starts, save_path=save_path, **kwargs)
+        elapsed = time.perf_counter() - start
+        frames = get_monitor_stats(env)[0]
+        env.close()
+    return frames / elapsed, num_updates[0] / elapsed
+
+
+def bench_end_to_end(args):
+    """Whole training runs of dqn and raa_dqn (max operator, vanilla AA)."""
+    results = {}
+    for name, learner, kwargs in (('dqn', dqn, {}),
+                                  ('raa_dqn', raa_dqn, dict(omega=5.0, target_update_freq=2000))):
+        frames, updates = run_learner(learner, args, **kwargs)
+        results['end_to_end/%s_frames' % name] = (frames, 'frames/s')
+        results['end_to_end/%s_updates' % name] = (updates, 'updates/s')
+    return results
+
+
+def compare(results, baseline, threshold):
+    """Print every result against the baseline and return the names of
+    those slower by more than `threshold`."""
+    regressions = []
+    print("%-40s %14s %14s %8s" % ("benchmark", "baseline", "current", "ratio"))
+    for name in sorted(results):
+        value = results[name]['value']
+        if name not in baseline:
+            print("%-40s %14s %14.1f %8s" % (name, "-", value, "new"))
+            continue
+        ratio = value / baseline[name]['value'] if baseline[name]['value'] > 0 else float('inf')
+        flag = ""
+        if ratio < 1 - threshold:
+            regressions.append(name)
+            flag = "  REGRESSION"
+        print("%-40s %14.1f %14.1f %8.2f%s" % (name, baseline[name]['value'], value, ratio, flag))
+    return regressions
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmarks of the training hot paths, as JSON')
+    parser.add_argument("--groups", default=",".join(GROUPS), help="comma separated subset of " + ", ".join(GROUPS))
+    parser.add_argument("--out", default="", help="file to write the results to, stdout if empty")
+    parser.add_argument("--baseline", default="", help="saved results to compare against, flagging regressions")
+    parser.add_argument("--results", default="", help="compare these saved results instead of running")
+    parser.add_argument("--threshold", type=float, default=0.1, help="slowdown counted as a regression, 0.1: 10%%")
+    parser.add_argument("--min_time", type=float, default=1.0, help="seconds per measurement")
+    parser.add_argument("--repeats", type=int, default=3, help="measurements per benchmark, the best is kept")
+    parser.add_argument("--replay_size", type=int, default=100000)
+    parser.add_argument("--replay_fill", type=int, default=120000, help="frames stored before measuring (> replay_size wraps)")
+    parser.add_argument("--sample_size", type=int, default=128)
+    parser.add_argument("--num_actions", type=int, default=4)
+    parser.add_argument("--env_name", default="Synthetic2000NoFrameskip-v4")
+    parser.add_argument("--e2e_frames", type=int, default=40000, help="env frames of each end to end run, rounded up to 40000")
+    parser.add_argument("--e2e_learning_starts", type=int, default=1000)
+    args = parser.parse_args()
+
+    if args.results:
+        with open(args.results) as f:
+            report = json.load(f)
+    else:
+        torch.manual_seed(0)
+        np.random.seed(0)
+        results = {}
+        for group in args.groups.split(','):
+            assert group in GROUPS, "unknown group %s" % group
+            print("running %s" % group, file=sys.stderr)
+            for name, (value, unit) in globals()['bench_' + group](args).items():
+                results[name] = dict(value=value, unit=unit)
+        report = dict(meta=dict(time=time.strftime('%Y-%m-%dT%H:%M:%S'), python=platform.python_version(),
+                                torch=torch.__version__, device=str(device), machine=platform.machine(),
+                                processor=platform.processor(), num_threads=torch.get_num_threads(),
+                                args=vars(args)),
+                      results=results)
+        text = json.dumps(report, indent=2, sort_keys=True)
+        if args.out:
+            with open(args.out, 'w') as f:
+                f.write(text + '\n')
+        else:
+            print(text)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        regressions = compare(report['results'], baseline['results'], args.threshold)
+        if regressions:
+            print("%d regressions beyond %.0f%%: %s" % (len(regressions), 100 * args.threshold,
+                                                      ", ".join(regressions)))
+            sys.exit(1)
@@ -0,0 +1,68 @@
+import argparse
+import time
+import torch
+
+from src.model import Dueling_DQN, TargetHistory
+
+
+def timeit(f, iters):
+    f()
+    start = time.perf_counter()
+    for _ in range(iters):
+        f()
+    return (time.perf_counter() - start) / iters
+
+
+def evaluate_loop(Q_targets, x, num):
+    """Q_targets[-num:](x), oldest first, one network after the other."""
+    with torch.no_grad():
+        return torch.stack([Q_targets[-i](x) for i in range(num, 0, -1)])
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Target phase of the AA update: per-target loop vs TargetHistory')
+    parser.add_argument("--sample_size", type=int, default=128)
+    parser.add_argument("--num_actions", type=int, default=4)
+    parser.add_argument("--iters", type=int, default=10)
+    parser.add_argument("--threads", type=int, default=0, help="torch threads, 0: torch default")
+    args = parser.parse_args()
+    if args.threads > 0:
+        torch.set_num_threads(args.threads)
+
+    torch.manual_seed(0)
+    Q_targets = [Dueling_DQN(4, args.num_actions) for _ in range(5)]
+    stacked = TargetHistory(Q_targets[0], 5)
+    for q_target in Q_targets:
+        stacked.push(q_target)
+    cat_obs = torch.randint(0, 256, (2 * args.sample_size, 4, 84, 84), dtype=torch.uint8)
+
+    print("%4s %12s %12s %8s %12s" % ("num", "loop ms", "stacked ms", "speedup", "max abs err"))
+    for num in range(1, 6):
+        err = (evaluate_loop(Q_targets, cat_obs, num) - stacked(cat_obs, num)).abs().max().item()
+        loop_time = timeit(lambda: evaluate_loop(Q_targets, cat_obs, num), args.iters)
+        stacked_time = timeit(lambda: stacked(cat_obs, num), args.iters)
+        print("%4d %12.1f %12.1f %8.2f %12.2e" % (num, 1e3 * loop_time, 1e3 * stacked_time,
+                                                   loop_time / stacked_time, err))
+
+    # rotation: load_state_dict into the oldest module and move it to the end
+    # of the list, as the learner did, vs one row copy; both see the same
+    # sequence of networks, so the history stays equal to the list
+    incoming = [Dueling_DQN(4, args.num_actions) for _ in range(3)]
+    rotations = [0, 0]
+
+    def rotate_modules():
+        Q_targets[0].load_state_dict(incoming[rotations[0] % 3].state_dict())
+        Q_targets.append(Q_targets.pop(0))
+        rotations[0] += 1
+
+    def push():
+        stacked.push(incoming[rotations[1] % 3])
+        rotations[1] += 1
+
+    rotate_time = timeit(rotate_modules, args.iters)
+    push_time = timeit(push, args.iters)
+    print("rotation: modules %.3f ms, row copy %.3f ms" % (1e3 * rotate_time, 1e3 * push_time))
+    # unless iters + 1 is a multiple of 5 the newest rows now wrap around
+    for num in range(1, 6):
+        err = (evaluate_loop(Q_targets, cat_obs, num) - stacked(cat_obs, num)).abs().max().item()
+        print("after rotation, num %d: max abs err %.2e" % (num, err))
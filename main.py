@@ -5,10 +5,13 @@ import argparse
 from collections import namedtuple
 
 from src.model import Dueling_DQN
-from src import dqn, raa_dqn
+from src import dqn, raa_dqn, population_dqn
 from utils.atari_wrappers import *
 from utils.gym_setup import *
 from utils.schedules import *
+from utils.vec_env import make_vec_env
+from utils.async_actors import make_async_actors
+from utils.precision import PRECISIONS, bf16_stages
 
 # Global Variables
 # Extended data table 1 of nature paper
@@ -24,15 +27,104 @@ EPS = 0.01
 EXPLORATION_SCHEDULE = LinearSchedule(1000000, 0.1)
 LEARNING_STARTS = 50000
 
+def member_values(values, default, size):
+    """Per member values of a comma separated --population_* option, the
+    single run's value for all members if empty."""
+    if not values:
+        return [default] * size
+    values = [float(value) for value in values.split(',')]
+    assert len(values) == size, "need one value per member, got %d for %d" % (len(values), size)
+    return values
+
+
+def population_learn(args, optimizer):
+    # population_dqn has none of these modes, reject them rather than
+    # silently running a different experiment
+    assert not args.prioritized, "population training does not support --prioritized"
+    assert args.prefetch == 0, "population training does not support --prefetch"
+    assert args.num_envs == 1, "population training does not support --num_envs"
+    assert args.num_actors == 0, "population training does not support --num_actors"
+    assert args.replay_ratio is None, "population training does not support --replay_ratio"
+    assert args.target_cache == 0, "population training does not support --target_cache"
+    assert not args.raa_sync_free, "population training does not support --raa_sync_free"
+    assert not args.compile_step, "population training does not support --compile_step"
+
+    K = args.population
+    seeds = [args.seed + k for k in range(K)]
+    omegas = member_values(args.population_omegas, args.omega, K)
+    betas = member_values(args.population_betas, args.beta, K)
+    reg_scales = member_values(args.population_reg_scales, args.reg_scale, K)
+
+    envs, rngs, save_paths = [], [], []
+    for k in range(K):
+        save_path = "logs/{}/{}-omega-{}-AA-{}-Soft-{}-Reg-{}/seed-{}".format(args.env_name, args.agent_name, omegas[k], args.AA, args.soft, reg_scales[k], seeds[k])
+        if args.save_suffix:
+            save_path += '-' + args.save_suffix
+        if not os.path.exists(save_path):
+            os.makedirs(save_path)
+        envs.append(get_env(args.env_name, seeds[k], save_path))
+        # the global RNGs as a run of this seed alone would find them
+        rngs.append(GlobalRNG())
+        save_paths.append(save_path)
+    assert len(set(save_paths)) == K, "members with equal seed, omega and reg_scale would share a log directory"
+
+    population_dqn.dqn_learning(
+        envs=envs,
+        rngs=rngs,
+        omega=omegas,
+        q_func=Dueling_DQN,
+        optimizer_spec=optimizer,
+        exploration=EXPLORATION_SCHEDULE,
+        max_steps=args.max_steps,
+        replay_buffer_size=REPLAY_BUFFER_SIZE,
+        batch_size=BATCH_SIZE,
+        sample_size=SAMPLE_SIZE,
+        gamma=GAMMA,
+        beta=betas,
+        reg_scale=reg_scales,
+        use_restart=args.use_restart,
+        learning_starts=LEARNING_STARTS,
+        learning_freq=LEARNING_FREQ,
+        frame_history_len=FRAME_HISTORY_LEN,
+        target_update_freq=args.target_update_freq,
+        save_paths=save_paths,
+        AA=args.AA,
+        soft=args.soft,
+        replay_storage=args.replay_storage,
+        precision=args.precision
+    )
+    for env in envs:
+        env.close()
+
+
 def atari_learn(args):
     OptimizerSpec = namedtuple("OptimizerSpec", ["constructor", "kwargs"])
     optimizer = OptimizerSpec(constructor=optim.RMSprop, kwargs=dict(lr=LEARNING_RATE, alpha=ALPHA, eps=EPS))
 
+    if args.population > 0:
+        assert args.agent_name == 'DuelingDQN_RAA', "population training runs the RAA learner"
+        return population_learn(args, optimizer)
+
     save_path = "logs/{}/{}-omega-{}-AA-{}-Soft-{}-Reg-{}/seed-{}".format(args.env_name, args.agent_name, args.omega, args.AA, args.soft, args.reg_scale, args.seed)
+    if args.save_suffix:
+        save_path += '-' + args.save_suffix
     if not os.path.exists(save_path):
         os.makedirs(save_path)
 
-    env = get_env(args.env_name, args.seed, save_path)
+    if args.num_actors > 0:
+        set_global_seeds(args.seed)
+        env = make_async_actors(args.env_name, args.seed, save_path, args.num_actors,
+                                q_func=Dueling_DQN,
+                                replay_buffer_size=REPLAY_BUFFER_SIZE // args.num_actors,
+                                frame_history_len=FRAME_HISTORY_LEN,
+                                exploration=EXPLORATION_SCHEDULE,
+                                learning_starts=LEARNING_STARTS,
+                                bf16_acting='acting' in bf16_stages(args.precision))
+    elif args.num_envs > 1:
+        set_global_seeds(args.seed)
+        env = make_vec_env(args.env_name, args.seed, save_path, args.num_envs)
+    else:
+        env = get_env(args.env_name, args.seed, save_path)
 
     if args.agent_name == 'DuelingDQN_RAA':
         raa_dqn.dqn_learning(
@@ -55,7 +147,17 @@ def atari_learn(args):
             target_update_freq=args.target_update_freq,
             save_path=save_path,
             AA=args.AA,
-            soft=args.soft
+            soft=args.soft,
+            prefetch=args.prefetch,
+            replay_storage=args.replay_storage,
+            prioritized=args.prioritized,
+            num_envs=args.num_envs,
+            num_actors=args.num_actors,
+            replay_ratio=args.replay_ratio,
+            target_cache=args.target_cache,
+            raa_sync_free=args.raa_sync_free,
+            precision=args.precision,
+            compile_step=args.compile_step
         )
     else:
         dqn.dqn_learning(
@@ -71,14 +173,23 @@ def atari_learn(args):
             learning_freq=LEARNING_FREQ,
             frame_history_len=FRAME_HISTORY_LEN,
             target_update_freq=args.target_update_freq,
-            save_path=save_path
+            save_path=save_path,
+            prefetch=args.prefetch,
+            replay_storage=args.replay_storage,
+            prioritized=args.prioritized,
+            num_envs=args.num_envs,
+            num_actors=args.num_actors,
+            replay_ratio=args.replay_ratio,
+            precision=args.precision,
+            soft=args.soft,
+            omega=args.omega
         )
     env.close()
 
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description='RL agents for atari')
-    parser.add_argument("--env_name", default="BreakoutNoFrameskip-v4")
+    parser.add_argument("--env_name", default="BreakoutNoFrameskip-v4", help="an Atari NoFrameskip env, or Synthetic[<episode_len>]NoFrameskip-v4 (utils.synthetic_env)")
     parser.add_argument("--agent_name", default="DuelingDQN", help="DuelingDQN, DuelingDQN_RAA")
     parser.add_argument("--seed", type=int, default=123, help="seed for initialization")
     parser.add_argument("--gpu", type=int, default=0, help="ID of GPU to be used")
@@ -90,11 +201,29 @@ if __name__ == '__main__':
     parser.add_argument("--target_update_freq", type=int, default=10000, help="frequency to update target network")
     parser.add_argument("--AA", type=int, default=0, help="0: vanilla AA, 1: new regularization")
     parser.add_argument("--soft", type=int, default=0, help="0: no, 1: mellowmax, 2: softmax")
+    parser.add_argument("--prefetch", type=int, default=0, help="number of batches sampled ahead in a background thread, 0: off")
+    parser.add_argument("--replay_storage", default="memory", help="memory, memmap (files under the run's save path), zlib, lz4, zlib_delta, lz4_delta (compressed frames)")
+    parser.add_argument("--prioritized", action="store_true", help="Whether to use prioritized experience replay")
+    parser.add_argument("--num_envs", type=int, default=1, help="number of envs stepped in parallel subprocesses")
+    parser.add_argument("--num_actors", type=int, default=0, help="number of asynchronous actor processes, 0: act in the learner")
+    parser.add_argument("--replay_ratio", type=float, default=None, help="max updates per actor env step, default 1/learning_freq, <= 0: unthrottled")
+    parser.add_argument("--target_cache", type=float, default=0, help="MB for caching target network outputs per replay index (RAA only), 0: off")
+    parser.add_argument("--raa_sync_free", action="store_true", help="Whether to compute the anderson weights and restarts without host synchronization")
+    parser.add_argument("--precision", default="fp32", choices=sorted(PRECISIONS), help="fp32, bf16_targets, bf16_acting or bf16 (acting, targets and the online network)")
+    parser.add_argument("--compile_step", action="store_true", help="Whether to run the RAA update through torch.compile (torch >= 2.0, eager otherwise)")
+    parser.add_argument("--save_suffix", default="", help="appended to the run's log directory, e.g. the args it does not name (set by sweep.py)")
+    parser.add_argument("--num_threads", type=int, default=0, help="torch intra-op threads, 0: torch default (all cores)")
+    parser.add_argument("--population", type=int, default=0, help="number of RAA runs trained together in one process, seeds seed, seed + 1, ..., 0: off")
+    parser.add_argument("--population_omegas", default="", help="comma separated omega of each population member, default --omega")
+    parser.add_argument("--population_betas", default="", help="comma separated beta of each population member, default --beta")
+    parser.add_argument("--population_reg_scales", default="", help="comma separated reg_scale of each population member, default --reg_scale")
     args = parser.parse_args()
 
     # command
     if torch.cuda.is_available():
         torch.cuda.set_device(args.gpu)
+    if args.num_threads > 0:
+        torch.set_num_threads(args.num_threads)
 
     # Run training
     print("----------------------------------------------")
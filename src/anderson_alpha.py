@@ -1,11 +1,12 @@
 # -*- coding: utf-8 -*-
 
 import torch
+from src.anderson_solver import raa_alpha, raa_newreg_alpha
 device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
 
 
 class RAA(object):
-    def __init__(self, num_critics, use_restart, reg=0.1):
+    def __init__(self, num_critics, use_restart, reg=0.1, sync_free=False):
         self.size = num_critics
         self.reg = reg                 # regularization
         self.use_restart = use_restart
@@ -14,77 +15,47 @@ class RAA(object):
         self.errors = torch.zeros(self.interval).to(device)
         self.opt_error = torch.tensor(0.).to(device)
 
+        # sync free mode: solves never read back to the host, and the restart
+        # decision of an interval is copied to pinned memory without waiting
+        # and acted on by the first call after the copy finished
+        self.sync_free = sync_free
+        self.restart_flag = torch.zeros(1, dtype=torch.bool, pin_memory=torch.cuda.is_available())
+        self.restart_copied = None
+        self.num_restarts = 0
+        self.last_check = None         # (error, opt_error) of the last interval, on device
+
     def calculate(self, Qs, F_Qs):
         Qs = Qs.t()
         F_Qs = F_Qs.t()
         delta_Qs = F_Qs - Qs
-        cur_size = Qs.size(1)
-
-        del_mat = delta_Qs.t().mm(delta_Qs)
-        alpha = del_mat / torch.abs(torch.mean(del_mat))
-        alpha += self.reg * torch.eye(cur_size).to(device)
 
-        alpha = torch.sum(alpha.inverse(), 1)
-        alpha = torch.unsqueeze(alpha / torch.sum(alpha), 1)
+        # solves (del_mat / |mean(del_mat)| + reg * I) alpha = 1 by Cholesky
+        alpha = raa_alpha(delta_Qs, self.reg, self.sync_free)
 
-        # restart checking
-        self.count += 1
-        self.errors[self.count % self.interval] = torch.mean(torch.pow(delta_Qs[:, -1], 2)).detach()
-
-        if self.use_restart:
-            if self.count % self.interval == 0:
-                error = torch.mean(self.errors)
-                if self.count == self.interval:
-                    self.opt_error = error
-                else:
-                    self.opt_error = torch.min(self.opt_error, error)
-
-                if (self.count > self.interval and error > self.opt_error) or self.count > 100000:
-                    print(error, self.opt_error)
-                    restart = True
-                    self.count = 0
-                else:
-                    restart = False
-            else:
-                restart = False
-        else:
-            restart = False
-
-        return alpha, restart
+        return alpha, self.check_restart(delta_Qs)
 
     def calculate_newReg(self, Qs, F_Qs): # Qs/F_Qs: m * |S*A|
-        # (1) delta matrix: m by m
+        # (1) delta matrix: N by m
         Qs = Qs.t()
         F_Qs = F_Qs.t()
         delta_Qs = F_Qs - Qs  # compute delta matrix
-        cur_size = Qs.size(1) # m
-        # (2) regularization matrix
-        g = delta_Qs.detach()
-        Y = g[:,1:] - g[:,:cur_size-1] # (N, m-1)
-        S = F_Qs[:,1:] - F_Qs[:,:cur_size-1] # v^{k+1}=\sum alpha_i * F(v^k)
-        delta_k = delta_Qs[:,cur_size - 1] # N*1, current target
-        # (3) solve gamma
-        temp = Y.t().mm(Y)
-        temp = temp / torch.abs(torch.mean(temp))
-        temp += self.reg * (torch.norm(S, p='fro')**2 + torch.norm(Y, p='fro')**2) * torch.eye(cur_size-1).to(device)
-        gamma = temp.inverse().mm(Y.t().mm(torch.unsqueeze(delta_k,1)))
-        # (4) transform from gamma to alpha
-        m = gamma.shape[0]
-
-        gamma = gamma.squeeze()
-        if m == 1:
-            gamma = gamma.unsqueeze(0)
-
-        alpha = torch.zeros(m+1)
-        alpha[0] = gamma[0]
-        alpha[1:m] = gamma[1:m] - gamma[0:m-1]
-        alpha[m] = 1-gamma[m-1]
-        alpha = torch.unsqueeze(alpha, 1)
+        # (2) regularized least squares for gamma, (3) transform from gamma to alpha
+        alpha = raa_newreg_alpha(delta_Qs.detach(), F_Qs, self.reg, self.sync_free)
 
+        return alpha.to(device), self.check_restart(delta_Qs)
+
+    def check_restart(self, delta_Qs):
+        """Record the residual of the newest target and tell whether the
+        Anderson history should restart. Called by `calculate` and
+        `calculate_newReg`, and directly by callers that compute alpha
+        themselves (see src.learner_step)."""
         # restart checking
         self.count += 1
         self.errors[self.count % self.interval] = torch.mean(torch.pow(delta_Qs[:, -1], 2)).detach()
 
+        if self.sync_free:
+            return self._restart_sync_free()
+
         if self.use_restart:
             if self.count % self.interval == 0:
                 error = torch.mean(self.errors)
@@ -103,4 +74,42 @@ class RAA(object):
                 restart = False
         else:
             restart = False
-        return alpha.to(device), restart
\ No newline at end of file
+
+        return restart
+
+    def _restart_sync_free(self):
+        # same rule as above, decided on the device at the end of an interval
+        # and applied up to a few updates later, once the flag reached the host
+        if not self.use_restart:
+            return False
+
+        restart = False
+        if self.restart_copied is not None and (self.restart_copied is True or self.restart_copied.query()):
+            restart = bool(self.restart_flag[0])
+            self.restart_copied = None
+            if restart:
+                self.count = 0
+                self.num_restarts += 1
+
+        if self.count > 0 and self.count % self.interval == 0:
+            error = torch.mean(self.errors)
+            if self.count == self.interval:
+                self.opt_error = error
+            else:
+                self.opt_error = torch.min(self.opt_error, error)
+
+            if self.count > 100000:
+                flag = torch.ones((), dtype=torch.bool, device=device)
+            elif self.count > self.interval:
+                flag = error > self.opt_error
+            else:
+                flag = torch.zeros((), dtype=torch.bool, device=device)
+            self.last_check = (error, self.opt_error)
+            self.restart_flag.copy_(flag.view(1), non_blocking=True)
+            if device.type == 'cuda':
+                self.restart_copied = torch.cuda.Event()
+                self.restart_copied.record()
+            else:
+                self.restart_copied = True
+
+        return restart
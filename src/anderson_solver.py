@@ -0,0 +1,193 @@
+import torch
+
+# torch.linalg (torch >= 1.8) replaces torch.cholesky and torch.solve, which
+# later releases removed, so the old functions are only used on older torch
+if hasattr(torch, 'linalg') and hasattr(torch.linalg, 'cholesky'):
+    _cholesky = torch.linalg.cholesky
+else:
+    _cholesky = torch.cholesky
+
+if hasattr(torch, 'linalg') and hasattr(torch.linalg, 'solve'):
+    _solve = torch.linalg.solve
+else:
+    def _solve(A, b):
+        return torch.solve(b, A)[0]
+
+
+def solve_spd(A, b):
+    """Solve A x = b for a symmetric positive definite A, e.g. a regularized
+    Gram matrix, without forming the inverse.
+    A Cholesky solve is tried first. If A is not numerically positive
+    definite the factorization fails and an LU solve is used, and for a
+    singular A the least squares solution from the pseudo inverse.
+    """
+    try:
+        return torch.cholesky_solve(b, _cholesky(A))
+    except RuntimeError:
+        pass
+    try:
+        return _solve(A, b)
+    except RuntimeError:
+        return torch.pinverse(A).mm(b)
+
+
+def solve_spd_sync_free(A, b):
+    """solve_spd without synchronizing with the device. The Cholesky and LU
+    solves read their status back to the host, so here the Cholesky
+    factorization and both substitutions are unrolled over the (small)
+    dimension of A in plain tensor ops. If A is not numerically positive
+    definite the solution is not finite, and callers pick a fallback with
+    `torch.where` instead of catching an error.
+    """
+    m = A.size(0)
+    L = torch.zeros_like(A)
+    for j in range(m):
+        L[j, j] = torch.sqrt(A[j, j] - L[j, :j].dot(L[j, :j]))
+        L[j + 1:, j] = (A[j + 1:, j] - L[j + 1:, :j].mv(L[j, :j])) / L[j, j]
+    y = torch.zeros_like(b)
+    for i in range(m):
+        y[i] = (b[i] - L[i:i + 1, :i].mm(y[:i])[0]) / L[i, i]
+    x = torch.zeros_like(b)
+    for i in reversed(range(m)):
+        x[i] = (y[i] - L[i + 1:, i:i + 1].t().mm(x[i + 1:])[0]) / L[i, i]
+    return x
+
+
+def _newest_only(x, fallback):
+    # where the solve broke down, keep the weights of the plain target of
+    # the newest network, without reading anything back to the host
+    return torch.where(torch.isfinite(x).all(), x, fallback)
+
+
+def solve_spd_batched(A, b):
+    """solve_spd for a batch of systems A[i] x[i] = b[i], A of shape
+    (batch, m, m) and b (batch, m, k). One batched Cholesky solve; if any
+    system is not numerically positive definite, each is solved on its own
+    with the fallbacks of solve_spd."""
+    try:
+        return torch.cholesky_solve(b, _cholesky(A))
+    except RuntimeError:
+        return torch.stack([solve_spd(A_i, b_i) for A_i, b_i in zip(A, b)])
+
+
+def gram(X):
+    """X^T X of an (N, m) matrix, or of each of a batch (batch, N, m),
+    symmetrized and in float64, so the small m x m solves that follow do not
+    lose the precision the N long dot products kept."""
+    G = X.transpose(-2, -1).matmul(X).double()
+    return (G + G.transpose(-2, -1)) / 2
+
+
+def raa_alpha(delta_Qs, reg, sync_free=False):
+    """Weights of RAA.calculate: the solution of
+        (G / |mean(G)| + reg I) x = 1,   G = delta_Qs^T delta_Qs
+    normalized to sum to one.
+    Parameters
+    ----------
+    delta_Qs: torch.Tensor
+        (N, m) residuals F(Q) - Q of the m targets.
+    reg: float
+    sync_free: bool
+        Solve with solve_spd_sync_free; if the system breaks down alpha
+        falls back to (0, ..., 0, 1), the newest target alone.
+    Returns
+    -------
+    alpha: torch.Tensor
+        (m, 1), same dtype as delta_Qs.
+    """
+    m = delta_Qs.size(1)
+    G = gram(delta_Qs)
+    G = G / torch.abs(torch.mean(G)) + reg * torch.eye(m, dtype=G.dtype, device=G.device)
+    ones = torch.ones(m, 1, dtype=G.dtype, device=G.device)
+    if sync_free:
+        alpha = solve_spd_sync_free(G, ones)
+        alpha = _newest_only(alpha / torch.sum(alpha), torch.eye(m, dtype=G.dtype, device=G.device)[:, -1:])
+    else:
+        alpha = solve_spd(G, ones)
+        alpha = alpha / torch.sum(alpha)
+    return alpha.to(delta_Qs.dtype)
+
+
+def raa_newreg_alpha(delta_Qs, F_Qs, reg, sync_free=False):
+    """Weights of RAA.calculate_newReg. With Y and S the differences of
+    consecutive columns of delta_Qs and F_Qs and d the newest residual,
+        (Y^T Y / |mean(Y^T Y)| + reg (|S|^2 + |Y|^2) I) gamma = Y^T d
+    is solved and gamma turned into the m weights alpha.
+    Parameters
+    ----------
+    delta_Qs, F_Qs: torch.Tensor
+        (N, m) residuals and F(Q) of the m targets, m >= 2.
+    reg: float
+    sync_free: bool
+        See raa_alpha; the fallback is gamma = 0.
+    Returns
+    -------
+    alpha: torch.Tensor
+        (m, 1), same dtype as delta_Qs.
+    """
+    m = delta_Qs.size(1)
+    Y = delta_Qs[:, 1:] - delta_Qs[:, :-1]
+    S = F_Qs[:, 1:] - F_Qs[:, :-1]
+    # one product for Y^T Y and Y^T d
+    G = Y.t().mm(torch.cat((Y, delta_Qs[:, -1:]), 1)).double()
+    YtY, Ytd = (G[:, :-1] + G[:, :-1].t()) / 2, G[:, -1:]
+    YtY = YtY / torch.abs(torch.mean(YtY))
+    YtY += reg * (torch.sum(S.double() ** 2) + torch.trace(G[:, :-1])) * torch.eye(m - 1, dtype=G.dtype, device=G.device)
+    if sync_free:
+        gamma = _newest_only(solve_spd_sync_free(YtY, Ytd), torch.zeros_like(Ytd))
+    else:
+        gamma = solve_spd(YtY, Ytd)
+
+    alpha = torch.cat((gamma[:1], gamma[1:] - gamma[:-1], 1 - gamma[-1:]), 0)
+    return alpha.to(delta_Qs.dtype)
+
+
+def raa_alpha_batched(delta_Qs, reg):
+    """raa_alpha of a batch of independent systems, e.g. one per member of a
+    population, in one batched solve.
+    Parameters
+    ----------
+    delta_Qs: torch.Tensor
+        (batch, N, m) residuals.
+    reg: torch.Tensor
+        (batch,) regularization of each system.
+    Returns
+    -------
+    alpha: torch.Tensor
+        (batch, m, 1), same dtype as delta_Qs.
+    """
+    batch, m = delta_Qs.size(0), delta_Qs.size(2)
+    G = gram(delta_Qs)
+    eye = torch.eye(m, dtype=G.dtype, device=G.device)
+    G = G / torch.abs(G.mean((1, 2), keepdim=True)) + reg.to(G.dtype).view(-1, 1, 1) * eye
+    alpha = solve_spd_batched(G, torch.ones(batch, m, 1, dtype=G.dtype, device=G.device))
+    alpha = alpha / torch.sum(alpha, 1, keepdim=True)
+    return alpha.to(delta_Qs.dtype)
+
+
+def raa_newreg_alpha_batched(delta_Qs, F_Qs, reg):
+    """raa_newreg_alpha of a batch of independent systems in one batched
+    solve, see raa_alpha_batched.
+    Parameters
+    ----------
+    delta_Qs, F_Qs: torch.Tensor
+        (batch, N, m) residuals and F(Q), m >= 2.
+    reg: torch.Tensor
+        (batch,) regularization of each system.
+    Returns
+    -------
+    alpha: torch.Tensor
+        (batch, m, 1), same dtype as delta_Qs.
+    """
+    m = delta_Qs.size(2)
+    Y = delta_Qs[:, :, 1:] - delta_Qs[:, :, :-1]
+    S = F_Qs[:, :, 1:] - F_Qs[:, :, :-1]
+    G = Y.transpose(1, 2).bmm(torch.cat((Y, delta_Qs[:, :, -1:]), 2)).double()
+    YtY, Ytd = (G[:, :, :-1] + G[:, :, :-1].transpose(1, 2)) / 2, G[:, :, -1:]
+    YtY = YtY / torch.abs(YtY.mean((1, 2), keepdim=True))
+    scale = reg.to(G.dtype) * (torch.sum(S.double() ** 2, (1, 2)) + torch.diagonal(G[:, :, :-1], dim1=1, dim2=2).sum(1))
+    YtY = YtY + scale.view(-1, 1, 1) * torch.eye(m - 1, dtype=G.dtype, device=G.device)
+    gamma = solve_spd_batched(YtY, Ytd)
+
+    alpha = torch.cat((gamma[:, :1], gamma[:, 1:] - gamma[:, :-1], 1 - gamma[:, -1:]), 1)
+    return alpha.to(delta_Qs.dtype)
@@ -0,0 +1,49 @@
+import numpy as np
+import torch
+
+
+def backup_values(q_next, soft=0, omega=5.0):
+    """Value of the next states under the backup operator, for any number of
+    leading dimensions, e.g. the stacked (num_targets, N, num_actions) output
+    of the target history, in one vectorized call.
+    Parameters
+    ----------
+    q_next: torch.Tensor
+        Q values of the next states, actions along the last dimension.
+    soft: int
+        0: max, 1: mellowmax, 2: softmax (Boltzmann) weighted mean.
+    omega: float or torch.Tensor
+        Inverse temperature of mellowmax and softmax, a tensor broadcastable
+        to q_next for one per leading index, e.g. (K, 1, 1, 1) for K runs.
+    Returns
+    -------
+    values: torch.Tensor
+        q_next.shape[:-1]
+    """
+    if soft == 0:  # hard
+        return q_next.max(-1)[0]
+    if soft == 1:  # mellowmax, log(mean(exp(omega * q))) / omega
+        # shifted by each row's max, so exp never overflows
+        c = q_next.max(-1, keepdim=True)[0]
+        v = (torch.logsumexp(omega * (q_next - c), -1, keepdim=True) - np.log(q_next.size(-1))) / omega + c
+        return v.squeeze(-1)
+    # softmax
+    return torch.sum(torch.softmax(omega * q_next, dim=-1) * q_next, -1)
+
+
+def bellman_targets(q_next, rew, done_mask, gamma, soft=0, omega=5.0):
+    """r + gamma * (1 - done) * backup(Q(s', .)) for every leading index of
+    q_next at once, e.g. (num_targets, N, num_actions) gives the
+    (num_targets, N) targets F(Q) of all targets.
+    Parameters
+    ----------
+    q_next: torch.Tensor
+        (..., N, num_actions) Q values of the next states.
+    rew, done_mask: torch.Tensor
+        (N,) rewards and 1 where the episode ended.
+    gamma: float
+    soft, omega:
+        See backup_values.
+    """
+    # if current state is end of episode, then there is no next Q value
+    return rew + gamma * (1 - done_mask) * backup_values(q_next, soft, omega)
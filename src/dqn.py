@@ -7,6 +7,13 @@ import random
 from utils.replay_buffer import *
 from utils.schedules import *
 from utils.gym_setup import *
+from utils.prefetch import BatchPrefetcher
+from utils.storage import make_storage
+from utils.samplers import PrioritizedSampler
+from utils.vec_env import VecActor
+from utils.frame_stack import FrameStack
+from utils.precision import autocast, bf16_stages, bellman_target_error
+from src.backup import bellman_targets
 #from src.logger import Logger
 
 device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
@@ -24,7 +31,16 @@ def dqn_learning(env,
                  learning_freq=4,
                  frame_history_len=4,
                  target_update_freq=10000,
-                 save_path=None):
+                 save_path=None,
+                 prefetch=0,
+                 replay_storage='memory',
+                 prioritized=False,
+                 num_envs=1,
+                 num_actors=0,
+                 replay_ratio=None,
+                 precision='fp32',
+                 soft=0,
+                 omega=5.0):
     """Run Deep Q-learning algorithm.
     You can specify your own convnet using q_func.
     All schedules are w.r.t. total number of steps taken in the environment.
@@ -58,6 +74,35 @@ def dqn_learning(env,
         each update to the target Q network
     grad_norm_clipping: float or None
         If not None gradients' norms are clipped to this value.
+    prefetch: int
+        If > 0, sample batches in a background thread, keeping up to this
+        many ready batches queued (see utils.prefetch.BatchPrefetcher).
+    replay_storage: str
+        Backend of the replay buffer arrays, see utils.storage.make_storage.
+    prioritized: bool
+        Sample transitions by |TD error| with utils.samplers.PrioritizedSampler
+        and scale the update by the importance weights. Single env only,
+        not combined with num_envs > 1 or num_actors > 0.
+    num_envs: int
+        If > 1, `env` is a utils.vec_env.SubprocVecEnv with this many envs,
+        acted in with one batched forward of Q. Each env gets its own
+        replay_buffer_size / num_envs slots.
+    num_actors: int
+        If > 0, `env` is a utils.async_actors.AsyncActors running this many
+        actor processes, which step their envs and fill their own replay
+        buffers while this process only trains.
+    replay_ratio: float or None
+        With actors, the most updates the learner may do per env step of the
+        actors. None keeps 1 / learning_freq as in the single process loop,
+        <= 0 never holds the learner back once learning started.
+    precision: str
+        Stages whose forwards run under bfloat16 autocast, see
+        utils.precision.PRECISIONS.
+    soft: int
+        Backup operator of the targets, 0: max, 1: mellowmax, 2: softmax,
+        see src.backup.
+    omega: float
+        Inverse temperature of mellowmax and softmax.
     """
     assert type(env.observation_space) == gym.spaces.Box
     assert type(env.action_space) == gym.spaces.Discrete
@@ -78,6 +123,7 @@ def dqn_learning(env,
         input_shape = (img_h, img_w, frame_history_len * img_c)
         in_channels = input_shape[2]
     num_actions = env.action_space.n
+    stages = bf16_stages(precision)
     
     # define Q target and Q
     Q = q_func(in_channels, num_actions).to(device)
@@ -87,7 +133,29 @@ def dqn_learning(env,
     optimizer = optimizer_spec.constructor(Q.parameters(), **optimizer_spec.kwargs)
 
     # create replay buffer
-    replay_buffer = ReplayBuffer(replay_buffer_size, frame_history_len)
+    if num_actors > 0:
+        assert not prioritized, "the actors' buffers do not track priorities"
+        replay_buffer = env.replay_buffer
+        # learner step t waits for the actors to take t env steps until
+        # learning starts, and then one more env step every replay_scale steps
+        if replay_ratio is None:
+            replay_scale = 1.0
+        elif replay_ratio <= 0:
+            replay_scale = float('inf')
+        else:
+            replay_scale = replay_ratio * learning_freq
+        env.publish(Q)
+    elif num_envs > 1:
+        assert not prioritized, "prioritized sampling is per buffer, not across the envs' buffers"
+        replay_buffer = VecReplayBuffer([ReplayBuffer(replay_buffer_size // num_envs, frame_history_len,
+                                                      storage=make_storage(replay_storage, '%s/env-%d' % (save_path, i)))
+                                         for i in range(num_envs)])
+        actor = VecActor(env, replay_buffer, num_actions)
+    else:
+        replay_buffer = ReplayBuffer(replay_buffer_size, frame_history_len,
+                                     sampler=PrioritizedSampler() if prioritized else None,
+                                     storage=make_storage(replay_storage, save_path))
+    prefetcher = None
 
     ######
 
@@ -97,7 +165,9 @@ def dqn_learning(env,
     num_param_updates = 0
     mean_episode_reward = -float('nan')
     best_mean_episode_reward = -float('inf')
-    last_obs = env.reset()
+    last_obs = env.reset() if num_envs == 1 and num_actors == 0 else None
+    frame_stack = FrameStack(frame_history_len)
+    PUBLISH_EVERY_N_UPDATES = 100
     LOG_EVERY_N_STEPS = 10000
     SAVE_MODEL_EVERY_N_STEPS = 100000
     saved_scalars = []
@@ -106,41 +176,53 @@ def dqn_learning(env,
 
     for t in itertools.count():
         # 1. Step the env and store the transition
-        # store last frame, returned idx used later
-        last_stored_frame_idx = replay_buffer.store_frame(last_obs)
+        if num_actors > 0:
+            # the actors step the envs in their own processes
+            env.wait_for_steps(min(t, learning_starts) + max(0, t - learning_starts) / replay_scale)
+        elif num_envs > 1:
+            # all envs step together every num_envs iterations, so t still
+            # counts env steps and the update schedule below is unchanged
+            if t % num_envs == 0:
+                with autocast('acting' in stages):
+                    actor.step(Q, exploration.value(t) if t >= learning_starts else 1.0)
+        else:
+            # store last frame, returned idx used later
+            last_stored_frame_idx = replay_buffer.store_frame(last_obs)
 
-        # get observations to input to Q network (need to append prev frames)
-        observations = replay_buffer.encode_recent_observation()  # torch
+            # observations to input to Q network, the frames of
+            # replay_buffer.encode_recent_observation() kept on the device
+            frame_stack.push(last_obs)
 
-        # before learning starts, choose actions randomly
-        if t < learning_starts:
-            action = np.random.randint(num_actions)
-        else:
-            # epsilon greedy exploration
-            sample = random.random()
-            threshold = exploration.value(t)
-            if sample > threshold:
-                obs = observations.unsqueeze(0) / 255.0
-                with torch.no_grad():
-                    q_value_all_actions = Q(obs)
-                action = (q_value_all_actions.data.max(1)[1])[0]
+            # before learning starts, choose actions randomly
+            if t < learning_starts:
+                action = np.random.randint(num_actions)
             else:
-                action = torch.IntTensor([[np.random.randint(num_actions)]])[0][0]
+                # epsilon greedy exploration
+                sample = random.random()
+                threshold = exploration.value(t)
+                if sample > threshold:
+                    obs = frame_stack.observation().unsqueeze(0)
+                    with torch.no_grad(), autocast('acting' in stages):
+                        q_value_all_actions = Q(obs)
+                    action = int(q_value_all_actions.max(1)[1])
+                else:
+                    action = np.random.randint(num_actions)
 
-        obs, reward, done, info = env.step(action)
+            obs, reward, done, info = env.step(action)
 
-        # clipping the reward, noted in nature paper
-        reward = np.clip(reward, -1.0, 1.0)
+            # clipping the reward, noted in nature paper
+            reward = np.clip(reward, -1.0, 1.0)
 
-        # store effect of action
-        replay_buffer.store_effect(last_stored_frame_idx, action, reward, done)
+            # store effect of action
+            replay_buffer.store_effect(last_stored_frame_idx, action, reward, done)
 
-        # reset env if reached episode boundary
-        if done:
-            obs = env.reset()
+            # reset env if reached episode boundary
+            if done:
+                obs = env.reset()
+                frame_stack.reset()
 
-        # update last_obs
-        last_obs = obs
+            # update last_obs
+            last_obs = obs
 
         # 2. Perform experience replay and train the network.
         # if the replay buffer contains enough samples...
@@ -150,35 +232,44 @@ def dqn_learning(env,
 
             # sample transition batch from replay memory
             # done_mask = 1 if next state is end of episode
-            obs_t, act_t, rew_t, obs_tp1, done_mask = replay_buffer.sample(batch_size)
-            obs_t = obs_t / 255.0
+            if prefetch > 0:
+                if prefetcher is None:
+                    prefetcher = BatchPrefetcher(replay_buffer, batch_size, prefetch, return_idxes=prioritized)
+                batch = prefetcher.get()
+            else:
+                batch = replay_buffer.sample(batch_size, return_idxes=prioritized)
+            obs_t, act_t, rew_t, obs_tp1, done_mask = batch[:5]
             act_t = torch.LongTensor(act_t).to(device)
             rew_t = torch.FloatTensor(rew_t).to(device)
-            obs_tp1 = obs_tp1 / 255.0
             done_mask = done_mask
 
             # input batches to networks
             # get the Q values for current observations (Q(s,a, theta_i))
-            q_values = Q(obs_t)
+            with autocast('online' in stages):
+                q_values = Q(obs_t).float()
             q_s_a = q_values.gather(1, act_t.unsqueeze(1))
             q_s_a = q_s_a.squeeze()
 
             # get the Q values for best actions in obs_tp1 
             # based off frozen Q network
             # max(Q(s', a', theta_i_frozen)) wrt a'
-            q_tp1_values = Q_target(obs_tp1).detach()
-            q_s_a_prime, a_prime = q_tp1_values.max(1)
-
-            # if current state is end of episode, then there is no next Q value
-            q_s_a_prime = (1 - done_mask) * q_s_a_prime 
+            with autocast('targets' in stages):
+                q_tp1_values = Q_target(obs_tp1).float().detach()
 
             # Compute Bellman error
             # r + gamma * Q(s',a', theta_i_frozen) - Q(s, a, theta_i)
-            error = rew_t + gamma * q_s_a_prime - q_s_a
+            # if current state is end of episode, then there is no next Q value
+            error = bellman_targets(q_tp1_values, rew_t, done_mask, gamma, soft, omega) - q_s_a
 
             # clip the error and flip
             clipped_error = -1.0 * error.clamp(-1, 1)
 
+            # feed |TD error| back and correct for the non-uniform sampling
+            if prioritized:
+                idxes, weights, expiry = batch[5], batch[6], batch[7]
+                replay_buffer.update_priorities(idxes, error.detach().abs().cpu().numpy(), expiry)
+                clipped_error = clipped_error * weights
+
             # backwards pass
             optimizer.zero_grad()
             q_s_a.backward(clipped_error.data)
@@ -187,6 +278,9 @@ def dqn_learning(env,
             optimizer.step()
             num_param_updates += 1
 
+            if num_actors > 0 and num_param_updates % PUBLISH_EVERY_N_UPDATES == 0:
+                env.publish(Q)
+
             # update target Q network weights with current Q network weights
             if num_param_updates % target_update_freq == 0:
                 Q_target.load_state_dict(Q.state_dict())
@@ -197,10 +291,8 @@ def dqn_learning(env,
                 torch.save(Q.state_dict(), '%s/net.pth' % save_path)
 
         if t % LOG_EVERY_N_STEPS == 0:
-            underlying_env = get_wrapper_by_name(env, "Monitor")
-            internal_steps = underlying_env.get_total_steps()
+            internal_steps, episode_rewards = get_monitor_stats(env)
             stop = (internal_steps >= max_steps)
-            episode_rewards = underlying_env.get_episode_rewards()
             num_episode = len(episode_rewards)
 
             if num_episode > 0:
@@ -217,6 +309,12 @@ def dqn_learning(env,
             print("mean episode reward %f" % mean_episode_reward)
             print("best mean episode reward %f" % best_mean_episode_reward)
             print("exploration %f" % exploration.value(t))
+            if 'targets' in stages and num_param_updates > 0:
+                print("bf16 bellman target error %f" % bellman_target_error(Q_target, obs_tp1, done_mask, gamma))
+            if prefetcher is not None:
+                stats = prefetcher.stats()
+                print("prefetch queue depth %f" % stats['mean_queue_depth'])
+                print("prefetch stall time %f" % stats['stall_time'])
             sys.stdout.flush()
 
             # ============ TensorBoard logging ============#
@@ -229,4 +327,7 @@ def dqn_learning(env,
 
         # 4. Check the stop criteria
         if stop:
+            if prefetcher is not None:
+                prefetcher.close()
+            replay_buffer.close()
             break
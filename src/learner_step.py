@@ -0,0 +1,84 @@
+import torch
+
+from src.anderson_solver import raa_alpha, raa_newreg_alpha
+from src.backup import bellman_targets
+
+
+class CompiledStep(object):
+    def __init__(self, fn):
+        """`fn` compiled with torch.compile, falling back to running it
+        eagerly. torch.compile guards on the Python arguments and shapes, so
+        every number of live targets gets its own graph (at most MAX_NUM - 1,
+        below torch.compile's default recompile limit of 8), while the head
+        of the target history never reaches the graph (see make_aa_target).
+        If torch.compile is missing (torch < 2.0), fails on the first call or
+        fails to compile a later graph, `fn` runs eagerly from then on and
+        `fallback` says why. Any other error is raised: it may come from `fn`
+        after part of it ran, e.g. an optimizer step, which must not run
+        twice. TorchScript is
+        not used: it cannot capture closures over modules, backward or an
+        optimizer step.
+        Parameters
+        ----------
+        fn: callable
+            A function, module or bound method such as `optimizer.step`.
+        """
+        self.fn = fn
+        self.compiled = None
+        self.fallback = None
+        self.first_call = True
+        if hasattr(torch, 'compile'):
+            self.compiled = torch.compile(fn, dynamic=False)
+        else:
+            self.fallback = "torch.compile needs torch >= 2.0, found torch %s" % torch.__version__
+
+    def __call__(self, *args, **kwargs):
+        if self.compiled is not None:
+            first_call, self.first_call = self.first_call, False
+            try:
+                return self.compiled(*args, **kwargs)
+            except Exception as e:
+                # the first call compiles before fn runs, later calls only
+                # when a guard fails; anything else is an error of fn itself
+                if not first_call and not isinstance(e, _compile_errors()):
+                    raise
+                self.compiled, self.fallback = None, "torch.compile failed: %r" % e
+        return self.fn(*args, **kwargs)
+
+
+def _compile_errors():
+    """The exception types of dynamo and its backends failing to compile."""
+    try:
+        from torch._dynamo.exc import TorchDynamoException
+    except ImportError:
+        return ()
+    return (TorchDynamoException,)
+
+
+def make_aa_target(Q_targets, batch_size, gamma, beta, reg, AA, soft, omega):
+    """The target side of a raa_dqn update after the first one since a
+    restart, as one function of tensors: the forward of the target history,
+    the max/mellowmax/softmax backups, the Anderson weights from the sync
+    free solver and the blended target q_rhs.
+    The returned function takes (obs_t, act_t, rew_t, obs_tp1, done_mask,
+    rows) with `rows` a device tensor of `Q_targets.order(num)`, and returns
+    q_rhs of shape (batch_size,) and the (sample_size, num) residuals for
+    `RAA.check_restart`. All rows of the history are evaluated and the live
+    ones picked by `rows`, so rotating the history does not recompile.
+    """
+    def aa_target(obs_t, act_t, rew_t, obs_tp1, done_mask, rows):
+        sample_size = obs_t.size(0)
+        q = Q_targets.evaluate(torch.cat((obs_t, obs_tp1), 0))[rows].float()
+
+        qs_t = q[:, :sample_size].gather(2, act_t.view(1, -1, 1).expand(q.size(0), -1, 1)).squeeze(2)
+        F_qs = bellman_targets(q[:, sample_size:], rew_t, done_mask, gamma, soft, omega)
+
+        delta_Qs = (F_qs - qs_t).t()
+        if AA == 0:
+            alpha = raa_alpha(delta_Qs, reg, sync_free=True)
+        else:
+            alpha = raa_newreg_alpha(delta_Qs, F_qs.t(), reg, sync_free=True)
+        q_rhs = beta * qs_t[:, :batch_size].t().mm(alpha) + (1 - beta) * F_qs[:, :batch_size].t().mm(alpha)
+        return q_rhs.squeeze(1).detach(), delta_Qs
+
+    return aa_target
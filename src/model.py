@@ -1,10 +1,14 @@
 import torch
 import torch.nn as nn
+import torch.nn.functional as F
 
 
 class DQN(nn.Module):
-    def __init__(self, in_channels, num_actions):
+    def __init__(self, in_channels, num_actions, normalize_input=True):
         super(DQN, self).__init__()
+        # uint8 frames from the replay buffer are scaled to [0, 1] here, so the
+        # float copy is only made once, on the device, right before conv1
+        self.normalize_input = normalize_input
         self.conv1 = nn.Conv2d(in_channels=in_channels, out_channels=32, kernel_size=8, stride=4)
         self.conv2 = nn.Conv2d(in_channels=32, out_channels=64, kernel_size=4, stride=2)
         self.conv3 = nn.Conv2d(in_channels=64, out_channels=64, kernel_size=3, stride=1)
@@ -15,6 +19,8 @@ class DQN(nn.Module):
         self.relu = nn.ReLU()
 
     def forward(self, x):
+        if self.normalize_input:
+            x = x.float() / 255.0
         x = self.relu(self.conv1(x))
         x = self.relu(self.conv2(x))
         x = self.relu(self.conv3(x))
@@ -25,9 +31,10 @@ class DQN(nn.Module):
 
 
 class Dueling_DQN(nn.Module):
-    def __init__(self, in_channels, num_actions):
+    def __init__(self, in_channels, num_actions, normalize_input=True):
         super(Dueling_DQN, self).__init__()
         self.num_actions = num_actions
+        self.normalize_input = normalize_input
         
         self.conv1 = nn.Conv2d(in_channels=in_channels, out_channels=32, kernel_size=8, stride=4)
         self.conv2 = nn.Conv2d(in_channels=32, out_channels=64, kernel_size=4, stride=2)
@@ -42,6 +49,8 @@ class Dueling_DQN(nn.Module):
         self.relu = nn.ReLU()
 
     def forward(self, x):
+        if self.normalize_input:
+            x = x.float() / 255.0
         x = self.relu(self.conv1(x))
         x = self.relu(self.conv2(x))
         x = self.relu(self.conv3(x))
@@ -57,7 +66,161 @@ class Dueling_DQN(nn.Module):
         return x
 
 
+class _StackedParams(object):
+    """Parameters of several DQN/Dueling_DQN networks of one architecture as
+    the rows of a (rows, num_params) tensor `self.params`, and the forward
+    of a range of rows in a single pass: conv1 as one convolution with all
+    rows' filters, conv2/conv3 as grouped convolutions with one group per
+    row and the linear layers as batched matrix products, whose weights are
+    views of the rows. Shared by TargetHistory and StackedQ."""
+
+    def _set_layout(self, model):
+        if isinstance(model, _StackedParams):
+            for attr in ('normalize_input', 'dueling', 'layout', 'offsets', 'num_params', 'shapes', 'convs'):
+                setattr(self, attr, getattr(model, attr))
+            return
+        params = dict(model.named_parameters())
+        self.normalize_input = model.normalize_input
+        self.dueling = isinstance(model, Dueling_DQN)
+        self.layout = list(params)
+        if self.dueling:
+            # fc1_adv and fc1_val run as one layer, so both weights and both
+            # biases have to be adjacent in a row
+            i = self.layout.index('fc1_adv.bias')
+            self.layout[i], self.layout[i + 1] = self.layout[i + 1], self.layout[i]
+        self.offsets, self.num_params = {}, 0
+        for name in self.layout:
+            self.offsets[name] = self.num_params
+            self.num_params += params[name].numel()
+        self.shapes = {name: params[name].shape for name in self.layout}
+        self.convs = [(name, getattr(model, name).stride) for name in ('conv1', 'conv2', 'conv3')]
+
+    def _flatten(self, model):
+        # the parameters of `model` in row order, to be concatenated
+        params = dict(model.named_parameters())
+        return [params[name].reshape(-1) for name in self.layout]
+
+    def _rows(self, name, lo, hi, count=1):
+        # (hi - lo, count * numel) view of `count` adjacent parameters
+        offset = self.offsets[name]
+        return self.params[lo:hi, offset:offset + count * self.shapes[name].numel()]
+
+    def _linear(self, x, name, lo, hi, count=1):
+        out_features, in_features = self.shapes[name + '.weight']
+        weight = self._rows(name + '.weight', lo, hi, count).view(hi - lo, count * out_features, in_features)
+        bias = self._rows(name + '.bias', lo, hi, count).unsqueeze(1)
+        return torch.baddbmm(bias, x, weight.transpose(1, 2))
+
+    def _forward(self, x, lo, hi):
+        # x has the networks' in_channels and is the input of every row, or g
+        # times as many channels: the inputs of g equal groups of rows in order
+        n = hi - lo
+        groups = x.size(1) // self.shapes['conv1.weight'][1]
+        if self.normalize_input:
+            x = x.float() / 255.0
+        for i, (name, stride) in enumerate(self.convs):
+            shape = self.shapes[name + '.weight']
+            # conv2d wants contiguous weights, the convs are a small part of the rows
+            weight = self._rows(name + '.weight', lo, hi).reshape(n * shape[0], *shape[1:])
+            bias = self._rows(name + '.bias', lo, hi).reshape(-1)
+            x = F.relu(F.conv2d(x, weight, bias, stride=stride, groups=groups if i == 0 else n))
+        x = x.view(x.size(0), n, -1).transpose(0, 1)
+
+        if not self.dueling:
+            x = F.relu(self._linear(x, 'fc1', lo, hi))
+            return self._linear(x, 'fc2', lo, hi)
+        x = F.relu(self._linear(x, 'fc1_adv', lo, hi, count=2))
+        hidden = x.size(2) // 2
+        adv = self._linear(x[:, :, :hidden], 'fc2_adv', lo, hi)
+        val = self._linear(x[:, :, hidden:], 'fc2_val', lo, hi)
+        return val + adv - adv.mean(2, keepdim=True)
+
+
+class StackedQ(nn.Module, _StackedParams):
+    def __init__(self, models):
+        """Networks of one architecture, e.g. the online networks of a
+        population of runs, as a single module whose forward evaluates all of
+        them in one pass (see _StackedParams). The parameters are one
+        (num_members, num_params) nn.Parameter, so an elementwise optimizer
+        such as RMSprop updates every network as it would update it alone.
+        Parameters
+        ----------
+        models: list of DQN or Dueling_DQN
+            The members, whose parameters are copied.
+        """
+        super(StackedQ, self).__init__()
+        self._set_layout(models[0])
+        self.members = len(models)
+        with torch.no_grad():
+            self.params = nn.Parameter(torch.stack([torch.cat(self._flatten(model)) for model in models]))
 
-
-
-
+    def forward(self, x):
+        """Q values of every member for its own batch, of shape
+        (num_members, batch_size, num_actions). x is
+        (batch_size, num_members * in_channels, h, w), member k's input in
+        channels k * in_channels, ..., (k + 1) * in_channels - 1."""
+        return self._forward(x, 0, self.members)
+
+
+class TargetHistory(_StackedParams):
+    def __init__(self, model, size):
+        """The parameters of the last `size` snapshots of a DQN/Dueling_DQN,
+        e.g. the Anderson target networks, in one preallocated
+        (size, num_params) tensor on the model's device. `push` copies a model
+        into the oldest row and advances the head. Calling the history
+        evaluates the snapshots in a single pass (see _StackedParams).
+        For a StackedQ of num_members networks the rows of member k are
+        k * size, ..., (k + 1) * size - 1, and all members share the head.
+        Parameters
+        ----------
+        model: DQN, Dueling_DQN or StackedQ
+            Gives the architecture and device. Its parameters are not copied,
+            `push` models to fill the rows, which start out zero.
+        size: int
+            Number of snapshots kept.
+        """
+        self._set_layout(model)
+        self.size = size
+        self.members = model.members if isinstance(model, StackedQ) else 1
+        device = next(model.parameters()).device
+        self.params = torch.zeros(self.members * size, self.num_params, device=device)
+        self.head = 0   # row of the oldest snapshot, overwritten by the next push
+
+    def push(self, model):
+        """Copy the parameters of `model` (of every member of a StackedQ) over
+        the oldest snapshot, which becomes the newest."""
+        with torch.no_grad():
+            if isinstance(model, StackedQ):
+                self.params.view(self.members, self.size, -1)[:, self.head].copy_(model.params)
+            else:
+                torch.cat(self._flatten(model), out=self.params[self.head])
+        self.head = (self.head + 1) % self.size
+
+    def order(self, num=None):
+        """Rows of the newest `num` snapshots (all by default), oldest first.
+        With members these are the rows of member 0, add k * size for k."""
+        num = self.size if num is None else num
+        return [(self.head - num + i) % self.size for i in range(num)]
+
+    def __call__(self, x, num=None):
+        """Q values of the newest `num` snapshots (all by default) for the
+        batch x, as a tensor of shape (num, batch_size, num_actions), oldest
+        first. With members, x holds each member's input as for StackedQ and
+        the shape is (num_members, num, batch_size, num_actions)."""
+        order = self.order(num)
+        if self.members > 1:
+            q = self.evaluate(x)
+            return q.view(self.members, self.size, *q.shape[1:])[:, order]
+        if order[0] + len(order) <= self.size:
+            return self.evaluate(x, order[0], order[0] + len(order))
+        # the snapshots wrap around the end of the rows: evaluate all of them
+        # and put the outputs in order
+        return self.evaluate(x)[order]
+
+    def evaluate(self, x, lo=0, hi=None):
+        """Q values of rows lo, ..., hi - 1 (all by default) for the batch x,
+        in row order, as a tensor of shape (hi - lo, batch_size, num_actions).
+        Unlike calling the history this does not depend on the head."""
+        hi = len(self.params) if hi is None else hi
+        with torch.no_grad():
+            return self._forward(x, lo, hi)
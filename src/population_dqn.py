@@ -0,0 +1,305 @@
+import torch
+import sys
+import gym.spaces
+import itertools
+import numpy as np
+import random
+from utils.replay_buffer import *
+from utils.schedules import *
+from utils.gym_setup import *
+from utils.storage import make_storage
+from utils.frame_stack import FrameStack
+from utils.precision import autocast, bf16_stages
+from src.anderson_alpha import RAA
+from src.anderson_solver import raa_alpha_batched, raa_newreg_alpha_batched
+from src.model import StackedQ, TargetHistory
+from src.backup import bellman_targets
+
+import time
+
+
+device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+
+
+def dqn_learning(envs,
+                 rngs,
+                 omega,
+                 q_func,
+                 optimizer_spec,
+                 exploration=LinearSchedule(1000000, 0.1),
+                 max_steps=20e6,
+                 replay_buffer_size=1000000,
+                 batch_size=32,
+                 sample_size=128,
+                 gamma=0.99,
+                 beta=0.05,
+                 reg_scale=0.1,
+                 use_restart=True,
+                 learning_starts=50000,
+                 learning_freq=4,
+                 frame_history_len=4,
+                 target_update_freq=2000,
+                 save_paths=None,
+                 AA=0,
+                 soft=0,
+                 replay_storage='memory',
+                 precision='fp32'):
+    """Run src.raa_dqn.dqn_learning for a population of K independent runs,
+    e.g. seeds or omega/beta/reg_scale settings, in one process.
+    Each member keeps its own env, replay buffer, RAA restarts and RNG
+    streams, so it takes the same steps as when run alone. The K online
+    networks are one StackedQ and the K * 5 targets one TargetHistory, each
+    evaluated in a single pass for all members, and the Anderson systems of
+    the members are solved in one batched solve per number of live targets.
+    Results match K separate runs up to the rounding of the batched kernels.
+    Parameters
+    ----------
+    envs: list of gym.Env
+        One env per member, made by get_env with the member's seed.
+    rngs: list of utils.gym_setup.GlobalRNG
+        The global RNG state of each member, taken right after its get_env.
+    omega, beta, reg_scale: float or list of float
+        Shared by all members, or one value per member.
+    save_paths: list of str
+        Log directory of each member.
+    Other parameters are those of src.raa_dqn.dqn_learning, and apply to
+    every member.
+    """
+    env = envs[0]
+    assert type(env.observation_space) == gym.spaces.Box
+    assert type(env.action_space) == gym.spaces.Discrete
+    K = len(envs)
+
+    ###############
+    # BUILD MODEL #
+    ###############
+
+    start_time = time.time()
+    stages = bf16_stages(precision)
+
+    if len(env.observation_space.shape) == 1:
+        # This means we are running on low-dimensional observations (e.g. RAM)
+        input_shape = env.observation_space.shape
+        in_channels = input_shape[0]
+    else:
+        img_h, img_w, img_c = env.observation_space.shape
+        input_shape = (img_h, img_w, frame_history_len * img_c)
+        in_channels = input_shape[2]
+    num_actions = env.action_space.n
+
+    omegas = torch.tensor(np.broadcast_to(omega, K), dtype=torch.float32, device=device)
+    betas = torch.tensor(np.broadcast_to(beta, K), dtype=torch.float32, device=device)
+    reg_scales = np.broadcast_to(reg_scale, K)
+    regs = torch.tensor(reg_scales, dtype=torch.float64, device=device)
+
+    # every member draws its networks, replay sampler seed and first reset
+    # from its own RNG streams, in the order of a single run
+    MAX_NUM = 5
+    Qs, targets, replay_buffers, last_obs = [], [], [], []
+    for k in range(K):
+        with rngs[k]:
+            Qs.append(q_func(in_channels, num_actions).to(device))
+            targets.append([q_func(in_channels, num_actions).to(device) for i in range(MAX_NUM)])
+            replay_buffers.append(ReplayBuffer(replay_buffer_size, frame_history_len,
+                                               storage=make_storage(replay_storage, save_paths[k])))
+            last_obs.append(envs[k].reset())
+    frame_stacks = [FrameStack(frame_history_len) for k in range(K)]
+
+    # define Q target and Q, rows k * MAX_NUM, ... of Q_targets are member k's
+    Q = StackedQ(Qs)
+    Q_targets = TargetHistory(Q, MAX_NUM)
+    for i in range(MAX_NUM):
+        Q_targets.push(StackedQ([nets[i] for nets in targets]))
+    del Qs, targets
+
+    # initialize anderson
+    andersons = [RAA(MAX_NUM, use_restart, reg_scales[k]) for k in range(K)]
+
+    # initialize optimizer, elementwise so one over the stacked parameters
+    # updates every member as its own optimizer would
+    optimizer = optimizer_spec.constructor(Q.parameters(), **optimizer_spec.kwargs)
+
+    ###############
+    # RUN ENV     #
+    ###############
+    num_param_updates = 0
+    last_num_param_updates = 0
+    mean_episode_rewards = [-float('nan')] * K
+    best_mean_episode_rewards = [-float('inf')] * K
+    LOG_EVERY_N_STEPS = 10000
+    saved_scalars = [[] for k in range(K)]
+    stopped = [False] * K
+    restarts = [True] * K
+    cur_nums = np.ones(K, dtype=np.int64)
+    clipped_error = torch.zeros(K, 1, device=device)
+
+    for t in itertools.count():
+        # 1. Step every member's env and store the transitions
+        last_stored_frame_idxes, actions = [], []
+        for k in range(K):
+            with rngs[k]:
+                last_stored_frame_idxes.append(replay_buffers[k].store_frame(last_obs[k]))
+                frame_stacks[k].push(last_obs[k])
+
+                # before learning starts, choose actions randomly
+                if t < learning_starts:
+                    action = np.random.randint(num_actions)
+                else:
+                    # epsilon greedy exploration, greedy actions come from
+                    # one forward of all members below
+                    sample = random.random()
+                    threshold = exploration.value(t)
+                    if sample > threshold:
+                        action = None
+                    else:
+                        action = np.random.randint(num_actions)
+                actions.append(action)
+
+        if any(action is None for action in actions):
+            obs = torch.cat([frame_stack.observation() for frame_stack in frame_stacks], 0).unsqueeze(0)
+            with torch.no_grad(), autocast('acting' in stages):
+                greedy = Q(obs).max(2)[1][:, 0].tolist()
+            actions = [greedy[k] if action is None else action for k, action in enumerate(actions)]
+
+        for k in range(K):
+            with rngs[k]:
+                obs, reward, done, info = envs[k].step(actions[k])
+
+                # clipping the reward, noted in nature paper
+                reward = np.clip(reward, -1.0, 1.0)
+
+                # store effect of action
+                replay_buffers[k].store_effect(last_stored_frame_idxes[k], actions[k], reward, done)
+
+                # reset env if reached episode boundary
+                if done:
+                    obs = envs[k].reset()
+                    frame_stacks[k].reset()
+
+                # update last_obs
+                last_obs[k] = obs
+
+        # 2. Perform experience replay and train the networks.
+        # all buffers hold the same number of frames
+        if (t > learning_starts and
+                t % learning_freq == 0 and
+                replay_buffers[0].can_sample(sample_size)):
+
+            # every member samples from its own buffer, stacked as StackedQ input
+            batches = []
+            for k in range(K):
+                with rngs[k]:
+                    batches.append(replay_buffers[k].sample(sample_size))
+            obs_t = torch.cat([batch[0] for batch in batches], 1)
+            obs_tp1 = torch.cat([batch[3] for batch in batches], 1)
+            act_t = torch.LongTensor(np.stack([batch[1] for batch in batches])).to(device)
+            rew_t = torch.FloatTensor(np.stack([batch[2] for batch in batches])).to(device)
+            done_mask = torch.stack([batch[4] for batch in batches])
+
+            # get the Q values for current observations (Q(s,a, theta_i)), K x batch_size
+            with autocast('online' in stages):
+                q_values = Q(obs_t[:batch_size]).float()
+            q_s_a = q_values.gather(2, act_t[:, :batch_size].unsqueeze(2)).squeeze(2)
+
+            # Q(s, a) and F(Q)(s, a) of every member's targets, oldest first,
+            # K x MAX_NUM x sample_size
+            with autocast('targets' in stages):
+                q_targets = Q_targets(torch.cat((obs_t, obs_tp1), 0)).float()
+            qs_target_t = q_targets[:, :, :sample_size].gather(
+                3, act_t.view(K, 1, -1, 1).expand(-1, MAX_NUM, -1, 1)).squeeze(3)
+            F_qs_target_t = bellman_targets(q_targets[:, :, sample_size:], rew_t.unsqueeze(1),
+                                            done_mask.unsqueeze(1), gamma, soft, omegas.view(K, 1, 1, 1))
+
+            for k in range(K):
+                if restarts[k]:
+                    cur_nums[k], restarts[k] = 1, False
+                else:
+                    cur_nums[k] += 1
+            nums = np.minimum(cur_nums, MAX_NUM)
+
+            q_rhs = torch.zeros(K, batch_size, device=device)
+            for num in np.unique(nums):
+                members = np.flatnonzero(nums == num)
+                idx = torch.from_numpy(members).to(device)
+                if num == 1:
+                    # right after a restart: the plain target of the newest network
+                    q_rhs[idx] = F_qs_target_t[idx, -1, :batch_size]
+                    continue
+
+                # (5) important 5: the optimal alphas of all members with num
+                # live targets in one batched solve
+                qs, F_qs = qs_target_t[idx, -num:], F_qs_target_t[idx, -num:]
+                delta_Qs = (F_qs - qs).transpose(1, 2)
+                if AA == 0:  # vanilla AA
+                    alpha = raa_alpha_batched(delta_Qs, regs[idx])
+                else:  # AA == 1: # new regularization
+                    alpha = raa_newreg_alpha_batched(delta_Qs, F_qs.transpose(1, 2), regs[idx])
+
+                aa_q = qs[:, :, :batch_size].transpose(1, 2).bmm(alpha).squeeze(2)
+                aa_Tq = F_qs[:, :, :batch_size].transpose(1, 2).bmm(alpha).squeeze(2)
+                q_rhs[idx] = betas[idx].unsqueeze(1) * aa_q + (1 - betas[idx].unsqueeze(1)) * aa_Tq
+
+                for i, k in enumerate(members):
+                    restarts[k] = andersons[k].check_restart(delta_Qs[i])
+
+            # Compute Bellman error
+            # r + gamma * Q(s',a', theta_i_frozen) - Q(s, a, theta_i)
+            error = q_rhs - q_s_a
+
+            # clip the error and flip
+            clipped_error = -1.0 * error.clamp(-1, 1)
+
+            # backwards pass, the members' losses touch disjoint parameters
+            optimizer.zero_grad()
+            q_s_a.backward(clipped_error.data)
+
+            # update
+            optimizer.step()
+            num_param_updates += 1
+
+            # update target Q network weights with current Q network weights
+            if num_param_updates % target_update_freq == 0:
+                Q_targets.push(Q)
+
+        # 3. Log progress
+        if t % LOG_EVERY_N_STEPS == 0:
+            end_time = time.time()
+            total_steps = 0
+            print("---------------------------------")
+            for k in range(K):
+                internal_steps, episode_rewards = get_monitor_stats(envs[k])
+                total_steps += internal_steps
+                num_episode = len(episode_rewards)
+                # a member past max_steps keeps running with the others, but
+                # its log ends where a run of its own would have stopped
+                if stopped[k]:
+                    continue
+
+                if num_episode > 0:
+                    mean_episode_rewards[k] = np.mean(episode_rewards[-100:])
+                    best_mean_episode_rewards[k] = max(best_mean_episode_rewards[k], mean_episode_rewards[k])
+
+                    saved_scalars[k].append([t, internal_steps, num_episode, mean_episode_rewards[k],
+                                             clipped_error[k].mean().data.cpu().numpy()])
+                    np.save('%s/scalars.npy' % save_paths[k], saved_scalars[k])
+
+                print("member %d (steps) %d-%d episodes %d mean episode reward %f best mean episode reward %f"
+                      % (k, t, internal_steps, num_episode, mean_episode_rewards[k], best_mean_episode_rewards[k]))
+                stopped[k] = (internal_steps >= max_steps)
+
+            # summed over the members
+            print("Wrapped - Atari (steps) %d-%d" % (K * t, total_steps))
+            print("exploration %f" % exploration.value(t))
+            print('last time: ' + (str(end_time-start_time)))
+            print("population updates/sec %f" % (K * (num_param_updates - last_num_param_updates)
+                                                 / (end_time - start_time)))
+            start_time = end_time
+            last_num_param_updates = num_param_updates
+
+            sys.stdout.flush()
+
+        # 4. Check the stop criteria
+        if all(stopped):
+            for replay_buffer in replay_buffers:
+                replay_buffer.close()
+            break
@@ -8,8 +8,18 @@ import threading
 from utils.replay_buffer import *
 from utils.schedules import *
 from utils.gym_setup import *
+from utils.prefetch import BatchPrefetcher
+from utils.storage import make_storage
+from utils.samplers import PrioritizedSampler
+from utils.vec_env import VecActor
+from utils.frame_stack import FrameStack
+from utils.target_cache import TargetCache
+from utils.precision import autocast, bf16_stages, bellman_target_error
 #from src.logger import Logger
 from src.anderson_alpha import RAA
+from src.model import TargetHistory
+from src.learner_step import CompiledStep, make_aa_target
+from src.backup import backup_values, bellman_targets
 
 from scipy.optimize import brentq
 import time
@@ -38,7 +48,17 @@ def dqn_learning(env,
                  target_update_freq=2000,
                  save_path=None,
                  AA=0,
-                 soft=0):
+                 soft=0,
+                 prefetch=0,
+                 replay_storage='memory',
+                 prioritized=False,
+                 num_envs=1,
+                 num_actors=0,
+                 replay_ratio=None,
+                 target_cache=0,
+                 raa_sync_free=False,
+                 precision='fp32',
+                 compile_step=False):
     """Run Deep Q-learning algorithm with regularized anderson acceleration.
     You can specify your own convnet using q_func.
     All schedules are w.r.t. total number of steps taken in the environment.
@@ -72,6 +92,43 @@ def dqn_learning(env,
         each update to the target Q network
     grad_norm_clipping: float or None
         If not None gradients' norms are clipped to this value.
+    prefetch: int
+        If > 0, sample batches in a background thread, keeping up to this
+        many ready batches queued (see utils.prefetch.BatchPrefetcher).
+    replay_storage: str
+        Backend of the replay buffer arrays, see utils.storage.make_storage.
+    prioritized: bool
+        Sample transitions by |TD error| with utils.samplers.PrioritizedSampler
+        and scale the update by the importance weights. Single env only,
+        not combined with num_envs > 1 or num_actors > 0.
+    num_envs: int
+        If > 1, `env` is a utils.vec_env.SubprocVecEnv with this many envs,
+        acted in with one batched forward of Q. Each env gets its own
+        replay_buffer_size / num_envs slots.
+    num_actors: int
+        If > 0, `env` is a utils.async_actors.AsyncActors running this many
+        actor processes, which step their envs and fill their own replay
+        buffers while this process only trains.
+    replay_ratio: float or None
+        With actors, the most updates the learner may do per env step of the
+        actors. None keeps 1 / learning_freq as in the single process loop,
+        <= 0 never holds the learner back once learning started.
+    target_cache: float
+        If > 0, MB for caching the outputs of the frozen targets per replay
+        index (see utils.target_cache.TargetCache), so transitions sampled
+        again while the same targets are live skip the target forward.
+    raa_sync_free: bool
+        Compute the Anderson weights and restart decisions without host
+        synchronization (see src.anderson_alpha.RAA); restarts then take
+        effect a few updates late and are reported with the progress log.
+    precision: str
+        Stages whose forwards run under bfloat16 autocast, see
+        utils.precision.PRECISIONS. The Anderson solve stays in float64.
+    compile_step: bool
+        Run the online forward and backward, the AA target and the optimizer
+        step through torch.compile, see src.learner_step.CompiledStep. Falls
+        back to eager where torch.compile is unavailable. Not combined with
+        target_cache, whose batches vary in size.
     """
     assert type(env.observation_space) == gym.spaces.Box
     assert type(env.action_space) == gym.spaces.Discrete
@@ -84,6 +141,7 @@ def dqn_learning(env,
     ###############
 
     start_time = time.time()
+    stages = bf16_stages(precision)
 
     if len(env.observation_space.shape) == 1:
         # This means we are running on low-dimensional observations (e.g. RAM)
@@ -97,19 +155,52 @@ def dqn_learning(env,
 
     # define Q target and Q
     Q = q_func(in_channels, num_actions).to(device)
-    Q_targets = []
     MAX_NUM = 5
+    # one row of parameters per target, Q_targets(x, num) evaluates the newest num
+    Q_targets = TargetHistory(Q, MAX_NUM)
     for i in range(MAX_NUM):
-        Q_targets.append(q_func(in_channels, num_actions).to(device))
+        Q_targets.push(q_func(in_channels, num_actions).to(device))
 
     # initialize anderson
-    anderson = RAA(MAX_NUM, use_restart, reg_scale)
+    anderson = RAA(MAX_NUM, use_restart, reg_scale, raa_sync_free)
 
     # initialize optimizer
     optimizer = optimizer_spec.constructor(Q.parameters(), **optimizer_spec.kwargs)
 
+    if compile_step:
+        Q_update = CompiledStep(Q)
+        aa_target = CompiledStep(make_aa_target(Q_targets, batch_size, gamma, beta, reg_scale, AA, soft, omega))
+        optimizer_step = CompiledStep(optimizer.step)
+        target_rows = {}   # (head, num) -> device tensor of Q_targets.order(num)
+    else:
+        Q_update, optimizer_step = Q, optimizer.step
+
     # create replay buffer
-    replay_buffer = ReplayBuffer(replay_buffer_size, frame_history_len)
+    if num_actors > 0:
+        assert not prioritized, "the actors' buffers do not track priorities"
+        replay_buffer = env.replay_buffer
+        # learner step t waits for the actors to take t env steps until
+        # learning starts, and then one more env step every replay_scale steps
+        if replay_ratio is None:
+            replay_scale = 1.0
+        elif replay_ratio <= 0:
+            replay_scale = float('inf')
+        else:
+            replay_scale = replay_ratio * learning_freq
+        env.publish(Q)
+    elif num_envs > 1:
+        assert not prioritized, "prioritized sampling is per buffer, not across the envs' buffers"
+        replay_buffer = VecReplayBuffer([ReplayBuffer(replay_buffer_size // num_envs, frame_history_len,
+                                                      storage=make_storage(replay_storage, '%s/env-%d' % (save_path, i)))
+                                         for i in range(num_envs)])
+        actor = VecActor(env, replay_buffer, num_actions)
+    else:
+        replay_buffer = ReplayBuffer(replay_buffer_size, frame_history_len,
+                                     sampler=PrioritizedSampler() if prioritized else None,
+                                     storage=make_storage(replay_storage, save_path))
+    prefetcher = None
+    cache = TargetCache(replay_buffer, MAX_NUM, target_cache) if target_cache > 0 else None
+    return_idxes = prioritized or cache is not None
 
     ######
 
@@ -119,7 +210,9 @@ def dqn_learning(env,
     num_param_updates = 0
     mean_episode_reward = -float('nan')
     best_mean_episode_reward = -float('inf')
-    last_obs = env.reset()
+    last_obs = env.reset() if num_envs == 1 and num_actors == 0 else None
+    frame_stack = FrameStack(frame_history_len)
+    PUBLISH_EVERY_N_UPDATES = 100
     LOG_EVERY_N_STEPS = 10000
     SAVE_MODEL_EVERY_N_STEPS = 100000
     saved_scalars = []
@@ -131,41 +224,53 @@ def dqn_learning(env,
 
     for t in itertools.count():
         # 1. Step the env and store the transition
-        # store last frame, returned idx used later
-        last_stored_frame_idx = replay_buffer.store_frame(last_obs)
+        if num_actors > 0:
+            # the actors step the envs in their own processes
+            env.wait_for_steps(min(t, learning_starts) + max(0, t - learning_starts) / replay_scale)
+        elif num_envs > 1:
+            # all envs step together every num_envs iterations, so t still
+            # counts env steps and the update schedule below is unchanged
+            if t % num_envs == 0:
+                with autocast('acting' in stages):
+                    actor.step(Q, exploration.value(t) if t >= learning_starts else 1.0)
+        else:
+            # store last frame, returned idx used later
+            last_stored_frame_idx = replay_buffer.store_frame(last_obs)
 
-        # get observations to input to Q network (need to append prev frames)
-        observations = replay_buffer.encode_recent_observation()  # torch
+            # observations to input to Q network, the frames of
+            # replay_buffer.encode_recent_observation() kept on the device
+            frame_stack.push(last_obs)
 
-        # before learning starts, choose actions randomly
-        if t < learning_starts:
-            action = np.random.randint(num_actions)
-        else:
-            # epsilon greedy exploration
-            sample = random.random()
-            threshold = exploration.value(t)
-            if sample > threshold:
-                obs = observations.unsqueeze(0) / 255.0
-                with torch.no_grad():
-                    q_value_all_actions = Q(obs)
-                action = (q_value_all_actions.data.max(1)[1])[0]
+            # before learning starts, choose actions randomly
+            if t < learning_starts:
+                action = np.random.randint(num_actions)
             else:
-                action = torch.IntTensor([[np.random.randint(num_actions)]])[0][0]
+                # epsilon greedy exploration
+                sample = random.random()
+                threshold = exploration.value(t)
+                if sample > threshold:
+                    obs = frame_stack.observation().unsqueeze(0)
+                    with torch.no_grad(), autocast('acting' in stages):
+                        q_value_all_actions = Q(obs)
+                    action = int(q_value_all_actions.max(1)[1])
+                else:
+                    action = np.random.randint(num_actions)
 
-        obs, reward, done, info = env.step(action)
+            obs, reward, done, info = env.step(action)
 
-        # clipping the reward, noted in nature paper
-        reward = np.clip(reward, -1.0, 1.0)
+            # clipping the reward, noted in nature paper
+            reward = np.clip(reward, -1.0, 1.0)
 
-        # store effect of action
-        replay_buffer.store_effect(last_stored_frame_idx, action, reward, done)
+            # store effect of action
+            replay_buffer.store_effect(last_stored_frame_idx, action, reward, done)
 
-        # reset env if reached episode boundary
-        if done:
-            obs = env.reset()
+            # reset env if reached episode boundary
+            if done:
+                obs = env.reset()
+                frame_stack.reset()
 
-        # update last_obs
-        last_obs = obs
+            # update last_obs
+            last_obs = obs
 
         # 2. Perform experience replay and train the network.
         # if the replay buffer contains enough samples...
@@ -175,16 +280,21 @@ def dqn_learning(env,
 
             # sample transition batch from replay memory
             # done_mask = 1 if next state is end of episode
-            obs_t, act_t, rew_t, obs_tp1, done_mask = replay_buffer.sample(sample_size)
-            obs_t = obs_t / 255.0
+            if prefetch > 0:
+                if prefetcher is None:
+                    prefetcher = BatchPrefetcher(replay_buffer, sample_size, prefetch, return_idxes=return_idxes)
+                batch = prefetcher.get()
+            else:
+                batch = replay_buffer.sample(sample_size, return_idxes=return_idxes)
+            obs_t, act_t, rew_t, obs_tp1, done_mask = batch[:5]
             act_t = torch.LongTensor(act_t).to(device)
             rew_t = torch.FloatTensor(rew_t).to(device)
-            obs_tp1 = obs_tp1 / 255.0
             done_mask = done_mask
 
             # input batches to networks
             # get the Q values for current observations (Q(s,a, theta_i))
-            q_values = Q(obs_t[:batch_size, :])
+            with autocast('online' in stages):
+                q_values = Q_update(obs_t[:batch_size, :]).float()
             q_s_a = q_values.gather(1, act_t[:batch_size].unsqueeze(1))
             q_s_a = q_s_a.squeeze()
 
@@ -195,68 +305,58 @@ def dqn_learning(env,
                 # get the Q values for best actions in obs_tp1
                 # based off frozen Q network
                 # max(Q(s', a', theta_i_frozen)) wrt a'
-                q_tp1_values = Q_targets[-1](obs_tp1[:batch_size, :]).detach()
-
-                #max operator as default.
-                q_s_a_prime, _ = q_tp1_values.max(1)
-
-                ################# soft ######################
-                if soft == 0:  #
-                    q_s_a_prime, _ = q_tp1_values.max(1)
-                elif soft == 1:  # mellowmax
-                    #c = q_tp1_values.max()
-
-                    #q_s_a_prime = c + torch.log(torch.sum(torch.exp(omega * (q_tp1_values - c)), 1) / num_actions) / omega
-                    c = torch.max(q_tp1_values[0])
-                    q_s_a_prime = (torch.logsumexp(omega * (q_tp1_values - c), 1) - np.log(num_actions)) / omega + c
-
-                else:  # softmax
-                    q_s_a_prime = torch.softmax(omega * q_tp1_values, dim=1)
-                    q_s_a_prime = q_s_a_prime.mul(q_tp1_values)
-                    q_s_a_prime = torch.sum(q_s_a_prime, dim=1)
+                with autocast('targets' in stages):
+                    q_tp1_values = Q_targets(obs_tp1[:batch_size, :], 1)[0].float().detach()
 
                 # if current state is end of episode, then there is no next Q value
-                q_rhs = rew_t[:batch_size] + gamma * (1 - done_mask[:batch_size]) * q_s_a_prime
-            else:
+                q_rhs = bellman_targets(q_tp1_values, rew_t[:batch_size], done_mask[:batch_size], gamma, soft, omega)
+            elif compile_step and cache is None:
                 cur_num += 1
                 num = min(MAX_NUM, cur_num)
 
-                cat_obs = torch.cat((obs_t, obs_tp1), 0)
-                
-                qs_target_t_aa, qs_target_tp1_aa = [], []
-                for i in range(num, 0, -1):
-                    q_target = Q_targets[-i](cat_obs).detach()
-                
-                    q_aa = q_target[:sample_size, :].gather(1, act_t.unsqueeze(1))
-                    qs_target_t_aa.append(q_aa.t())
-
-                    # max operator as default.
-                    q_next_aa, _ = q_target[sample_size:, :].max(1)
-
-                    ################# soft ######################
-                    if soft == 0:  # hard
-                        q_next_aa, _ = q_target[sample_size:, :].max(1)  # obtain Q(s_t+1, max a)
-                    elif soft == 1:  # mellowmax
-                        #c = q_target[sample_size:, :].max()
-                        #q_next_aa = c + torch.log(
-                        #    torch.sum(torch.exp(omega * (q_target[sample_size:, :] - c)), 1) / num_actions) / omega
-                        c = torch.max(q_target[sample_size:, :][0])
-                        q_next_aa = (torch.logsumexp(omega * (q_target[sample_size:, :] - c), 1) - np.log(num_actions)) / omega + c
-
-
-                    else:  # softmax
-                        q_next_aa = torch.softmax(omega * q_target[sample_size:, :], dim=1)
-                        q_next_aa = q_next_aa.mul(q_target[sample_size:, :])  # element-wise
-                        q_next_aa = torch.sum(q_next_aa, dim=1)
+                # targets, backups, Anderson weights and q_rhs in one compiled graph
+                key = (Q_targets.head, num)
+                if key not in target_rows:
+                    target_rows[key] = torch.LongTensor(Q_targets.order(num)).to(device)
+                with autocast('targets' in stages):
+                    q_rhs, delta_Qs = aa_target(obs_t, act_t, rew_t, obs_tp1, done_mask, target_rows[key])
+                restart = anderson.check_restart(delta_Qs)
+            else:
+                cur_num += 1
+                num = min(MAX_NUM, cur_num)
 
-                    qs_target_tp1_aa.append(q_next_aa.unsqueeze(0))
+                # only the transitions the cache misses go through the targets
+                if cache is not None:
+                    hit, cached = cache.lookup(batch[5], num)
+                    miss = torch.from_numpy(np.flatnonzero(~hit)).to(device)
+                    miss_obs_t, miss_obs_tp1, miss_act_t = obs_t[miss], obs_tp1[miss], act_t[miss]
+                else:
+                    miss_obs_t, miss_obs_tp1, miss_act_t = obs_t, obs_tp1, act_t
+                num_miss = len(miss_act_t)
 
-                qs_target_t_values = torch.cat(qs_target_t_aa, 0)
-                qs_target_tp1_values = torch.cat(qs_target_tp1_aa, 0)
+                cat_obs = torch.cat((miss_obs_t, miss_obs_tp1), 0)
+                
+                if num_miss > 0:
+                    # Q_targets[-num:](cat_obs), oldest first
+                    with autocast('targets' in stages):
+                        q_targets_aa = Q_targets(cat_obs, num).float()
+                    # Q(s, a) and the backed up value of s' of all targets at once
+                    qs_target_t_aa = q_targets_aa[:, :num_miss].gather(
+                        2, miss_act_t.view(1, -1, 1).expand(num, -1, 1)).squeeze(2)
+                    qs_target_tp1_aa = backup_values(q_targets_aa[:, num_miss:], soft, omega)
+
+                if cache is not None:
+                    values = torch.zeros(num, sample_size, 2, device=device)
+                    values[:, torch.from_numpy(hit).to(device)] = cached
+                    if num_miss > 0:
+                        values[:, miss] = torch.stack((qs_target_t_aa, qs_target_tp1_aa), 2)
+                        cache.insert(batch[5][~hit], batch[7][~hit], values[:, miss], num)
+                    qs_target_t_values, qs_target_tp1_values = values[..., 0], values[..., 1]
+                else:
+                    qs_target_t_values, qs_target_tp1_values = qs_target_t_aa, qs_target_tp1_aa
 
-           
-                F_qs_target_t = torch.cat([(rew_t + gamma * (1 - done_mask) * q).unsqueeze(0)
-                                           for q in qs_target_tp1_values], 0)
+                # if current state is end of episode, then there is no next Q value
+                F_qs_target_t = rew_t + gamma * (1 - done_mask) * qs_target_tp1_values
 
                 alpha = 0
                 restart = False
@@ -287,19 +387,28 @@ def dqn_learning(env,
             # clip the error and flip
             clipped_error = -1.0 * error.clamp(-1, 1)
 
+            # feed |TD error| back and correct for the non-uniform sampling
+            if prioritized:
+                idxes, weights, expiry = batch[5][:batch_size], batch[6][:batch_size], batch[7][:batch_size]
+                replay_buffer.update_priorities(idxes, error.detach().abs().cpu().numpy(), expiry)
+                clipped_error = clipped_error * weights
+
             # backwards pass
             optimizer.zero_grad()
             q_s_a.backward(clipped_error.data)
 
             # update
-            optimizer.step()
+            optimizer_step()
             num_param_updates += 1
 
+            if num_actors > 0 and num_param_updates % PUBLISH_EVERY_N_UPDATES == 0:
+                env.publish(Q)
+
             # update target Q network weights with current Q network weights
             if num_param_updates % target_update_freq == 0:
-                Q_targets[0].load_state_dict(Q.state_dict())
-                Q_targets.append(Q_targets[0])
-                Q_targets.remove(Q_targets[0])
+                Q_targets.push(Q)
+                if cache is not None:
+                    cache.rotate()
 
         # 3. Log progress
         #if t % SAVE_MODEL_EVERY_N_STEPS == 0:
@@ -307,10 +416,8 @@ def dqn_learning(env,
                 #torch.save(Q.state_dict(), '%s/net.pth' % save_path)
 
         if t % LOG_EVERY_N_STEPS == 0:
-            underlying_env = get_wrapper_by_name(env, "Monitor")
-            internal_steps = underlying_env.get_total_steps()
+            internal_steps, episode_rewards = get_monitor_stats(env)
             stop = (internal_steps >= max_steps)
-            episode_rewards = underlying_env.get_episode_rewards()
             num_episode = len(episode_rewards)
 
             if num_episode > 0:
@@ -329,6 +436,23 @@ def dqn_learning(env,
             print("best mean episode reward %f" % best_mean_episode_reward)
             print("exploration %f" % exploration.value(t))
             print('last time: ' + (str(end_time-start_time)))
+            if prefetcher is not None:
+                stats = prefetcher.stats()
+                print("prefetch queue depth %f" % stats['mean_queue_depth'])
+                print("prefetch stall time %f" % stats['stall_time'])
+            if 'targets' in stages and num_param_updates > 0:
+                print("bf16 bellman target error %f" % bellman_target_error(
+                    lambda x: Q_targets(x, 1)[0], obs_tp1, done_mask, gamma))
+            if compile_step:
+                fallbacks = [s.fallback for s in (Q_update, aa_target, optimizer_step) if s.fallback]
+                print("compiled step %s" % ("eager, " + fallbacks[0] if fallbacks else "on"))
+            if raa_sync_free and anderson.last_check is not None:
+                print("anderson restarts %d" % anderson.num_restarts)
+                print("anderson error %f opt error %f" % tuple(float(e) for e in anderson.last_check))
+            if cache is not None:
+                stats = cache.stats()
+                print("target cache hit rate %f" % stats['hit_rate'])
+                print("target cache saved forwards %d" % stats['saved_forwards'])
             start_time = end_time
 
             sys.stdout.flush()
@@ -343,4 +467,7 @@ def dqn_learning(env,
 
         # 4. Check the stop criteria
         if stop:
+            if prefetcher is not None:
+                prefetcher.close()
+            replay_buffer.close()
             break
@@ -0,0 +1,277 @@
+import os
+import sys
+import json
+import time
+import hashlib
+import argparse
+import itertools
+import subprocess
+
+try:
+    import resource
+except ImportError:  # not on Windows
+    resource = None
+
+# main.py writes its logs relative to the repository root
+ROOT = os.path.dirname(os.path.abspath(__file__))
+
+# main.py names a run's log directory after these arguments; the others go
+# into its --save_suffix, so runs of a grid never share a directory
+LOG_DIR_ARGS = ('env_name', 'agent_name', 'omega', 'AA', 'soft', 'reg_scale', 'seed')
+# arguments that do not change what a run computes
+RESOURCE_ARGS = ('gpu', 'num_threads')
+
+
+def expand_spec(spec):
+    """Runs of a sweep spec, each a dict of main.py arguments.
+    The spec is a dict with any of
+        "grid": {arg: [values]} or a list of such dicts, the cartesian
+            product of every grid is added,
+        "runs": [{arg: value}], runs added as they are,
+        "args": {arg: value}, shared by every run, overridden by the runs.
+    Duplicated runs are dropped, and runs that would still share a log
+    directory (e.g. differing only in resource arguments such as the GPU)
+    are rejected with a ValueError.
+    """
+    grids = spec.get('grid', [])
+    if isinstance(grids, dict):
+        grids = [grids]
+    runs = []
+    for grid in grids:
+        names = sorted(grid)
+        for values in itertools.product(*[grid[name] for name in names]):
+            runs.append(dict(zip(names, values)))
+    runs.extend(spec.get('runs', []))
+
+    jobs, keys, log_dirs = [], set(), {}
+    for run in runs:
+        job = dict(spec.get('args', {}))
+        job.update(run)
+        key = run_key(job)
+        if key in keys:
+            continue
+        log_dir = (tuple(job.get(name) for name in LOG_DIR_ARGS), save_suffix(job))
+        if log_dir in log_dirs:
+            raise ValueError("runs '%s' and '%s' would share a log directory" % (log_dirs[log_dir], key))
+        keys.add(key)
+        log_dirs[log_dir] = key
+        jobs.append(job)
+    return jobs
+
+
+def run_key(job):
+    """Ledger key of a run, its arguments in a canonical order."""
+    return ' '.join('%s=%s' % (name, job[name]) for name in sorted(job))
+
+
+def save_suffix(job):
+    """--save_suffix of a run: the arguments main.py leaves out of the log
+    directory name, as passed by `command`, '' if there are none."""
+    if 'save_suffix' in job:
+        return job['save_suffix']
+    parts = []
+    for name in sorted(job):
+        value = job[name]
+        if name in LOG_DIR_ARGS or name in RESOURCE_ARGS or value is False or value is None:
+            continue
+        parts.append(name if value is True else '%s-%s' % (name, value))
+    return '-'.join(parts).replace(os.sep, '_')
+
+
+def command(job, num_threads, gpu):
+    """`python main.py ...` for a run. True flags are passed bare, False
+    ones left out."""
+    cmd = [sys.executable, os.path.join(ROOT, 'main.py'), '--num_threads=%d' % num_threads]
+    if gpu is not None and 'gpu' not in job:
+        cmd.append('--gpu=%d' % gpu)
+    if save_suffix(job) and 'save_suffix' not in job:
+        cmd.append('--save_suffix=%s' % save_suffix(job))
+    for name in sorted(job):
+        value = job[name]
+        if value is True:
+            cmd.append('--%s' % name)
+        elif value is not False and value is not None:
+            cmd.append('--%s=%s' % (name, value))
+    return cmd
+
+
+def cpu_slots(cores_per_run, max_parallel=0):
+    """Disjoint sets of `cores_per_run` cores out of the cores this process
+    may run on, one per concurrent run."""
+    if hasattr(os, 'sched_getaffinity'):
+        cores = sorted(os.sched_getaffinity(0))
+    else:
+        cores = list(range(os.cpu_count()))
+    num_slots = max(1, len(cores) // cores_per_run)
+    if max_parallel > 0:
+        num_slots = min(num_slots, max_parallel)
+    return [cores[i * cores_per_run:(i + 1) * cores_per_run] or cores for i in range(num_slots)]
+
+
+class Ledger(object):
+    def __init__(self, path):
+        """Append-only record of finished runs, one JSON object per line,
+        so an interrupted sweep skips the runs already done when restarted.
+        Parameters
+        ----------
+        path: str
+            File of the ledger, created if missing.
+        """
+        self.path = path
+        self.records = {}
+        if os.path.exists(path):
+            with open(path) as f:
+                for line in f:
+                    line = line.strip()
+                    if line:
+                        record = json.loads(line)
+                        # the last record of a key wins, e.g. a rerun of a failed run
+                        self.records[record['key']] = record
+
+    def done(self, key):
+        return self.records.get(key, {}).get('status') == 'done'
+
+    def add(self, record):
+        self.records[record['key']] = record
+        with open(self.path, 'a') as f:
+            f.write(json.dumps(record, sort_keys=True) + '\n')
+            f.flush()
+            os.fsync(f.fileno())
+
+
+def env_steps(log_path):
+    """Last env frame count printed by the learners, 0 if none yet: the
+    second field of 'Wrapped - Atari (steps) t-frames', the steps the
+    Monitors (under the frame skip) recorded over all envs, actors or
+    members. The first field is the learner loop counter, which with
+    actors is not an env step count."""
+    steps = 0
+    if os.path.exists(log_path):
+        with open(log_path, errors='replace') as f:
+            for line in f:
+                if line.startswith('Wrapped - Atari (steps)'):
+                    steps = int(line.split()[-1].split('-')[1])
+    return steps
+
+
+def run_sweep(jobs, ledger, log_dir, cores_per_run, num_threads, max_parallel=0, gpus=(), poll=5.0):
+    """Run the jobs not yet done in the ledger on a pool of processes, each
+    pinned to its own cores with its torch and OpenMP threads limited to
+    `num_threads`, so concurrent runs never compete for a core.
+    Actor and env subprocesses of a run inherit its cores.
+    Returns the start time, the wall time and the CPU time of all runs in
+    seconds."""
+    pending = [job for job in jobs if not ledger.done(run_key(job))]
+    print("%d runs, %d done, %d to run" % (len(jobs), len(jobs) - len(pending), len(pending)))
+    slots = cpu_slots(cores_per_run, max_parallel)
+    print("%d concurrent runs of %d cores and %d threads" % (len(slots), len(slots[0]), num_threads))
+
+    env = dict(os.environ, PYTHONUNBUFFERED='1')
+    for var in ('OMP_NUM_THREADS', 'MKL_NUM_THREADS', 'OPENBLAS_NUM_THREADS'):
+        env[var] = str(num_threads)
+
+    running = {}
+    start_time = time.time()
+    try:
+        while pending or running:
+            for slot, cores in enumerate(slots):
+                if slot in running or not pending:
+                    continue
+                job = pending.pop(0)
+                key = run_key(job)
+                log_path = os.path.join(log_dir, hashlib.sha1(key.encode()).hexdigest()[:12] + '.log')
+                gpu = gpus[slot % len(gpus)] if gpus else None
+                pin = None
+                if hasattr(os, 'sched_setaffinity'):
+                    pin = lambda cores=cores: os.sched_setaffinity(0, cores)
+                log = open(log_path, 'w')
+                proc = subprocess.Popen(command(job, num_threads, gpu), stdout=log, stderr=subprocess.STDOUT,
+                                        env=env, cwd=ROOT, preexec_fn=pin)
+                running[slot] = (proc, key, log, log_path, time.time())
+                print("start [cores %d-%d] %s" % (cores[0], cores[-1], key))
+
+            time.sleep(poll)
+            for slot in list(running):
+                proc, key, log, log_path, started = running[slot]
+                if proc.poll() is None:
+                    continue
+                log.close()
+                del running[slot]
+                record = dict(key=key, status='done' if proc.returncode == 0 else 'failed',
+                              returncode=proc.returncode, log=log_path,
+                              finished=time.time(), seconds=time.time() - started,
+                              steps=env_steps(log_path))
+                ledger.add(record)
+                print("%s (%.0fs) %s" % (record['status'], record['seconds'], key))
+    except KeyboardInterrupt:
+        # unfinished runs stay out of the ledger and run again on restart
+        for proc, _, log, _, _ in running.values():
+            proc.terminate()
+            proc.wait()
+            log.close()
+        raise
+
+    wall_time = time.time() - start_time
+    cpu_time = 0.
+    if resource is not None:
+        usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+        cpu_time = usage.ru_utime + usage.ru_stime
+    return start_time, wall_time, cpu_time
+
+
+def report(jobs, ledger, start_time=None, wall_time=None, cpu_time=None, num_cores=None):
+    """Print the env frames/sec of every run in the ledger and, given the
+    times returned by run_sweep, of the runs finished since `start_time`.
+    Frames are the Monitor step counts, see `env_steps`."""
+    print("env frames counted by the Monitors, 4 per agent step with the frame skip")
+    print("%-8s %10s %12s %10s  %s" % ("status", "seconds", "env frames", "frames/s", "run"))
+    total_steps = 0
+    for job in jobs:
+        key = run_key(job)
+        record = ledger.records.get(key)
+        if record is None:
+            print("%-8s %10s %12s %10s  %s" % ("pending", "-", "-", "-", key))
+            continue
+        if start_time is not None and record['finished'] >= start_time:
+            total_steps += record['steps']
+        print("%-8s %10.0f %12d %10.1f  %s" % (record['status'], record['seconds'], record['steps'],
+                                               record['steps'] / max(record['seconds'], 1e-9), key))
+    if wall_time:
+        print("aggregate env frames/sec %f" % (total_steps / wall_time))
+        if cpu_time and num_cores:
+            print("core utilization %f" % (cpu_time / (wall_time * num_cores)))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Run a grid of main.py configurations in parallel')
+    parser.add_argument("spec", help="JSON file with a grid, runs and shared args, see expand_spec")
+    parser.add_argument("--sweep_dir", default="logs/sweep", help="directory of the ledger and the run logs")
+    parser.add_argument("--cores_per_run", type=int, default=2, help="cores pinned to each run, incl. its env/actor processes")
+    parser.add_argument("--num_threads", type=int, default=0, help="torch intra-op threads per run, 0: cores_per_run")
+    parser.add_argument("--max_parallel", type=int, default=0, help="most concurrent runs, 0: as many as the cores allow")
+    parser.add_argument("--gpus", default="", help="comma separated GPU ids handed round-robin to the runs")
+    parser.add_argument("--poll", type=float, default=5.0, help="seconds between checks of the running processes")
+    parser.add_argument("--dry_run", action="store_true", help="Whether to only print the commands of the pending runs")
+    parser.add_argument("--report", action="store_true", help="Whether to only print the throughput of the ledger")
+    args = parser.parse_args()
+
+    with open(args.spec) as f:
+        jobs = expand_spec(json.load(f))
+    if not os.path.exists(args.sweep_dir):
+        os.makedirs(args.sweep_dir)
+    ledger = Ledger(os.path.join(args.sweep_dir, 'ledger.jsonl'))
+    # a machine with fewer cores than cores_per_run runs one job on all of them
+    num_threads = args.num_threads or len(cpu_slots(args.cores_per_run, args.max_parallel)[0])
+    gpus = [int(gpu) for gpu in args.gpus.split(',') if gpu]
+
+    if args.dry_run:
+        for job in jobs:
+            if not ledger.done(run_key(job)):
+                print(' '.join(command(job, num_threads, gpus[0] if gpus else None)))
+    elif args.report:
+        report(jobs, ledger)
+    else:
+        slots = cpu_slots(args.cores_per_run, args.max_parallel)
+        times = run_sweep(jobs, ledger, args.sweep_dir, args.cores_per_run, num_threads,
+                          args.max_parallel, gpus, args.poll)
+        report(jobs, ledger, *times, num_cores=sum(len(cores) for cores in slots))
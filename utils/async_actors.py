@@ -0,0 +1,209 @@
+import functools
+import itertools
+import queue
+import random
+import time
+import numpy as np
+import torch
+import torch.multiprocessing as mp
+
+from utils.gym_setup import get_env, get_wrapper_by_name
+from utils.replay_buffer import SharedReplayBuffer, VecReplayBuffer
+from utils.precision import autocast
+from utils.frame_stack import FrameStack
+
+device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+
+
+class SharedWeights(object):
+    def __init__(self, model):
+        """CPU copy of the parameters of `model` in shared memory, with a
+        version counter that is odd while `publish` is writing, so `pull`
+        never loads a half written set of weights.
+        """
+        self.tensors = {k: v.detach().cpu().clone().share_memory_() for k, v in model.state_dict().items()}
+        self.version = torch.zeros(1, dtype=torch.int64).share_memory_()
+
+    def publish(self, model):
+        self.version += 1
+        for k, v in model.state_dict().items():
+            self.tensors[k].copy_(v)
+        self.version += 1
+
+    def pull(self, model, version):
+        """Load the weights into `model` if they changed since `version`.
+        Returns the version now loaded."""
+        while True:
+            current = int(self.version)
+            if current == version:
+                return version
+            if current % 2 == 0:
+                model.load_state_dict(self.tensors)
+                if int(self.version) == current:
+                    return current
+            time.sleep(0.001)
+
+
+def _actor_loop(actor_id, env_fn, q_func, replay_buffer_size, frame_history_len, exploration,
+                learning_starts, num_actors, refresh_freq, bf16_acting, conn, stats_queue, stop):
+    torch.set_num_threads(1)
+    env = env_fn()
+    replay_buffer = SharedReplayBuffer(replay_buffer_size, frame_history_len, env.observation_space.shape)
+    stats_queue.put(('ready', actor_id, replay_buffer.name, env.observation_space, env.action_space))
+
+    if len(env.observation_space.shape) == 1:
+        in_channels = env.observation_space.shape[0]
+    else:
+        in_channels = frame_history_len * env.observation_space.shape[2]
+    num_actions = env.action_space.n
+    monitor = get_wrapper_by_name(env, "Monitor")
+    Q, weights, version, num_reported = None, None, 0, 0
+
+    last_obs = env.reset()
+    frame_stack = FrameStack(replay_buffer.frame_history_len)
+    try:
+        for t in itertools.count():
+            if t % refresh_freq == 0:
+                if stop.is_set():
+                    break
+                if weights is None and conn.poll():
+                    weights = conn.recv()
+                    Q = q_func(in_channels, num_actions).to(device)
+                if weights is not None:
+                    version = weights.pull(Q, version)
+                episode_rewards = monitor.get_episode_rewards()
+                stats_queue.put(('stats', actor_id, monitor.get_total_steps(), list(episode_rewards[num_reported:])))
+                num_reported = len(episode_rewards)
+
+            last_stored_frame_idx = replay_buffer.store_frame(last_obs)
+            frame_stack.push(last_obs)
+
+            # the actors share the exploration schedule of a single env
+            global_t = t * num_actors
+            if Q is None or global_t < learning_starts or random.random() <= exploration.value(global_t):
+                action = np.random.randint(num_actions)
+            else:
+                obs = frame_stack.observation().unsqueeze(0)
+                with torch.no_grad(), autocast(bf16_acting):
+                    action = int(Q(obs).max(1)[1][0])
+
+            obs, reward, done, info = env.step(action)
+            replay_buffer.store_effect(last_stored_frame_idx, action, np.clip(reward, -1.0, 1.0), done)
+            if done:
+                obs = env.reset()
+                frame_stack.reset()
+            last_obs = obs
+    finally:
+        replay_buffer.close()
+        env.close()
+
+
+class AsyncActors(object):
+    def __init__(self, env_fns, q_func, replay_buffer_size, frame_history_len, exploration,
+                 learning_starts, refresh_freq=100, bf16_acting=False):
+        """Actor processes that each step one env with an epsilon greedy copy
+        of Q and write to their own SharedReplayBuffer, while the learner
+        trains in the calling process. It stands in for the env in the
+        learners: it exposes the env spaces, `get_monitor_stats` and `close`.
+        Parameters
+        ----------
+        env_fns: [callable]
+            Functions building the (wrapped) env of each actor, picklable.
+        q_func: class
+            Model class, as passed to the learner.
+        replay_buffer_size: int
+            Slots of each actor's buffer.
+        frame_history_len: int
+        exploration: Schedule
+            Epsilon schedule over the total env steps of all actors.
+        learning_starts: int
+            Total env steps before the actors stop acting randomly.
+        refresh_freq: int
+            Env steps between checks for newly published weights.
+        bf16_acting: bool
+            Select actions under bfloat16 autocast, see utils.precision.
+        """
+        # fresh interpreters, so actors may use CUDA too
+        ctx = mp.get_context('spawn')
+        self.stats_queue = ctx.Queue()
+        self.stop = ctx.Event()
+        self.conns, self.processes = [], []
+        for i, env_fn in enumerate(env_fns):
+            conn, child_conn = ctx.Pipe()
+            process = ctx.Process(target=_actor_loop, daemon=True,
+                                  args=(i, env_fn, q_func, replay_buffer_size, frame_history_len, exploration,
+                                        learning_starts, len(env_fns), refresh_freq, bf16_acting, child_conn,
+                                        self.stats_queue, self.stop))
+            process.start()
+            self.conns.append(conn)
+            self.processes.append(process)
+
+        names = {}
+        while len(names) < len(env_fns):
+            try:
+                msg = self.stats_queue.get(timeout=1.0)
+            except queue.Empty:
+                # an actor that died before it was ready (missing ROM, gym
+                # error, ...) would never send 'ready'
+                self._check_actors([i for i in range(len(env_fns)) if i not in names], "before it was ready")
+                continue
+            if msg[0] == 'ready':
+                names[msg[1]] = msg[2]
+                self.observation_space, self.action_space = msg[3], msg[4]
+        self.replay_buffer = VecReplayBuffer([SharedReplayBuffer.attach(names[i]) for i in range(len(env_fns))])
+
+        self.weights = None
+        self.total_steps = [0] * len(env_fns)
+        self.episode_rewards = []
+
+    def num_steps(self):
+        """Env steps taken by all actors together."""
+        return sum(b.num_committed for b in self.replay_buffer.buffers)
+
+    def wait_for_steps(self, num_steps):
+        """Block until the actors together took `num_steps` env steps. Raises
+        if an actor exited, since the steps might then never come."""
+        while self.num_steps() < num_steps:
+            self._check_actors(range(len(self.processes)), "while the learner waited for env steps")
+            time.sleep(0.001)
+
+    def _check_actors(self, actors, when):
+        """Stop all actors and raise if one of `actors` has exited."""
+        for i in actors:
+            if self.processes[i].exitcode is not None:
+                self.stop.set()
+                raise RuntimeError("actor %d exited with code %s %s" % (i, self.processes[i].exitcode, when))
+
+    def publish(self, Q):
+        """Make the current weights of Q visible to the actors."""
+        if self.weights is None:
+            self.weights = SharedWeights(Q)
+            for conn in self.conns:
+                conn.send(self.weights)
+        self.weights.publish(Q)
+
+    def get_monitor_stats(self):
+        """Total steps and episode rewards over the Monitors of all actors."""
+        while True:
+            try:
+                msg = self.stats_queue.get_nowait()
+            except queue.Empty:
+                break
+            if msg[0] == 'stats':
+                self.total_steps[msg[1]] = msg[2]
+                self.episode_rewards += msg[3]
+        return sum(self.total_steps), self.episode_rewards
+
+    def close(self):
+        self.stop.set()
+        for process in self.processes:
+            process.join()
+        self.replay_buffer.close()
+
+
+def make_async_actors(env_name, seed, save_path, num_actors, **kwargs):
+    """`num_actors` actors on copies of `get_env`, seeded seed, seed+1, ...
+    and each with its own Monitor directory. See AsyncActors for kwargs."""
+    env_fns = [functools.partial(get_env, env_name, seed + i, '%s/actor-%d' % (save_path, i))
+               for i in range(num_actors)]
+    return AsyncActors(env_fns, **kwargs)
@@ -1,6 +1,5 @@
 import cv2
 import numpy as np
-from collections import deque
 import gym
 from gym import spaces
 
@@ -79,54 +78,118 @@ class EpisodicLifeEnv(gym.Wrapper):
 
 class MaxAndSkipEnv(gym.Wrapper):
     def __init__(self, env=None, skip=4):
-        """Return only every `skip`-th frame"""
+        """Return only every `skip`-th frame, the max over it and the frame
+        before, computed in place in preallocated buffers. The returned frame
+        is overwritten by the next step, ProcessFrame84 reads it right away."""
         super(MaxAndSkipEnv, self).__init__(env)
-        # most recent raw observations (for max pooling across time steps)
-        self._obs_buffer = deque(maxlen=2)
+        # the two most recent raw observations (for max pooling across time
+        # steps), written alternately
+        self._obs_buffer = None
+        self._max_frame  = None
+        self._newest     = 0
         self._skip       = skip
 
+    def _store(self, obs):
+        if self._obs_buffer is None:
+            self._obs_buffer = np.empty((2,) + np.shape(obs), dtype=np.asarray(obs).dtype)
+            self._max_frame  = np.empty_like(self._obs_buffer[0])
+        self._newest = 1 - self._newest
+        self._obs_buffer[self._newest] = obs
+
     def _step(self, action):
         total_reward = 0.0
         done = None
         for _ in range(self._skip):
             obs, reward, done, info = self.env.step(action)
-            self._obs_buffer.append(obs)
+            self._store(obs)
             total_reward += reward
             if done:
                 break
 
-        max_frame = np.max(np.stack(self._obs_buffer), axis=0)
+        max_frame = np.maximum(self._obs_buffer[0], self._obs_buffer[1], out=self._max_frame)
 
         return max_frame, total_reward, done, info
 
     def _reset(self):
         """Clear past frame buffer and init. to first obs. from inner env."""
-        self._obs_buffer.clear()
         obs = self.env.reset()
-        self._obs_buffer.append(obs)
+        # both slots hold the first obs, whose max with itself is the obs alone
+        self._store(obs)
+        self._store(obs)
         return obs
 
 
-def _process_frame84(frame):
-    img = np.reshape(frame, [210, 160, 3]).astype(np.float32)
-    img = img[:, :, 0] * 0.299 + img[:, :, 1] * 0.587 + img[:, :, 2] * 0.114
-    resized_screen = cv2.resize(img, (84, 110),  interpolation=cv2.INTER_LINEAR)
-    x_t = resized_screen[18:102, :]
-    x_t = np.reshape(x_t, [84, 84, 1])
-    return x_t.astype(np.uint8)
+# the largest difference per pixel of _process_frame84 from the float32
+# pipeline it replaced (float grayscale, float resize, truncation to uint8):
+# both OpenCV uint8 stages round where the float pipeline truncated, so pixels
+# are at most this many gray levels off, and on average about half a level
+# higher. Checked by benchmarks/preprocessing.py.
+FRAME84_TOLERANCE = 2
+
+
+def _process_frame84(frame, gray=None, out=None):
+    """84x84x1 uint8 grayscale of a 210x160x3 uint8 Atari frame: a uint8
+    grayscale with the weights 0.299, 0.587, 0.114, one bilinear resize to
+    84x110 and the crop of rows 18 to 101.
+    Parameters
+    ----------
+    frame: np.array
+        (210, 160, 3) uint8 RGB frame.
+    gray: np.array or None
+        (210, 160) uint8 scratch for the grayscale, allocated if None.
+    out: np.array or None
+        (110, 84) uint8 array the resize writes to, allocated if None. The
+        returned frame is a view into it.
+    """
+    frame = np.reshape(frame, [210, 160, 3])
+    gray = cv2.cvtColor(frame, cv2.COLOR_RGB2GRAY, dst=gray)
+    out = cv2.resize(gray, (84, 110), dst=out, interpolation=cv2.INTER_LINEAR)
+    return out[18:102, :, None]
+
+
+def process_frames84(frames, out=None):
+    """_process_frame84 of a batch of frames, e.g. of several envs, without
+    allocating per frame.
+    Parameters
+    ----------
+    frames: np.array
+        (n, 210, 160, 3) uint8 RGB frames.
+    out: np.array or None
+        (n, 84, 84, 1) uint8 result, allocated if None.
+    Returns
+    -------
+    out: np.array
+        (n, 84, 84, 1) uint8
+    """
+    if out is None:
+        out = np.empty((len(frames), 84, 84, 1), dtype=np.uint8)
+    gray, resized = np.empty((210, 160), dtype=np.uint8), np.empty((110, 84), dtype=np.uint8)
+    for i, frame in enumerate(frames):
+        out[i] = _process_frame84(frame, gray, resized)
+    return out
 
 
 class ProcessFrame84(gym.Wrapper):
     def __init__(self, env=None):
+        """84x84x1 grayscale frames, see _process_frame84. The frames are
+        written alternately to two preallocated buffers, so a returned
+        frame stays valid until the step after the next one."""
         super(ProcessFrame84, self).__init__(env)
         self.observation_space = spaces.Box(low=0, high=255, shape=(84, 84, 1))
+        self._gray    = np.empty((210, 160), dtype=np.uint8)
+        self._resized = np.empty((2, 110, 84), dtype=np.uint8)
+        self._newest  = 0
+
+    def _process(self, frame):
+        self._newest = 1 - self._newest
+        return _process_frame84(frame, self._gray, self._resized[self._newest])
 
     def _step(self, action):
         obs, reward, done, info = self.env.step(action)
-        return _process_frame84(obs), reward, done, info
+        return self._process(obs), reward, done, info
 
     def _reset(self):
-        return _process_frame84(self.env.reset())
+        return self._process(self.env.reset())
 
 
 class ClippedRewardsWrapper(gym.Wrapper):
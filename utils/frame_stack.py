@@ -0,0 +1,65 @@
+import torch
+
+device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+
+
+class FrameStack(object):
+    def __init__(self, frame_history_len):
+        """The last `frame_history_len` frames of an env as the uint8 input
+        of Q, kept on `device` for acting. It holds the same observation as
+        `ReplayBuffer.encode_recent_observation`, but each step only copies
+        the newest frame to the device instead of re-encoding the history
+        from the buffer.
+        The frames live in a preallocated tensor of twice the history, where
+        every frame is written at slot i and i + frame_history_len, so the
+        history, oldest first, is always the contiguous view of the
+        frame_history_len slots after the newest frame's first copy.
+        Parameters
+        ----------
+        frame_history_len: int
+            Number of frames in an observation. Low-dimensional observations
+            (e.g. RAM) are used alone, as by the replay buffer.
+        """
+        self.frame_history_len = frame_history_len
+        self.frames = None
+        self.newest = -1    # slot of the newest frame's first copy
+
+    def _allocate(self, frame):
+        if len(frame.shape) == 1:
+            self.frame_history_len = 1
+            self.channels = 1
+            shape = (2, frame.shape[0])
+        else:
+            img_h, img_w, self.channels = frame.shape
+            shape = (2 * self.frame_history_len * self.channels, img_h, img_w)
+        self.frames = torch.zeros(shape, dtype=torch.uint8, device=device)
+
+    def reset(self):
+        """Forget the history, e.g. at the end of an episode: the frames
+        before the next `push` are zeros, as in the replay buffer."""
+        if self.frames is not None:
+            self.frames.zero_()
+
+    def push(self, frame):
+        """Add the newest frame, of shape (img_h, img_w, img_c) and dtype
+        np.uint8 as stored in the replay buffer."""
+        if self.frames is None:
+            self._allocate(frame)
+        frame = torch.from_numpy(frame)
+        if len(frame.shape) > 1:
+            # c, h, w instead of h, w, c
+            frame = frame.permute(2, 0, 1)
+        self.newest = (self.newest + 1) % self.frame_history_len
+        c, k = self.channels, self.frame_history_len
+        first = self.frames[self.newest * c:(self.newest + 1) * c]
+        first.copy_(frame.view_as(first))
+        self.frames[(self.newest + k) * c:(self.newest + k + 1) * c].copy_(first)
+
+    def observation(self):
+        """The history, oldest frame first, as a view of shape
+        (img_c * frame_history_len, img_h, img_w) (or the RAM of the newest
+        frame), valid until the next `push`."""
+        start = (self.newest + 1) * self.channels
+        if len(self.frames.shape) == 2:
+            return self.frames[self.newest]
+        return self.frames[start:start + self.frame_history_len * self.channels]
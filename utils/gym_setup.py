@@ -3,6 +3,7 @@ from gym import wrappers
 import numpy as np
 import random
 from utils.atari_wrappers import *
+from utils.synthetic_env import is_synthetic_env, register_synthetic_env
 
 def set_global_seeds(i):
     try:
@@ -15,7 +16,47 @@ def set_global_seeds(i):
     random.seed(i)
 
 
+class GlobalRNG(object):
+    def __init__(self):
+        """Snapshot of the global random, numpy and torch RNG states, e.g.
+        taken right after get_env seeded them for a run. Inside `with rng:`
+        the globals draw from the snapshot, which moves on with them, and are
+        restored afterwards, so several runs in one process each draw the
+        same numbers as when run alone.
+        """
+        self.state = self._get()
+
+    @staticmethod
+    def _get():
+        try:
+            import torch
+        except ImportError:
+            torch_state = None
+        else:
+            torch_state = torch.get_rng_state()
+        return random.getstate(), np.random.get_state(), torch_state
+
+    @staticmethod
+    def _set(state):
+        random.setstate(state[0])
+        np.random.set_state(state[1])
+        if state[2] is not None:
+            import torch
+            torch.set_rng_state(state[2])
+
+    def __enter__(self):
+        self.outer = self._get()
+        self._set(self.state)
+        return self
+
+    def __exit__(self, *exc):
+        self.state = self._get()
+        self._set(self.outer)
+
+
 def get_env(env_name, seed, save_path):
+    if is_synthetic_env(env_name):
+        register_synthetic_env(env_name)
     env = gym.make(env_name)
 
     set_global_seeds(seed)
@@ -37,3 +78,12 @@ def get_wrapper_by_name(env, classname):
             currentenv = currentenv.env
         else:
             raise ValueError("Couldn't find wrapper named %s" % classname)
+
+
+def get_monitor_stats(env):
+    """Total env steps and episode rewards recorded by the Monitor of `env`,
+    which may also be a SubprocVecEnv."""
+    if hasattr(env, 'get_monitor_stats'):
+        return env.get_monitor_stats()
+    monitor = get_wrapper_by_name(env, "Monitor")
+    return monitor.get_total_steps(), monitor.get_episode_rewards()
@@ -0,0 +1,46 @@
+import contextlib
+import torch
+
+device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+
+# --precision choices and the stages of the learners they run in bfloat16:
+# action selection, the target networks and the online network's update
+PRECISIONS = {
+    'fp32': (),
+    'bf16_targets': ('targets',),
+    'bf16_acting': ('acting',),
+    'bf16': ('acting', 'targets', 'online'),
+}
+
+
+def bf16_stages(precision):
+    """Stages to run in bfloat16 for a `--precision` value. Fails early if
+    this torch has no bfloat16 autocast (torch.autocast came with 1.10)."""
+    stages = PRECISIONS[precision]
+    if stages and not hasattr(torch, 'autocast'):
+        raise RuntimeError("--precision=%s needs torch.autocast (torch >= 1.10), found torch %s"
+                           % (precision, torch.__version__))
+    return stages
+
+
+def autocast(enabled):
+    """Context in which autocast eligible ops (convolutions, matrix products)
+    run in bfloat16 on `device` if `enabled`; reductions, the softmax/
+    mellowmax backups and the Anderson solve stay in float32/float64.
+    Outputs may be bfloat16, callers cast them back with `.float()`."""
+    if not enabled:
+        return contextlib.nullcontext()
+    return torch.autocast(device.type, dtype=torch.bfloat16)
+
+
+def bellman_target_error(q, obs_tp1, done_mask, gamma):
+    """Largest difference between the max backup
+        r + gamma * (1 - done) * max_a q(s', a)
+    with q evaluated in bfloat16 and in float32, for a callable `q` returning
+    (batch_size, num_actions) Q values. The reward cancels out."""
+    with torch.no_grad():
+        exact = q(obs_tp1).float().max(1)[0]
+        with autocast(True):
+            approx = q(obs_tp1)
+        approx = approx.float().max(1)[0]
+    return float((gamma * (1 - done_mask) * (approx - exact)).abs().max())
@@ -0,0 +1,87 @@
+import queue
+import threading
+import time
+
+
+class BatchPrefetcher(object):
+    def __init__(self, replay_buffer, batch_size, depth=2, return_idxes=False):
+        """Samples batches from `replay_buffer` in a background thread, so the
+        next batch is assembled while the learner runs its forward/backward
+        pass. Torch kernels release the GIL, which is where the overlap comes
+        from.
+        Each batch is gathered under `replay_buffer.lock`, the same lock
+        `store_frame` and `store_effect` take, and the gather copies the frames
+        out of the buffer, so a queued batch never sees a half written frame.
+        A queued batch can be up to `depth` updates older than one sampled on
+        demand.
+        Parameters
+        ----------
+        replay_buffer: ReplayBuffer
+            Buffer to sample from.
+        batch_size: int
+            Number of transitions per batch, as passed to `ReplayBuffer.sample`.
+        depth: int
+            Maximum number of ready batches waiting in the queue.
+        return_idxes: bool
+            Passed on to `ReplayBuffer.sample`.
+        """
+        self.replay_buffer = replay_buffer
+        self.batch_size    = batch_size
+        self.return_idxes  = return_idxes
+        self.queue         = queue.Queue(maxsize=depth)
+
+        self.num_gets    = 0
+        self.stall_time  = 0.
+        self.depth_total = 0
+
+        self._stop   = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        try:
+            while not self._stop.is_set():
+                if not self.replay_buffer.can_sample(self.batch_size):
+                    time.sleep(0.01)
+                    continue
+                self._put(self.replay_buffer.sample(self.batch_size, self.return_idxes))
+        except Exception as e:
+            # hand the error to the learner, which would otherwise wait in
+            # `get` forever for a batch that never comes
+            self._put(e)
+
+    def _put(self, item):
+        while not self._stop.is_set():
+            try:
+                self.queue.put(item, timeout=0.1)
+                break
+            except queue.Full:
+                pass
+
+    def get(self):
+        """Return the next ready batch, blocking until one is available.
+        Same return value as `ReplayBuffer.sample`. An exception raised by
+        the sampling thread is raised here.
+        """
+        self.depth_total += self.queue.qsize()
+        start = time.perf_counter()
+        batch = self.queue.get()
+        self.stall_time += time.perf_counter() - start
+        if isinstance(batch, Exception):
+            raise batch
+        self.num_gets += 1
+        return batch
+
+    def stats(self):
+        """Mean queue depth seen by the learner and its total/mean stall time
+        in seconds, since the last call."""
+        num_gets = max(self.num_gets, 1)
+        stats = {'mean_queue_depth': self.depth_total / num_gets,
+                 'stall_time': self.stall_time,
+                 'mean_stall_time': self.stall_time / num_gets}
+        self.num_gets, self.stall_time, self.depth_total = 0, 0., 0
+        return stats
+
+    def close(self):
+        self._stop.set()
+        self._thread.join()
@@ -1,22 +1,20 @@
+import os
+import json
 import numpy as np
-import random
+import secrets
+import threading
 import torch
+from utils.samplers import UniformSampler
+from utils.storage import MemoryStorage, SharedMemoryStorage
 
 device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
 
-def sample_n_unique(sampling_f, n):
-    """Helper function. Given a function `sampling_f` that returns
-    comparable objects, sample n such unique objects.
-    """
-    res = []
-    while len(res) < n:
-        candidate = sampling_f()
-        if candidate not in res:
-            res.append(candidate)
-    return res
+# snapshots are written and read in pieces of about this many bytes
+SNAPSHOT_CHUNK_BYTES = 64 * 1024 * 1024
+
 
 class ReplayBuffer(object):
-    def __init__(self, size, frame_history_len):
+    def __init__(self, size, frame_history_len, sampler=None, storage=None):
         """This is a memory efficient implementation of the replay buffer.
         The sepecific memory optimizations use here are:
             - only store each frame once rather than k times
@@ -37,12 +35,26 @@ class ReplayBuffer(object):
             overflows the old memories are dropped.
         frame_history_len: int
             Number of memories to be retried for each observation.
+        sampler: utils.samplers.Sampler or None
+            Strategy picking the sampled indices, UniformSampler by default.
+        storage: utils.storage.Storage or None
+            Where the arrays are allocated, MemoryStorage by default. Use
+            MemmapStorage to keep the frames in files instead of RAM.
         """
         self.size = size
         self.frame_history_len = frame_history_len
 
+        self.sampler = sampler if sampler is not None else UniformSampler()
+        self.sampler.attach(self)
+        self.storage = storage if storage is not None else MemoryStorage()
+
+        # guards writes against a concurrent `sample`, e.g. from BatchPrefetcher
+        self.lock = threading.Lock()
+
         self.next_idx      = 0
         self.num_in_buffer = 0
+        self.num_stored    = 0      # frames ever stored, used by incremental `save`
+        self.buffer_id     = secrets.token_hex(8)
 
         self.obs      = None
         self.action   = None
@@ -50,21 +62,70 @@ class ReplayBuffer(object):
         self.done     = None
 
     def can_sample(self, batch_size):
-        """Returns true if `batch_size` different transitions can be sampled from the buffer."""
-        return batch_size + 1 <= self.num_in_buffer
+        """Returns true if a batch of `batch_size` transitions can be sampled
+        from the buffer, i.e. at least that many transitions are valid."""
+        return self.sampler.can_sample(batch_size)
 
     def _encode_sample(self, idxes):
-        obs_batch      = torch.cat([self._encode_observation(idx)[None] for idx in idxes], 0)
+        idxes          = np.asarray(idxes, dtype=np.int64)
+        obs_batch, next_obs_batch = self._encode_observations(idxes)
         act_batch      = self.action[idxes]
         rew_batch      = self.reward[idxes]
-        next_obs_batch = torch.cat([self._encode_observation(idx + 1)[None] for idx in idxes], 0)
-        done_mask      = torch.FloatTensor([1.0 if self.done[idx] else 0.0 for idx in idxes]).to(device)
+        done_mask      = torch.from_numpy(self.done[idxes].astype(np.float32)).to(device)
 
         return obs_batch, act_batch, rew_batch, next_obs_batch, done_mask
 
+    def _history_mask(self, history_idxes):
+        """Batched version of the context checks in `_encode_observation`.
+        Given absolute (not yet wrapped) frame indices of shape
+        (batch_size, frame_history_len), returns a boolean mask that is False
+        for every frame that `_encode_observation` would replace by zeros.
+        """
+        valid = np.ones(history_idxes.shape, dtype=np.bool_)
+        # if there weren't enough frames ever in the buffer for context
+        if self.num_in_buffer != self.size:
+            valid &= history_idxes >= 0
+        # a done flag at column k ends the previous episode, so frame k and
+        # everything before it belong to another episode
+        done = self.done[history_idxes[:, :-1] % self.size]
+        cut  = np.logical_or.accumulate(done[:, ::-1], axis=1)[:, ::-1]
+        valid[:, :-1] &= ~cut
+        return valid
+
+    def _encode_observations(self, idxes):
+        """Encode the observations at `idxes` and `idxes + 1` with a single
+        gather into `self.obs`. Equivalent to calling `_encode_observation`
+        on each index, but without a Python loop over the batch.
+        """
+        # this checks if we are using low-dimensional observations, such as RAM
+        # state, in which case we just directly return the latest RAM.
+        if len(self.obs.shape) == 2:
+            frames = torch.from_numpy(self.obs[np.stack([idxes, idxes + 1]) % self.size]).to(device)
+            return frames[0], frames[1]
+
+        # frame_history_len + 1 frames cover both obs and next_obs of each index
+        offsets = np.arange(-self.frame_history_len + 1, 2)
+        window  = idxes[:, None] + offsets[None, :]
+        frames  = self.obs[window % self.size]                  # b, k+1, c, h, w
+
+        batch_size, _, img_c, img_h, img_w = frames.shape
+        obs_mask      = self._history_mask(window[:, :-1])
+        next_obs_mask = self._history_mask(window[:, 1:])
+
+        obs_batch      = frames[:, :-1] * obs_mask[:, :, None, None, None]
+        next_obs_batch = frames[:, 1:] * next_obs_mask[:, :, None, None, None]
+
+        # c, h, w instead of h, w c
+        shape = (batch_size, self.frame_history_len * img_c, img_h, img_w)
+        obs_batch      = torch.from_numpy(obs_batch.reshape(shape)).to(device)
+        next_obs_batch = torch.from_numpy(next_obs_batch.reshape(shape)).to(device)
+        return obs_batch, next_obs_batch
+
 
-    def sample(self, batch_size):
-        """Sample `batch_size` different transitions.
+    def sample(self, batch_size, return_idxes=False):
+        """Sample `batch_size` transitions. They are distinct under the
+        default UniformSampler; a PrioritizedSampler draws with replacement,
+        so its batches can repeat an index.
         i-th sample transition is the following:
         when observing `obs_batch[i]`, action `act_batch[i]` was taken,
         after which reward `rew_batch[i]` was received and subsequent
@@ -75,35 +136,90 @@ class ReplayBuffer(object):
         ----------
         batch_size: int
             How many transitions to sample.
+        return_idxes: bool
+            Also return the sampled indices, their importance weights and
+            when they expire.
         Returns
         -------
-        obs_batch: np.array
-            Array of shape
+        obs_batch: torch.Tensor
+            Tensor of shape
             (batch_size, img_c * frame_history_len, img_h, img_w)
-            and dtype np.uint8
+            and dtype torch.uint8, on `device`
         act_batch: np.array
             Array of shape (batch_size,) and dtype np.int32
         rew_batch: np.array
             Array of shape (batch_size,) and dtype np.float32
-        next_obs_batch: np.array
-            Array of shape
+        next_obs_batch: torch.Tensor
+            Tensor of shape
             (batch_size, img_c * frame_history_len, img_h, img_w)
-            and dtype np.uint8
-        done_mask: np.array
-            Array of shape (batch_size,) and dtype np.float32
+            and dtype torch.uint8, on `device`
+        done_mask: torch.Tensor
+            Tensor of shape (batch_size,) and dtype torch.float32, on `device`
+        idxes: np.array
+            Only if `return_idxes`. Buffer indices of the transitions, to be
+            passed back to `update_priorities`.
+        weights: torch.Tensor or None
+            Only if `return_idxes`. Importance weights of shape (batch_size,)
+            on `device`, None if the sampler does not use them.
+        expiry: np.array
+            Only if `return_idxes`. For each transition, the `write_counts`
+            value after which it is overwritten: while `write_counts(idxes)
+            <= expiry` the transition is still the one sampled.
+        """
+        with self.lock:
+            assert self.can_sample(batch_size)
+            idxes = self.sampler.sample(batch_size)
+            batch = self._encode_sample(idxes)
+            if return_idxes:
+                batch += (idxes, self._weights(idxes), self._expiry(idxes, self.num_stored))
+            return batch
+
+    def _expiry(self, idxes, num_stored):
+        # frames are written in ring order, so a write into the slots read
+        # for idx (its history up to the next frame) hits the first of them
+        # first; the n-th frame ever stored goes to slot n % size
+        first = (np.asarray(idxes) - self.frame_history_len + 1) % self.size
+        return num_stored + (first - num_stored) % self.size
+
+    def write_counts(self, idxes):
+        """Frames stored so far by the buffer owning each of `idxes`, the
+        clock `expiry` of `sample` refers to."""
+        return np.full(len(idxes), self.num_stored, dtype=np.int64)
+
+    def _weights(self, idxes):
+        weights = self.sampler.weights(idxes)
+        return torch.from_numpy(weights).to(device) if weights is not None else None
+
+    def update_priorities(self, idxes, td_errors, expiry=None):
+        """Feed the TD errors of a sampled batch back to a prioritized
+        sampler, e.g. PrioritizedSampler.
+        Parameters
+        ----------
+        idxes: np.array
+            Indices returned by `sample(..., return_idxes=True)`.
+        td_errors: np.array
+            TD errors of the same shape.
+        expiry: np.array or None
+            The `expiry` returned with `idxes`. Transitions overwritten since
+            they were sampled, e.g. while a prefetched batch waited, are
+            skipped instead of passing their error on to the new ones.
         """
-        assert self.can_sample(batch_size)
-        idxes = sample_n_unique(lambda: random.randint(0, self.num_in_buffer - 2), batch_size)
-        return self._encode_sample(idxes)
+        idxes, td_errors = np.asarray(idxes), np.asarray(td_errors)
+        with self.lock:
+            if expiry is not None:
+                current = self.write_counts(idxes) <= np.asarray(expiry)
+                idxes, td_errors = idxes[current], td_errors[current]
+            self.sampler.update_priorities(idxes, td_errors)
 
     def encode_recent_observation(self):
         """Return the most recent `frame_history_len` frames.
         Returns
         -------
-        observation: np.array
-            Array of shape (img_c * frame_history_len, img_h, img_w)
-            and dtype np.uint8, where observation[i*img_c:(i+1)*img_c, :, :]
-            encodes frame at time `t - frame_history_len + i`
+        observation: torch.Tensor
+            Tensor of shape (img_c * frame_history_len, img_h, img_w)
+            and dtype torch.uint8, where observation[i*img_c:(i+1)*img_c, :, :]
+            encodes frame at time `t - frame_history_len + i`. On the CPU this
+            may be a view into the buffer, so use it before the next `store_frame`.
         """
         assert self.num_in_buffer > 0
         return self._encode_observation((self.next_idx - 1) % self.size)
@@ -114,7 +230,7 @@ class ReplayBuffer(object):
         # this checks if we are using low-dimensional observations, such as RAM
         # state, in which case we just directly return the latest RAM.
         if len(self.obs.shape) == 2:
-            return torch.FloatTensor(self.obs[end_idx-1]).to(device)
+            return torch.from_numpy(self.obs[end_idx-1]).to(device)
         # if there weren't enough frames ever in the buffer for context
         if start_idx < 0 and self.num_in_buffer != self.size:
             start_idx = 0
@@ -125,15 +241,23 @@ class ReplayBuffer(object):
         # if zero padding is needed for missing context
         # or we are on the boundry of the buffer
         if start_idx < 0 or missing_context > 0:
-            frames = [torch.zeros_like(torch.FloatTensor(self.obs[0]).to(device)) for _ in range(missing_context)]
+            frames = [np.zeros_like(self.obs[0]) for _ in range(missing_context)]
             for idx in range(start_idx, end_idx):
-                frames.append(torch.FloatTensor(self.obs[idx % self.size]).to(device))
-            return torch.cat(frames, 0)     # c, h, w instead of h, w c
+                frames.append(self.obs[idx % self.size])
+            return torch.from_numpy(np.concatenate(frames, 0)).to(device)     # c, h, w instead of h, w c
         else:
             # this optimization has potential to saves about 30% compute time \o/
             # c, h, w instead of h, w c
             img_h, img_w = self.obs.shape[2], self.obs.shape[3]
-            return torch.FloatTensor(self.obs[start_idx:end_idx].reshape(-1, img_h, img_w)).to(device)
+            return torch.from_numpy(self.obs[start_idx:end_idx].reshape(-1, img_h, img_w)).to(device)
+
+    def _allocate(self, frame_shape):
+        """Allocate the buffer arrays for frames of shape `frame_shape`
+        (c, h, w for images)."""
+        self.obs      = self.storage.empty('obs',    [self.size] + list(frame_shape), np.uint8)
+        self.action   = self.storage.empty('action', [self.size],                     np.int32)
+        self.reward   = self.storage.empty('reward', [self.size],                     np.float32)
+        self.done     = self.storage.empty('done',   [self.size],                     np.bool_)
 
     def store_frame(self, frame):
         """Store a single frame in the buffer at the next available index, overwriting
@@ -154,15 +278,15 @@ class ReplayBuffer(object):
             frame = frame.transpose(2, 0, 1)
 
         if self.obs is None:
-            self.obs      = np.empty([self.size] + list(frame.shape), dtype=np.uint8)
-            self.action   = np.empty([self.size],                     dtype=np.int32)
-            self.reward   = np.empty([self.size],                     dtype=np.float32)
-            self.done     = np.empty([self.size],                     dtype=np.bool)
-        self.obs[self.next_idx] = frame
+            self._allocate(frame.shape)
+        with self.lock:
+            self.obs[self.next_idx] = frame
 
-        ret = self.next_idx
-        self.next_idx = (self.next_idx + 1) % self.size
-        self.num_in_buffer = min(self.size, self.num_in_buffer + 1)
+            ret = self.next_idx
+            self.next_idx = (self.next_idx + 1) % self.size
+            self.num_in_buffer = min(self.size, self.num_in_buffer + 1)
+            self.num_stored += 1
+            self.sampler.on_store_frame(ret)
 
         return ret
 
@@ -182,6 +306,333 @@ class ReplayBuffer(object):
         done: bool
             True if episode was finished after performing that action.
         """
-        self.action[idx] = action
-        self.reward[idx] = reward
-        self.done[idx]   = done
+        with self.lock:
+            self.action[idx] = action
+            self.reward[idx] = reward
+            self.done[idx]   = done
+
+    def _snapshot_arrays(self):
+        return [('obs', self.obs), ('action', self.action), ('reward', self.reward), ('done', self.done)]
+
+    def save(self, path, incremental=True):
+        """Write the buffer to directory `path`: one raw binary file per array
+        plus `meta.json` with the indices. Arrays are written in large
+        sequential pieces straight from the buffer memory.
+        Parameters
+        ----------
+        path: str
+            Snapshot directory, created if needed.
+        incremental: bool
+            If `path` already holds a complete snapshot of this buffer, only
+            rewrite the slots stored since then (plus the slot whose effect
+            may still have been pending at that time).
+        """
+        assert self.obs is not None, "nothing to save"
+        if not os.path.exists(path):
+            os.makedirs(path)
+        with self.lock:
+            meta = {'buffer_id': self.buffer_id,
+                    'size': self.size,
+                    'frame_history_len': self.frame_history_len,
+                    'frame_shape': [int(d) for d in self.obs.shape[1:]],
+                    'next_idx': self.next_idx,
+                    'num_in_buffer': self.num_in_buffer,
+                    'num_stored': self.num_stored,
+                    'complete': False}
+            old = _read_meta(path) if incremental else None
+            if (old is not None and old['complete'] and old['buffer_id'] == self.buffer_id and
+                    0 < old['num_stored'] <= self.num_stored < old['num_stored'] + self.size):
+                start = (old['num_stored'] - 1) % self.size
+                regions = _ring_regions(start, self.num_stored - old['num_stored'] + 1, self.size)
+                mode = 'r+b'
+            else:
+                regions = [(0, self.num_in_buffer)]
+                mode = 'wb'
+
+            # a crash while writing leaves a snapshot that `load` refuses
+            _write_meta(path, meta)
+            for name, array in self._snapshot_arrays():
+                with open(os.path.join(path, '%s.bin' % name), mode) as f:
+                    for lo, hi in regions:
+                        _write_rows(f, array, lo, hi)
+            meta['complete'] = True
+            _write_meta(path, meta)
+
+    def load(self, path):
+        """Restore a snapshot written by `save` into this buffer, which must
+        have the same `size` and `frame_history_len`."""
+        meta = _read_meta(path)
+        if meta is None or not meta['complete']:
+            raise ValueError("No complete replay buffer snapshot in %s" % path)
+        if meta['size'] != self.size or meta['frame_history_len'] != self.frame_history_len:
+            raise ValueError("Snapshot in %s was taken from a buffer of a different size" % path)
+        with self.lock:
+            if self.obs is None:
+                self._allocate(meta['frame_shape'])
+            for name, array in self._snapshot_arrays():
+                with open(os.path.join(path, '%s.bin' % name), 'rb') as f:
+                    _read_rows(f, array, 0, meta['num_in_buffer'])
+            self.next_idx      = meta['next_idx']
+            self.num_in_buffer = meta['num_in_buffer']
+            self.num_stored    = meta['num_stored']
+            self.buffer_id     = meta['buffer_id']
+            # forget the bookkeeping of the old contents, then report every
+            # restored frame, oldest first
+            self.sampler.attach(self)
+            self.sampler.on_store_frames((self.next_idx - self.num_in_buffer + np.arange(self.num_in_buffer)) % self.size)
+
+    def close(self):
+        """Release the storage backing the buffer."""
+        self.obs = self.action = self.reward = self.done = None
+        self.storage.close()
+
+
+class VecReplayBuffer(object):
+    def __init__(self, buffers):
+        """One ReplayBuffer per environment of a vectorized env runner, so
+        each env's frames stay contiguous for the frame history. Batches are
+        drawn from all buffers, split as evenly as possible, and shuffled, so
+        any prefix of a batch mixes the envs. Indices are global: buffer k
+        owns [k * size, (k + 1) * size).
+        Parameters
+        ----------
+        buffers: [ReplayBuffer]
+            Buffers of equal size, buffer i is written by env i. Their
+            samplers must not be prioritized: each would draw and weight its
+            share of a batch by its own priorities only.
+        """
+        self.buffers = buffers
+        self.size = buffers[0].size
+
+    def can_sample(self, batch_size):
+        per_buffer = -(-batch_size // len(self.buffers))
+        return all(b.can_sample(per_buffer) for b in self.buffers)
+
+    def sample(self, batch_size, return_idxes=False):
+        """See ReplayBuffer.sample."""
+        counts = np.full(len(self.buffers), batch_size // len(self.buffers))
+        counts[np.random.choice(len(self.buffers), batch_size % len(self.buffers), replace=False)] += 1
+        batches = []
+        for k, (b, count) in enumerate(zip(self.buffers, counts)):
+            if count == 0:
+                continue
+            batch = b.sample(int(count), return_idxes)
+            if return_idxes:
+                batch = batch[:5] + (batch[5] + k * self.size,) + batch[6:]
+            batches.append(batch)
+        # the learners train on a prefix of the batch, which without the
+        # shuffle would only hold the first buffers' transitions
+        order = np.random.permutation(batch_size)
+        return tuple(_concat(parts, order) for parts in zip(*batches))
+
+    def write_counts(self, idxes):
+        """See ReplayBuffer.write_counts."""
+        counts = np.array([b.write_counts([0])[0] for b in self.buffers])
+        return counts[np.asarray(idxes) // self.size]
+
+    def store_frames(self, frames):
+        """Store `frames[i]` in buffer i and return the list of indices."""
+        return [b.store_frame(frame) for b, frame in zip(self.buffers, frames)]
+
+    def store_effects(self, idxes, actions, rewards, dones):
+        for b, idx, action, reward, done in zip(self.buffers, idxes, actions, rewards, dones):
+            b.store_effect(idx, action, reward, done)
+
+    def encode_recent_observations(self):
+        """Stack the recent observation of every buffer, (num_envs, c, h, w)."""
+        return torch.stack([b.encode_recent_observation() for b in self.buffers])
+
+    def close(self):
+        for b in self.buffers:
+            b.close()
+
+
+def _concat(parts, order):
+    """Join the `parts` of a batch and reorder the rows by `order`."""
+    if parts[0] is None:
+        return None
+    if torch.is_tensor(parts[0]):
+        return torch.cat(parts, 0)[torch.from_numpy(order).to(parts[0].device)]
+    return np.concatenate(parts, 0)[order]
+
+
+def _read_meta(path):
+    meta_path = os.path.join(path, 'meta.json')
+    if not os.path.exists(meta_path):
+        return None
+    with open(meta_path) as f:
+        return json.load(f)
+
+
+def _write_meta(path, meta):
+    tmp_path = os.path.join(path, 'meta.json.tmp')
+    with open(tmp_path, 'w') as f:
+        json.dump(meta, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, os.path.join(path, 'meta.json'))
+
+
+def _ring_regions(start, count, size):
+    """Split `count` ring buffer slots from `start` into [lo, hi) ranges."""
+    if start + count <= size:
+        return [(start, start + count)]
+    return [(start, size), (0, start + count - size)]
+
+
+def _write_rows(f, array, lo, hi):
+    row_bytes = int(np.prod(array.shape[1:])) * array.dtype.itemsize
+    step = max(1, SNAPSHOT_CHUNK_BYTES // row_bytes)
+    for a in range(lo, hi, step):
+        b = min(hi, a + step)
+        f.seek(a * row_bytes)
+        f.write(memoryview(np.ascontiguousarray(array[a:b])).cast('B'))
+
+
+def _read_rows(f, array, lo, hi):
+    row_bytes = int(np.prod(array.shape[1:])) * array.dtype.itemsize
+    f.seek(lo * row_bytes)
+    if isinstance(array, np.ndarray):
+        # read straight into the buffer memory
+        if f.readinto(memoryview(array[lo:hi]).cast('B')) != (hi - lo) * row_bytes:
+            raise IOError("Truncated replay buffer snapshot %s" % f.name)
+        return
+    step = max(1, SNAPSHOT_CHUNK_BYTES // row_bytes)
+    for a in range(lo, hi, step):
+        b = min(hi, a + step)
+        rows = np.frombuffer(f.read((b - a) * row_bytes), dtype=array.dtype)
+        if rows.size * array.dtype.itemsize != (b - a) * row_bytes:
+            raise IOError("Truncated replay buffer snapshot %s" % f.name)
+        rows = rows.reshape((b - a,) + tuple(array.shape[1:]))
+        for i in range(b - a):
+            array[a + i] = rows[i]
+
+
+# layout of the SharedReplayBuffer header
+_STARTED, _COMMITTED, _SIZE, _HISTORY, _NDIM = range(5)
+_HEADER_LEN = 8
+
+
+class SharedReplayBuffer(ReplayBuffer):
+    def __init__(self, size, frame_history_len, frame_shape, name=None, sampler=None, create=True):
+        """ReplayBuffer in shared memory, written by one process and sampled
+        by any number of processes attached with `SharedReplayBuffer.attach`.
+        Besides the arrays, a small header holds the buffer geometry and two
+        frame counters. The writer bumps `started` before overwriting a slot
+        and `committed` once the slot and the buffer indices are updated, so
+        `next_idx`/`num_in_buffer` follow from `committed`. A reader samples
+        against the committed state and then checks whether any slot it
+        gathered was started in the meantime; if so the batch may contain a
+        torn frame and is drawn again. Since the sampler keeps
+        `frame_history_len` slots away from the write head this is rare.
+        Parameters
+        ----------
+        size, frame_history_len, sampler:
+            See ReplayBuffer.
+        frame_shape: tuple
+            Shape of a frame as passed to `store_frame`, e.g.
+            `env.observation_space.shape`.
+        name: str or None
+            Prefix of the shared memory segments. Generated when None.
+        create: bool
+            True for the writer. Readers should use `attach` instead.
+        """
+        if name is None:
+            name = 'replay_%d_%s' % (os.getpid(), secrets.token_hex(4))
+        self.name = name
+        self.create = create
+        self.num_synced = 0     # frames of the writer the sampler has seen
+        super(SharedReplayBuffer, self).__init__(size, frame_history_len, sampler,
+                                                 SharedMemoryStorage(name, create))
+
+        if len(frame_shape) > 1:
+            # c, h, w instead of h, w, c
+            frame_shape = (frame_shape[2], frame_shape[0], frame_shape[1])
+        self.header = self.storage.empty('header', [_HEADER_LEN], np.int64)
+        if create:
+            self.header[:] = 0
+            self.header[_SIZE] = size
+            self.header[_HISTORY] = frame_history_len
+            self.header[_NDIM] = len(frame_shape)
+            self.header[_NDIM + 1:_NDIM + 1 + len(frame_shape)] = frame_shape
+        self._allocate(frame_shape)
+
+    @classmethod
+    def attach(cls, name, sampler=None):
+        """Map the buffer created under `name` by another process, without
+        copying it. The returned buffer can only be sampled from."""
+        header = SharedMemoryStorage(name, create=False)
+        geometry = header.empty('header', [_HEADER_LEN], np.int64).copy()
+        header.close()
+        ndim = int(geometry[_NDIM])
+        frame_shape = tuple(int(d) for d in geometry[_NDIM + 1:_NDIM + 1 + ndim])
+        if ndim > 1:
+            # the header keeps c, h, w; the constructor expects h, w, c
+            frame_shape = (frame_shape[1], frame_shape[2], frame_shape[0])
+        return cls(int(geometry[_SIZE]), int(geometry[_HISTORY]), frame_shape,
+                   name=name, sampler=sampler, create=False)
+
+    def store_frame(self, frame):
+        assert self.create, "only the creating process may write"
+        self.header[_STARTED] += 1
+        idx = super(SharedReplayBuffer, self).store_frame(frame)
+        self.header[_COMMITTED] += 1
+        return idx
+
+    def store_effect(self, idx, action, reward, done):
+        assert self.create, "only the creating process may write"
+        super(SharedReplayBuffer, self).store_effect(idx, action, reward, done)
+
+    @property
+    def num_committed(self):
+        """Frames the writer has stored so far."""
+        return int(self.header[_COMMITTED])
+
+    def _sync(self):
+        """Take the committed state of the writer as our own."""
+        committed = int(self.header[_COMMITTED])
+        self.next_idx = committed % self.size
+        self.num_in_buffer = min(self.size, committed)
+        if committed > self.num_synced:
+            # the frames stored since the last sync, at most one whole buffer
+            first = max(self.num_synced, committed - self.size)
+            self.sampler.on_store_frames(np.arange(first, committed) % self.size)
+            self.num_synced = committed
+        return committed
+
+    def _was_overwritten(self, idxes, committed):
+        """True if a slot read for `idxes` was started after `committed`."""
+        num_started = int(self.header[_STARTED]) - committed
+        if num_started == 0:
+            return False
+        if num_started >= self.size:
+            return True
+        slots = idxes[:, None] + np.arange(-self.frame_history_len + 1, 2)[None, :]
+        return bool(np.any((slots - committed) % self.size < num_started))
+
+    def can_sample(self, batch_size):
+        if not self.create:
+            self._sync()
+        return super(SharedReplayBuffer, self).can_sample(batch_size)
+
+    def sample(self, batch_size, return_idxes=False):
+        if self.create:
+            return super(SharedReplayBuffer, self).sample(batch_size, return_idxes)
+        with self.lock:
+            while True:
+                committed = self._sync()
+                assert super(SharedReplayBuffer, self).can_sample(batch_size)
+                idxes = self.sampler.sample(batch_size)
+                batch = self._encode_sample(idxes)
+                if not self._was_overwritten(idxes, committed):
+                    if return_idxes:
+                        batch += (idxes, self._weights(idxes), self._expiry(idxes, committed))
+                    return batch
+
+    def write_counts(self, idxes):
+        return np.full(len(idxes), self.num_committed, dtype=np.int64)
+
+    def encode_recent_observation(self):
+        if not self.create:
+            self._sync()
+        return super(SharedReplayBuffer, self).encode_recent_observation()
@@ -0,0 +1,219 @@
+import numpy as np
+
+
+class Sampler(object):
+    """Strategy that picks which transitions `ReplayBuffer.sample` returns.
+    The buffer calls `attach` once, then `on_store_frame` every time a frame
+    is written, so a sampler can keep its own bookkeeping up to date. Frames
+    that arrive in bulk, from `ReplayBuffer.load` or another process's
+    SharedReplayBuffer, are reported at once by `on_store_frames`.
+    """
+    def attach(self, replay_buffer):
+        self.replay_buffer = replay_buffer
+
+    def on_store_frame(self, idx):
+        """Called after `ReplayBuffer.store_frame` wrote a frame at `idx`."""
+        pass
+
+    def on_store_frames(self, idxes):
+        """Called after frames were written at `idxes`, oldest first, and the
+        buffer indices were set past the newest of them."""
+        if len(idxes) > 0:
+            self.on_store_frame(idxes[-1])
+
+    def can_sample(self, batch_size):
+        """Returns true if `batch_size` transitions can be sampled, i.e. at
+        least that many are valid."""
+        raise NotImplementedError()
+
+    def sample(self, batch_size):
+        """Returns an np.array of `batch_size` buffer indices, distinct
+        unless the sampler draws with replacement (PrioritizedSampler)."""
+        raise NotImplementedError()
+
+    def weights(self, idxes):
+        """Importance sampling weights of `idxes`, None if not needed."""
+        return None
+
+
+class UniformSampler(Sampler):
+    def __init__(self, seed=None):
+        """Samples valid transitions uniformly without replacement.
+        Valid indices always form one contiguous interval of the ring buffer,
+        so the sampler only tracks its start and length:
+            - before the buffer is full every stored frame but the newest one
+              is valid (the newest has no next frame yet)
+            - once full, the newest frame and the `frame_history_len - 1`
+              oldest frames are excluded, since the history of the oldest
+              frames would run into the newest ones
+        Parameters
+        ----------
+        seed: int or None
+            Seed of the np.random.Generator. When None it is drawn from the
+            global numpy RNG, so runs seeded by `set_global_seeds` stay
+            reproducible.
+        """
+        if seed is None:
+            seed = np.random.randint(2 ** 31)
+        self.rng         = np.random.default_rng(seed)
+        self.valid_start = 0
+        self.num_valid   = 0
+
+    def on_store_frame(self, idx):
+        size, history = self.replay_buffer.size, self.replay_buffer.frame_history_len
+        if self.replay_buffer.num_in_buffer < size:
+            self.valid_start = 0
+            self.num_valid   = self.replay_buffer.num_in_buffer - 1
+        else:
+            self.valid_start = (idx + history) % size
+            self.num_valid   = max(0, size - history)
+
+    def can_sample(self, batch_size):
+        return batch_size <= self.num_valid
+
+    def sample(self, batch_size):
+        offsets = self.rng.choice(self.num_valid, batch_size, replace=False)
+        return (self.valid_start + offsets) % self.replay_buffer.size
+
+
+class SumTree(object):
+    def __init__(self, capacity):
+        """Array-backed binary sum tree over `capacity` non-negative leaves.
+        Node i has children 2i and 2i+1, the root is node 1 and leaf j is
+        node `self.capacity + j` (capacity is rounded up to a power of two).
+        Updates and lookups work on whole batches, one vectorized step per
+        tree level.
+        """
+        self.capacity = 1
+        while self.capacity < capacity:
+            self.capacity *= 2
+        self.depth = self.capacity.bit_length() - 1
+        self.tree = np.zeros(2 * self.capacity, dtype=np.float64)
+
+    @property
+    def total(self):
+        return self.tree[1]
+
+    def __getitem__(self, idxes):
+        return self.tree[np.asarray(idxes) + self.capacity]
+
+    def update(self, idxes, values):
+        """Set leaves `idxes` to `values` and refresh their ancestors."""
+        nodes = np.asarray(idxes, dtype=np.int64) + self.capacity
+        self.tree[nodes] = values
+        for _ in range(self.depth):
+            nodes = np.unique(nodes // 2)
+            self.tree[nodes] = self.tree[2 * nodes] + self.tree[2 * nodes + 1]
+
+    def find(self, values):
+        """For each value in [0, total) return the leaf j such that
+        sum(leaves[:j]) <= value < sum(leaves[:j+1])."""
+        values = np.array(values, dtype=np.float64)
+        nodes = np.ones(values.shape, dtype=np.int64)
+        for _ in range(self.depth):
+            left = self.tree[2 * nodes]
+            go_right = values >= left
+            values -= left * go_right
+            nodes = 2 * nodes + go_right
+        return nodes - self.capacity
+
+
+class PrioritizedSampler(Sampler):
+    def __init__(self, alpha=0.6, beta=0.4, eps=1e-6, seed=None):
+        """Proportional prioritized replay (Schaul et al., 2016) on a SumTree.
+        Transitions are drawn with probability p_i^alpha / sum_k p_k^alpha,
+        one sample from each of `batch_size` equal slices of the total, so a
+        batch may repeat a transition with a very large priority. New
+        transitions get the largest priority seen so far, and indices that
+        UniformSampler would exclude are kept at priority zero.
+        Parameters
+        ----------
+        alpha: float
+            How strongly priorities skew sampling, 0 is uniform.
+        beta: float
+            Exponent of the importance weights returned by `weights`.
+        eps: float
+            Added to |TD error| so no valid transition gets priority zero.
+        seed: int or None
+            See UniformSampler.
+        """
+        if seed is None:
+            seed = np.random.randint(2 ** 31)
+        self.rng   = np.random.default_rng(seed)
+        self.alpha = alpha
+        self.beta  = beta
+        self.eps   = eps
+        self.max_priority = 1.0
+
+    def attach(self, replay_buffer):
+        super(PrioritizedSampler, self).attach(replay_buffer)
+        self.tree = SumTree(replay_buffer.size)
+        self.num_valid = 0
+
+    def on_store_frame(self, idx):
+        size, history = self.replay_buffer.size, self.replay_buffer.frame_history_len
+        # the newest frame has no next frame yet, and once the buffer is full
+        # the oldest frames' history runs into it
+        invalid = (idx + np.arange(history if self.replay_buffer.num_in_buffer == size else 1)) % size
+        priorities = np.zeros(len(invalid))
+        if self.replay_buffer.num_in_buffer > 1:
+            invalid = np.append(invalid, (idx - 1) % size)
+            priorities = np.append(priorities, self.max_priority)
+        self.tree.update(invalid, priorities)
+        self._count_valid()
+
+    def on_store_frames(self, idxes):
+        if len(idxes) == 0:
+            return
+        size, history = self.replay_buffer.size, self.replay_buffer.frame_history_len
+        # each new frame completes the transition before it, which gets the
+        # largest priority, unless it is one of the newest frame's neighbours
+        # that are invalid now
+        idxes = np.asarray(idxes, dtype=np.int64)
+        touched = np.unique(np.concatenate(((idxes - 1) % size, (idxes[-1] + np.arange(history)) % size)))
+        self.tree.update(touched, np.where(self._is_valid(touched), self.max_priority, 0.0))
+        self._count_valid()
+
+    def _count_valid(self):
+        size, history = self.replay_buffer.size, self.replay_buffer.frame_history_len
+        if self.replay_buffer.num_in_buffer < size:
+            self.num_valid = self.replay_buffer.num_in_buffer - 1
+        else:
+            self.num_valid = max(0, size - history)
+
+    def _is_valid(self, idxes):
+        size, history = self.replay_buffer.size, self.replay_buffer.frame_history_len
+        if self.replay_buffer.num_in_buffer < size:
+            return idxes < self.replay_buffer.num_in_buffer - 1
+        newest = (self.replay_buffer.next_idx - 1) % size
+        return (idxes - newest) % size >= history
+
+    def can_sample(self, batch_size):
+        return batch_size <= self.num_valid
+
+    def sample(self, batch_size):
+        segment = self.tree.total / batch_size
+        # the strata in random order, so a prefix of the batch (raa_dqn
+        # trains on the first batch_size of sample_size) is not only the
+        # lowest slices of the total
+        values = (self.rng.permutation(batch_size) + self.rng.random(batch_size)) * segment
+        return self.tree.find(np.minimum(values, np.nextafter(self.tree.total, 0)))
+
+    def weights(self, idxes):
+        """Importance sampling weights (N * P(i))^-beta, scaled so the largest
+        weight of the batch is 1."""
+        probs = self.tree[idxes] / self.tree.total
+        weights = (self.num_valid * probs) ** -self.beta
+        return (weights / weights.max()).astype(np.float32)
+
+    def update_priorities(self, idxes, td_errors):
+        """Set the priorities of `idxes` from their |TD error|. Indices that
+        are invalid now are skipped; `ReplayBuffer.update_priorities` drops
+        those overwritten since they were sampled before calling this."""
+        idxes = np.asarray(idxes)
+        if len(idxes) == 0:
+            return
+        priorities = (np.abs(td_errors) + self.eps) ** self.alpha
+        valid = self._is_valid(idxes)
+        self.tree.update(idxes[valid], priorities[valid])
+        self.max_priority = max(self.max_priority, float(priorities.max()))
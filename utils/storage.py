@@ -0,0 +1,213 @@
+import os
+import zlib
+import numpy as np
+from multiprocessing import resource_tracker, shared_memory
+try:
+    import lz4.frame
+except ImportError:
+    lz4 = None
+
+
+class Storage(object):
+    """Allocates the arrays backing a ReplayBuffer."""
+    def empty(self, name, shape, dtype):
+        """Return an uninitialized array called `name`."""
+        raise NotImplementedError()
+
+    def close(self):
+        """Release everything allocated by `empty`."""
+        pass
+
+
+class MemoryStorage(Storage):
+    """Plain in-process numpy arrays."""
+    def empty(self, name, shape, dtype):
+        return np.empty(shape, dtype=dtype)
+
+
+class MemmapStorage(Storage):
+    def __init__(self, directory):
+        """Arrays backed by `np.memmap` files in `directory`.
+        The frames are written in ring order by `store_frame`, so dirty pages
+        are flushed sequentially by the OS, and cold pages can be dropped from
+        the page cache under memory pressure instead of being swapped. The
+        files are created sparse and removed again by `close`.
+        Parameters
+        ----------
+        directory: str
+            Directory holding one `<name>.dat` file per array, e.g. under the
+            run's save_path.
+        """
+        self.directory = directory
+        self.paths = []
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+
+    def empty(self, name, shape, dtype):
+        path = os.path.join(self.directory, '%s.dat' % name)
+        self.paths.append(path)
+        return np.memmap(path, dtype=dtype, mode='w+', shape=tuple(shape))
+
+    def close(self):
+        for path in self.paths:
+            if os.path.exists(path):
+                os.remove(path)
+        self.paths = []
+
+
+class SharedMemoryStorage(Storage):
+    def __init__(self, prefix, create=True):
+        """Arrays in named `multiprocessing.shared_memory` segments, so other
+        processes can map the same memory without copying.
+        Parameters
+        ----------
+        prefix: str
+            Segment `<name>` is registered as `<prefix>_<name>`.
+        create: bool
+            True in the owning process, which creates the segments and
+            unlinks them on `close`. False to attach to existing segments.
+        """
+        self.prefix = prefix
+        self.create = create
+        self.segments = []
+
+    def empty(self, name, shape, dtype):
+        segment_name = '%s_%s' % (self.prefix, name)
+        if self.create:
+            nbytes = max(1, int(np.prod(shape)) * np.dtype(dtype).itemsize)
+            segment = shared_memory.SharedMemory(name=segment_name, create=True, size=nbytes)
+        else:
+            segment = shared_memory.SharedMemory(name=segment_name)
+            # the resource tracker would unlink the segment when this reader
+            # exits, pulling it from under the owner
+            resource_tracker.unregister(segment._name, 'shared_memory')
+        self.segments.append(segment)
+        return np.ndarray(shape, dtype=dtype, buffer=segment.buf)
+
+    def close(self):
+        for segment in self.segments:
+            try:
+                segment.close()
+            except BufferError:
+                # an array view is still alive, the mapping goes with it
+                pass
+            if self.create:
+                segment.unlink()
+        self.segments = []
+
+
+def _get_codec(name):
+    """Return the (compress, decompress) pair of codec `name`."""
+    if name == 'zlib':
+        return (lambda data: zlib.compress(data, 1)), zlib.decompress
+    elif name == 'lz4':
+        if lz4 is None:
+            raise ImportError("the lz4 codec needs the lz4 package")
+        return lz4.frame.compress, lz4.frame.decompress
+    else:
+        raise ValueError("Unknown codec %s" % name)
+
+
+class CompressedFrames(object):
+    def __init__(self, size, frame_shape, codec='zlib', chunk_size=8, delta=False):
+        """Array-like store of uint8 frames, compressed in chunks of
+        `chunk_size` consecutive frames. It supports the indexing
+        ReplayBuffer needs (ints, slices and integer arrays of any shape).
+        The chunk under the write head is kept raw until the writer moves on,
+        and every read decompresses each chunk it touches only once.
+        Parameters
+        ----------
+        size: int
+            Number of frames.
+        frame_shape: tuple
+            Shape of one frame.
+        codec: str
+            'zlib' (level 1) or 'lz4'.
+        chunk_size: int
+            Frames per compressed chunk. Larger chunks compress better but
+            make every sampled frame cost more decompression.
+        delta: bool
+            Store each frame of a chunk as its difference (mod 256) to the
+            previous one, which turns static background into zeros.
+        """
+        self.shape = (size,) + tuple(frame_shape)
+        self.dtype = np.dtype(np.uint8)
+        self.chunk_size = chunk_size
+        self.delta = delta
+        self.compress, self.decompress = _get_codec(codec)
+
+        self.chunks = [None] * ((size + chunk_size - 1) // chunk_size)
+        self.open_chunk = -1
+        self.open_frames = np.zeros((chunk_size,) + self.shape[1:], dtype=np.uint8)
+
+    @property
+    def nbytes(self):
+        return sum(len(c) for c in self.chunks if c is not None) + self.open_frames.nbytes
+
+    def _encode(self, frames):
+        if self.delta:
+            deltas = frames.copy()
+            deltas[1:] -= frames[:-1]
+            frames = deltas
+        return self.compress(frames.tobytes())
+
+    def _decode(self, k):
+        if self.chunks[k] is None:
+            return np.zeros_like(self.open_frames)
+        frames = np.frombuffer(self.decompress(self.chunks[k]), dtype=np.uint8)
+        frames = frames.reshape(self.open_frames.shape)
+        if self.delta:
+            frames = np.cumsum(frames, axis=0, dtype=np.uint8)
+        return frames
+
+    def _flush(self):
+        if self.open_chunk >= 0:
+            self.chunks[self.open_chunk] = self._encode(self.open_frames)
+
+    def __setitem__(self, idx, frame):
+        k = idx // self.chunk_size
+        if k != self.open_chunk:
+            self._flush()
+            # frames of this chunk that are not overwritten yet stay valid
+            self.open_frames[:] = self._decode(k)
+            self.open_chunk = k
+        self.open_frames[idx - k * self.chunk_size] = frame
+
+    def __getitem__(self, idx):
+        if isinstance(idx, slice):
+            idx = np.arange(*idx.indices(self.shape[0]))
+        idx = np.asarray(idx)
+        flat = idx.reshape(-1)
+        chunk_ids, inverse = np.unique(flat // self.chunk_size, return_inverse=True)
+        decoded = np.stack([self.open_frames if k == self.open_chunk else self._decode(k)
+                            for k in chunk_ids])
+        frames = decoded[inverse, flat % self.chunk_size]
+        return frames.reshape(idx.shape + self.shape[1:])
+
+
+class CompressedStorage(MemoryStorage):
+    def __init__(self, codec='zlib', chunk_size=8, delta=False):
+        """Keeps the frames in CompressedFrames and everything else in plain
+        numpy arrays. See CompressedFrames for the parameters."""
+        self.codec = codec
+        self.chunk_size = chunk_size
+        self.delta = delta
+
+    def empty(self, name, shape, dtype):
+        if name == 'obs':
+            return CompressedFrames(shape[0], shape[1:], self.codec, self.chunk_size, self.delta)
+        return super(CompressedStorage, self).empty(name, shape, dtype)
+
+
+def make_storage(name, save_path):
+    """Build the storage called `name` for a run logging to `save_path`:
+    'memory', 'memmap', or a compressed store '<codec>[_delta]' with codec
+    'zlib' or 'lz4', e.g. 'lz4_delta'."""
+    if name == 'memory':
+        return MemoryStorage()
+    elif name == 'memmap':
+        return MemmapStorage('%s/replay' % save_path)
+    elif name.split('_')[0] in ('zlib', 'lz4'):
+        return CompressedStorage(codec=name.split('_')[0], delta=name.endswith('_delta'))
+    else:
+        raise ValueError("Unknown replay storage %s" % name)
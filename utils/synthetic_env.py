@@ -0,0 +1,123 @@
+import re
+import numpy as np
+import gym
+from gym import spaces
+from gym.utils import seeding
+
+# Synthetic[<episode_len>]NoFrameskip-v4, e.g. SyntheticNoFrameskip-v4 or
+# Synthetic2000NoFrameskip-v4 for episodes of at most 2000 frames
+SYNTHETIC_ENV_PATTERN = re.compile(r'^Synthetic(\d*)NoFrameskip-v4$')
+DEFAULT_EPISODE_LEN = 20000
+
+ACTION_MEANINGS = ['NOOP', 'FIRE', 'RIGHT', 'LEFT']
+
+
+class _ALE(object):
+    """The part of the ALE interface the wrappers use, `ale.lives()`."""
+    def __init__(self, env):
+        self.env = env
+
+    def lives(self):
+        return self.env.lives
+
+
+class SyntheticAtariEnv(gym.Env):
+    metadata = {'render.modes': []}
+
+    def __init__(self, episode_len=DEFAULT_EPISODE_LEN, num_lives=5):
+        """A deterministic stand-in for an Atari NoFrameskip env, for
+        benchmarking the whole pipeline without atari-py and ROMs. It has the
+        interface wrap_deepmind expects: 210x160x3 uint8 frames, the actions
+        NOOP, FIRE, RIGHT and LEFT and lives through `unwrapped.ale.lives()`.
+        A ball bounces in the screen and RIGHT/LEFT move a paddle at the
+        bottom: returning the ball gives a reward of 1, missing it costs a
+        life. Given the seed and the actions every frame is reproducible.
+        Parameters
+        ----------
+        episode_len: int
+            Frames after which an episode ends, even with lives left.
+        num_lives: int
+            Lives at the start of an episode.
+        """
+        self.episode_len = episode_len
+        self.num_lives = num_lives
+        self.observation_space = spaces.Box(low=0, high=255, shape=(210, 160, 3), dtype=np.uint8)
+        self.action_space = spaces.Discrete(len(ACTION_MEANINGS))
+        self.ale = _ALE(self)
+
+        # a textured background under the ball and paddle, so frames do not
+        # compress or preprocess unrealistically well
+        y, x = np.mgrid[0:210, 0:160]
+        self.background = np.stack([(3 * x) % 64, (2 * y) % 64, (x + y) % 32], 2).astype(np.uint8)
+        self.lives = num_lives
+        self.seed()
+
+    def seed(self, seed=None):
+        self.np_random, seed = seeding.np_random(seed)
+        return [seed]
+
+    def get_action_meanings(self):
+        return list(ACTION_MEANINGS)
+
+    def _serve(self):
+        self.ball_y, self.ball_x = 60.0, self.np_random.uniform(10, 150)
+        self.speed_y, self.speed_x = 2.0, self.np_random.uniform(-2, 2)
+
+    def _frame(self):
+        frame = self.background.copy()
+        y, x, paddle = int(self.ball_y), int(self.ball_x), int(self.paddle)
+        frame[y - 2:y + 2, x - 1:x + 1] = 200
+        frame[190:194, paddle - 8:paddle + 8] = (200, 72, 72)
+        return frame
+
+    def reset(self):
+        self.lives = self.num_lives
+        self.frames = 0
+        self.paddle = 80.0
+        self._serve()
+        return self._frame()
+
+    def step(self, action):
+        self.frames += 1
+        if ACTION_MEANINGS[action] == 'RIGHT':
+            self.paddle = min(self.paddle + 3, 151)
+        elif ACTION_MEANINGS[action] == 'LEFT':
+            self.paddle = max(self.paddle - 3, 9)
+
+        self.ball_y += self.speed_y
+        self.ball_x += self.speed_x
+        if not 2 <= self.ball_x <= 157:
+            self.speed_x = -self.speed_x
+            self.ball_x = min(max(self.ball_x, 2), 157)
+        if self.ball_y < 32:
+            self.speed_y = -self.speed_y
+
+        reward = 0.0
+        if self.ball_y >= 188:
+            if abs(self.ball_x - self.paddle) <= 10:
+                reward = 1.0
+                self.speed_y = -self.speed_y
+                self.ball_y = 187
+            else:
+                self.lives -= 1
+                self._serve()
+
+        done = self.lives == 0 or self.frames >= self.episode_len
+        return self._frame(), reward, done, {'ale.lives': self.lives}
+
+
+def is_synthetic_env(env_name):
+    return SYNTHETIC_ENV_PATTERN.match(env_name) is not None
+
+
+def register_synthetic_env(env_name):
+    """Register `env_name`, Synthetic[<episode_len>]NoFrameskip-v4, with
+    gym, so gym.make, the Monitor and wrap_deepmind treat it like an Atari
+    env. Registering a name again is a no-op."""
+    if env_name in gym.envs.registry.env_specs:
+        return
+    episode_len = SYNTHETIC_ENV_PATTERN.match(env_name).group(1)
+    gym.envs.registration.register(
+        id=env_name,
+        entry_point='utils.synthetic_env:SyntheticAtariEnv',
+        kwargs=dict(episode_len=int(episode_len) if episode_len else DEFAULT_EPISODE_LEN))
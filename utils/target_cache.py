@@ -0,0 +1,144 @@
+import numpy as np
+import torch
+
+device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+
+# bytes per cached entry: two float32 values on `device`, expiry, last use
+# and owner (version, index) on the host
+ENTRY_BYTES = 2 * 4 + 4 * 8
+
+
+class TargetCache(object):
+    def __init__(self, replay_buffer, num_targets, budget_mb=256):
+        """Outputs of the frozen target networks per replay index, so a
+        transition sampled again while the same targets are live costs no
+        target forward. An entry holds Q_target(s, a) and the backed up value
+        of s' (max, mellowmax or softmax, whichever the learner uses) and is
+        keyed by (target version, replay index).
+        Entries live in a pool of slots sized by `budget_mb`, with one dense
+        index -> slot table per live target version. `rotate` drops the
+        version of the oldest target when the learner reloads it. Entries
+        also carry the `expiry` returned by `ReplayBuffer.sample`, so a slot
+        the ring buffer has overwritten since is a miss. Once the pool is
+        full the least recently used eighth of it is evicted.
+        Parameters
+        ----------
+        replay_buffer: ReplayBuffer or VecReplayBuffer
+            Buffer the indices come from.
+        num_targets: int
+            Number of live target networks (MAX_NUM in the learner).
+        budget_mb: float
+            Memory for the slot pool and the index tables.
+        """
+        self.replay_buffer = replay_buffer
+        # a VecReplayBuffer's indices span all of its buffers
+        self.num_indices = replay_buffer.size * len(getattr(replay_buffer, 'buffers', [replay_buffer]))
+        table_bytes = num_targets * self.num_indices * 4
+        self.capacity = int(budget_mb * 2 ** 20 - table_bytes) // ENTRY_BYTES
+        assert self.capacity > 0, "budget_mb does not even cover the index tables"
+
+        self.values    = torch.zeros(self.capacity, 2, device=device)
+        self.expiry    = np.zeros(self.capacity, dtype=np.int64)
+        self.last_used = np.zeros(self.capacity, dtype=np.int64)
+        self.owner     = np.full((self.capacity, 2), -1, dtype=np.int64)
+        self.free      = np.arange(self.capacity)[::-1].copy()
+        self.tick      = 0
+
+        # (version, index -> slot) of the live targets, oldest first
+        self.tables = [(v, np.full(self.num_indices, -1, dtype=np.int32)) for v in range(num_targets)]
+        self.next_version = num_targets
+
+        self.num_lookups = 0
+        self.num_hits    = 0
+        self.num_saved   = 0
+
+    def __len__(self):
+        return self.capacity - len(self.free)
+
+    def rotate(self):
+        """Forget the oldest target, whose network was reloaded and is now
+        the newest."""
+        version, table = self.tables.pop(0)
+        self._release(table[table >= 0])
+        table[:] = -1
+        self.tables.append((self.next_version, table))
+        self.next_version += 1
+
+    def lookup(self, idxes, num):
+        """Cached outputs of the newest `num` targets.
+        Parameters
+        ----------
+        idxes: np.array
+            Replay indices of a sampled batch.
+        num: int
+        Returns
+        -------
+        hit: np.array
+            Bool of shape (len(idxes),), True where all `num` targets have a
+            current entry.
+        values: torch.Tensor
+            Shape (num, hit.sum(), 2) on `device`, oldest target first;
+            [..., 0] is Q(s, a) and [..., 1] the value of s'.
+        """
+        idxes = np.asarray(idxes)
+        slots = np.stack([table[idxes] for _, table in self.tables[-num:]])
+        current = (slots >= 0) & (self.expiry[slots] >= self.replay_buffer.write_counts(idxes))
+        hit = current.all(0)
+        hit_slots = slots[:, hit]
+
+        self.tick += 1
+        self.last_used[hit_slots] = self.tick
+        self.num_lookups += len(idxes)
+        self.num_hits    += int(hit.sum())
+        self.num_saved   += num * int(hit.sum())
+        return hit, self.values[torch.from_numpy(hit_slots.astype(np.int64)).to(device)]
+
+    def insert(self, idxes, expiry, values, num):
+        """Store the outputs of the newest `num` targets for `idxes`, with
+        `values` as returned by `lookup` and `expiry` as by `sample`."""
+        idxes, first = np.unique(np.asarray(idxes), return_index=True)
+        expiry, values = np.asarray(expiry)[first], values[:, torch.from_numpy(first).to(device)]
+        tables = self.tables[-num:]
+        slots = np.stack([table[idxes] for _, table in tables])
+        self.last_used[slots[slots >= 0]] = self.tick
+
+        missing = slots < 0
+        if missing.sum() > len(self.free):
+            self._evict(missing.sum())
+            if missing.sum() > len(self.free):
+                return
+        new_slots = self.free[len(self.free) - missing.sum():]
+        self.free = self.free[:len(self.free) - missing.sum()]
+        slots[missing] = new_slots
+        for (version, table), target_slots, target_missing in zip(tables, slots, missing):
+            table[idxes[target_missing]] = target_slots[target_missing]
+            self.owner[target_slots[target_missing]] = np.stack(
+                [np.full(target_missing.sum(), version), idxes[target_missing]], 1)
+
+        self.expiry[slots] = expiry[None, :]
+        self.last_used[slots] = self.tick
+        self.values[torch.from_numpy(slots.reshape(-1).astype(np.int64)).to(device)] = values.reshape(-1, 2)
+
+    def _evict(self, count):
+        # slots used by the current lookup/insert are never evicted
+        count = max(int(count) - len(self.free), self.capacity // 8)
+        candidates = np.flatnonzero((self.owner[:, 0] >= 0) & (self.last_used < self.tick))
+        if len(candidates) > count:
+            candidates = candidates[np.argpartition(self.last_used[candidates], count)[:count]]
+        versions = self.owner[candidates, 0]
+        for version, table in self.tables:
+            table[self.owner[candidates[versions == version], 1]] = -1
+        self._release(candidates)
+
+    def _release(self, slots):
+        self.owner[slots] = -1
+        self.free = np.concatenate([self.free, slots])
+
+    def stats(self):
+        """Hit rate of the lookups and number of (transition, target)
+        forwards saved, since the last call."""
+        stats = {'hit_rate': self.num_hits / max(self.num_lookups, 1),
+                 'saved_forwards': self.num_saved,
+                 'entries': len(self)}
+        self.num_lookups, self.num_hits, self.num_saved = 0, 0, 0
+        return stats
@@ -0,0 +1,148 @@
+import functools
+import multiprocessing as mp
+import numpy as np
+import torch
+
+from utils.gym_setup import get_env, get_wrapper_by_name
+
+device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+
+
+def _worker(remote, parent_remote, env_fn):
+    parent_remote.close()
+    env = env_fn()
+    try:
+        while True:
+            cmd, data = remote.recv()
+            if cmd == 'step':
+                obs, reward, done, info = env.step(data)
+                if done:
+                    obs = env.reset()
+                remote.send((obs, reward, done))
+            elif cmd == 'reset':
+                remote.send(env.reset())
+            elif cmd == 'monitor':
+                monitor = get_wrapper_by_name(env, "Monitor")
+                remote.send((monitor.get_total_steps(), monitor.get_episode_rewards()))
+            elif cmd == 'spaces':
+                remote.send((env.observation_space, env.action_space))
+            elif cmd == 'close':
+                break
+    finally:
+        env.close()
+        remote.close()
+
+
+class SubprocVecEnv(object):
+    def __init__(self, env_fns):
+        """Run one environment per subprocess and step them together.
+        An env that finishes an episode is reset right away, and the first
+        observation of the new episode is returned in place of the last one,
+        just as the learners do with `env.reset()` after `done`.
+        Parameters
+        ----------
+        env_fns: [callable]
+            Functions building the (wrapped) environments.
+        """
+        self.num_envs = len(env_fns)
+        self.waiting = False
+        self.remotes, work_remotes = zip(*[mp.Pipe() for _ in range(self.num_envs)])
+        self.processes = [mp.Process(target=_worker, args=(work_remote, remote, env_fn), daemon=True)
+                          for work_remote, remote, env_fn in zip(work_remotes, self.remotes, env_fns)]
+        for process, work_remote in zip(self.processes, work_remotes):
+            process.start()
+            work_remote.close()
+
+        self.remotes[0].send(('spaces', None))
+        self.observation_space, self.action_space = self.remotes[0].recv()
+
+    def step_async(self, actions):
+        """Start stepping env i with `actions[i]` without waiting for it."""
+        for remote, action in zip(self.remotes, actions):
+            remote.send(('step', int(action)))
+        self.waiting = True
+
+    def step_wait(self):
+        """Wait for `step_async` and return the stacked obs, rewards and dones."""
+        results = [remote.recv() for remote in self.remotes]
+        self.waiting = False
+        obs, rewards, dones = zip(*results)
+        return np.stack(obs), np.array(rewards, dtype=np.float32), np.array(dones)
+
+    def step(self, actions):
+        self.step_async(actions)
+        return self.step_wait()
+
+    def reset(self):
+        for remote in self.remotes:
+            remote.send(('reset', None))
+        return np.stack([remote.recv() for remote in self.remotes])
+
+    def get_monitor_stats(self):
+        """Total steps and episode rewards summed up over the Monitor of every env."""
+        for remote in self.remotes:
+            remote.send(('monitor', None))
+        total_steps, episode_rewards = 0, []
+        for remote in self.remotes:
+            steps, rewards = remote.recv()
+            total_steps += steps
+            episode_rewards += list(rewards)
+        return total_steps, episode_rewards
+
+    def close(self):
+        if self.waiting:
+            self.step_wait()
+        for remote in self.remotes:
+            remote.send(('close', None))
+        for process in self.processes:
+            process.join()
+
+
+def make_vec_env(env_name, seed, save_path, num_envs):
+    """`num_envs` copies of `get_env`, seeded seed, seed+1, ... and each with
+    its own Monitor directory."""
+    return SubprocVecEnv([functools.partial(get_env, env_name, seed + i, '%s/env-%d' % (save_path, i))
+                          for i in range(num_envs)])
+
+
+class VecActor(object):
+    def __init__(self, env, replay_buffer, num_actions):
+        """Epsilon greedy acting in a SubprocVecEnv with one batched Q forward
+        for all envs. Env i writes to `replay_buffer.buffers[i]`. Each `step`
+        collects the transitions of the previous one, so the envs run while
+        the learner updates.
+        Parameters
+        ----------
+        env: SubprocVecEnv
+        replay_buffer: VecReplayBuffer
+            With one buffer per env.
+        num_actions: int
+        """
+        self.env = env
+        self.replay_buffer = replay_buffer
+        self.num_actions = num_actions
+        self.last_obs = env.reset()
+        self.idxes = None
+        self.actions = None
+
+    def step(self, Q, epsilon):
+        """Store the frames of the previous step, choose actions for all envs
+        and start the next step."""
+        if self.env.waiting:
+            obs, rewards, dones = self.env.step_wait()
+            # clipping the reward, noted in nature paper
+            self.replay_buffer.store_effects(self.idxes, self.actions, np.clip(rewards, -1.0, 1.0), dones)
+            self.last_obs = obs
+
+        self.idxes = self.replay_buffer.store_frames(self.last_obs)
+
+        actions = np.random.randint(self.num_actions, size=self.env.num_envs)
+        explore = np.random.rand(self.env.num_envs) < epsilon
+        if not explore.all():
+            observations = self.replay_buffer.encode_recent_observations()
+            with torch.no_grad():
+                greedy = Q(observations).max(1)[1].cpu().numpy()
+            actions = np.where(explore, actions, greedy)
+
+        self.env.step_async(actions)
+        self.actions = actions